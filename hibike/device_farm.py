@@ -0,0 +1,241 @@
+"""
+Load test Hibike with many virtual devices in a single event loop.
+
+usage:
+$ python3 device_farm.py -n 200                 # 200 devices, cycling through every type, for 10 s
+$ python3 device_farm.py -n 50 -d YogiBear --delay 10 --duration 30
+$ python3 device_farm.py -n 100 --baud 115200   # emulate the speed of a serial link
+$ python3 device_farm.py -n 20 --profile stress # every param, as fast as possible
+$ python3 device_farm.py -n 20 --capture farm.cap  # record traffic for replay_capture.py
+
+Each ``VirtualDevice`` is connected to a ``SmartSensorProtocol`` through an
+in-memory loopback transport, so there are no PTYs, no ``socat`` and no
+extra processes. Once every device has been identified and subscribed,
+the farm measures how many DeviceData packets the devices send, how many
+Hibike decodes, how many sensor values reach the (stand-in) StateManager
+queue through ``batch_data``, and how late the event loop wakes up. The
+loopback links never lose bytes, so frames that have not been decoded by
+the end are reported as in flight; only invalid frames are lost.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import hibike_message as hm
+from hibike_process import SmartSensorProtocol, batch_data
+from serial_capture import CaptureFile
+from transports import connect_loopback
+from virtual_device import VirtualDevice, DEFAULT_VALUES, PROFILES, STRESS_DELAY_MS
+
+# Time in seconds to wait for every device to be identified
+IDENTIFY_WAIT = 10
+# Interval in seconds at which loop lag is sampled
+LAG_SAMPLE_INTERVAL = 0.01
+
+
+class StateQueueSink:
+    """
+    Stands in for the queue to StateManager, counting what reaches it.
+    """
+    def __init__(self):
+        self.messages = {}
+        self.values = 0
+
+    # pylint: disable=unused-argument
+    async def coro_put(self, item, loop=None):
+        """Count ITEM."""
+        message_type, args = item
+        self.messages[message_type] = self.messages.get(message_type, 0) + 1
+        if message_type == "device_values":
+            self.values += sum(len(values) for values in args[0].values())
+
+
+class LoopLagMonitor:
+    """
+    Measure how much later than requested the event loop wakes up a sleeping task.
+    """
+    def __init__(self, event_loop, interval=LAG_SAMPLE_INTERVAL):
+        self.event_loop = event_loop
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        """Sample loop lag forever."""
+        while True:
+            expected = self.event_loop.time() + self.interval
+            await asyncio.sleep(self.interval, loop=self.event_loop)
+            self.lags.append(max(self.event_loop.time() - expected, 0))
+
+    def summary(self):
+        """Return the mean, p99 and maximum lag in milliseconds."""
+        if not self.lags:
+            return 0, 0, 0
+        lags = sorted(self.lags)
+        return (1000 * sum(lags) / len(lags), 1000 * lags[int(0.99 * (len(lags) - 1))],
+                1000 * lags[-1])
+
+
+def make_uid(device_name, rng):
+    """Make a random UID for a device of type DEVICE_NAME."""
+    return (hm.device_name_to_id(device_name) << 72) | (1 << 64) | rng.getrandbits(64)
+
+
+def readable_params(uid):
+    """Return every readable param of the device UID that virtual devices have a value for."""
+    device_id = hm.uid_to_device_id(uid)
+    values = DEFAULT_VALUES[hm.uid_to_device_name(uid)]
+    return [param["name"] for param in hm.DEVICES[device_id]["params"]
+            if hm.readable(device_id, param["name"]) and param["name"] in values]
+
+
+def data_packets(stats, message_type="DeviceData"):
+    """Count packets of MESSAGE_TYPE in a `SmartSensorProtocol.stats` result."""
+    return stats["packets"].get(message_type, 0)
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+async def run_farm(event_loop, device_names, delay, duration, bytes_per_sec,
+                   profile="default", capture_file=None):
+    """
+    Connect a virtual device of each type in DEVICE_NAMES to Hibike and
+    measure for DURATION seconds after subscribing at DELAY milliseconds.
+    The devices answer subscriptions according to PROFILE, and Hibike's
+    traffic is recorded in CAPTURE_FILE if given.
+    """
+    rng = random.Random(0)
+    devices = {}
+    batched_data = {}
+    last_sent = {}
+    pending = set()
+    error_queue = asyncio.Queue(loop=event_loop)
+    sink = StateQueueSink()
+    links = []
+
+    def host_factory():
+        return SmartSensorProtocol(devices, batched_data, error_queue, sink, event_loop, pending,
+                                   capture_file=capture_file, last_sent=last_sent)
+
+    for num, device_name in enumerate(device_names):
+        uid = make_uid(device_name, rng)
+        name = "loop{}".format(num)
+        pending.add(name)
+        (_, host), (device_transport, _) = connect_loopback(
+            event_loop, host_factory,
+            lambda uid=uid: VirtualDevice(uid, event_loop, profile=profile), name, bytes_per_sec)
+        links.append((host, device_transport))
+
+    start = event_loop.time()
+    while pending and event_loop.time() - start < IDENTIFY_WAIT:
+        await asyncio.sleep(0.05, loop=event_loop)
+    identify_time = event_loop.time() - start
+    print("Identified {} of {} devices in {:.2f} s".format(
+        len(devices), len(device_names), identify_time))
+
+    for uid, dev in devices.items():
+        dev.write_queue.put_nowait(("subscribe", (uid, delay, readable_params(uid))))
+    # Let the subscriptions take effect before measuring
+    await asyncio.sleep(max(0.2, 5 * delay / 1000), loop=event_loop)
+
+    lag_monitor = LoopLagMonitor(event_loop)
+    lag_task = event_loop.create_task(lag_monitor.run())
+    batch_task = event_loop.create_task(batch_data(batched_data, sink, event_loop, last_sent))
+
+    cpu_start = time.process_time()
+    before = totals(links, sink)
+    await asyncio.sleep(duration, loop=event_loop)
+    after = totals(links, sink)
+    cpu = time.process_time() - cpu_start
+    lag_task.cancel()
+    batch_task.cancel()
+
+    results = dict(zip(("sent", "received", "decoded", "values"),
+                       (end - begin for begin, end in zip(before, after))))
+    results["frame_errors"] = count_frame_errors(links)
+    results["queued"] = sum(host.read_queue.qsize() for host, _ in links)
+    # Every frame sent so far was received, is queued for decoding, was invalid or is on the link
+    results["on_link"] = (after[0] - after[1] - results["queued"]
+                          - sum(results["frame_errors"].values()))
+    results["delay"] = STRESS_DELAY_MS if profile == "stress" else delay
+    results["expected"] = len(devices) * 1000 / results["delay"] * duration
+    print_report(len(devices), duration, results, lag_monitor.summary(), cpu)
+
+    for host, _ in links:
+        await host.stop()
+
+
+def totals(links, sink):
+    """Count frames sent, packets received and decoded, and values that reached SINK so far."""
+    sent = sum(transport.writes for _, transport in links)
+    received = sum(sum(host.link_stats.packets.values()) for host, _ in links)
+    decoded = sum(data_packets(host.stats()) for host, _ in links)
+    return sent, received, decoded, sink.values
+
+
+def count_frame_errors(links):
+    """Add up the invalid frames of every host in LINKS, by reason."""
+    frame_errors = {}
+    for host, _ in links:
+        for reason, count in (getattr(host.serial_buf, "errors", None) or {}).items():
+            frame_errors[reason] = frame_errors.get(reason, 0) + count
+    return frame_errors
+
+
+def print_report(num_devices, duration, results, lag, cpu):
+    """
+    Print the RESULTS of measuring NUM_DEVICES for DURATION seconds, the
+    mean, p99 and maximum loop LAG, and the CPU time used.
+    """
+    print("Devices:               {}".format(num_devices))
+    print("Subscription delay:    {} ms ({:.0f} packets/s expected)".format(
+        results["delay"], results["expected"] / duration))
+    print("Frames sent:           {:.0f}/s".format(results["sent"] / duration))
+    print("Packets received:      {:.0f}/s".format(results["received"] / duration))
+    print("DeviceData decoded:    {:.0f}/s ({:.1%} of expected)".format(
+        results["decoded"] / duration,
+        results["decoded"] / results["expected"] if results["expected"] else 0))
+    print("Values to StateManager {:.0f}/s".format(results["values"] / duration))
+    print("Frames in flight:      {} (on the link: {}, queued for decoding: {})".format(
+        results["on_link"] + results["queued"], results["on_link"], results["queued"]))
+    print("Invalid frames:        {}".format(
+        {reason: count for reason, count in results["frame_errors"].items() if count}
+        or "none"))
+    print("Event loop lag:        mean {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(*lag))
+    print("CPU:                   {:.0%} of one core".format(cpu / duration))
+
+
+def main():
+    """
+    Parse arguments and run the farm.
+    """
+    parser = argparse.ArgumentParser(description="Load test Hibike with virtual devices.")
+    parser.add_argument("-n", "--num-devices", type=int, default=100,
+                        help="number of virtual devices")
+    parser.add_argument("-d", "--device", action="append", choices=sorted(DEFAULT_VALUES),
+                        help="device type to use (may be repeated; default: all)")
+    parser.add_argument("--delay", type=int, default=40,
+                        help="subscription delay in milliseconds")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to measure for")
+    parser.add_argument("--baud", type=int, default=None,
+                        help="emulate serial links of this speed (default: unlimited)")
+    parser.add_argument("--profile", choices=PROFILES, default="default",
+                        help="how virtual devices answer subscription requests")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="append Hibike's traffic to this capture file")
+    args = parser.parse_args()
+
+    device_types = args.device or sorted(DEFAULT_VALUES)
+    device_names = [device_types[num % len(device_types)] for num in range(args.num_devices)]
+    bytes_per_sec = args.baud / 10 if args.baud else None
+    capture_file = CaptureFile(args.capture) if args.capture else None
+    event_loop = asyncio.get_event_loop()
+    event_loop.run_until_complete(run_farm(event_loop, device_names, args.delay,
+                                           args.duration, bytes_per_sec, args.profile,
+                                           capture_file))
+    if capture_file is not None:
+        capture_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Ways for Hibike to find out that serial devices may have come or gone.
+
+``make_device_watcher`` picks the best watcher available: an inotify watcher
+on Linux, which wakes up within milliseconds of a matching file being created,
+deleted or having its permissions changed, or a watcher that just polls
+otherwise. Both have the same interface::
+
+    watcher = make_device_watcher(event_loop, {"/dev": ["ttyACM*"]}, 1)
+    while True:
+        await watcher.wait()
+        # rescan
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import struct
+
+__all__ = ["PollingWatcher", "InotifyWatcher", "CachedFile", "make_device_watcher"]
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# watch descriptor, mask, cookie, len; followed by a NUL-padded name of length len
+INOTIFY_EVENT = struct.Struct("iIII")
+READ_SIZE = 4096
+
+
+class PollingWatcher:
+    """
+    Wake up every ``interval`` seconds.
+    """
+    def __init__(self, event_loop, interval):
+        self.event_loop = event_loop
+        self.interval = interval
+
+    async def wait(self):
+        """
+        Wait until it is time to rescan.
+        """
+        await asyncio.sleep(self.interval, loop=self.event_loop)
+
+    def close(self):
+        """
+        Stop watching.
+        """
+
+
+class InotifyWatcher:
+    """
+    Wake up when a file matching a pattern is created, deleted or changed in
+    one of the watched directories, or every ``interval`` seconds otherwise.
+
+    :param event_loop: The event loop
+    :param dict watches: Mapping from directories to lists of glob patterns
+    of file names in them
+    :param interval: The longest time to go without waking up, in seconds
+    """
+    _libc = None
+
+    def __init__(self, event_loop, watches, interval):
+        libc = self._load_libc()
+        self.event_loop = event_loop
+        self.interval = interval
+        self._changed = asyncio.Event(loop=event_loop)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._patterns = {}
+        try:
+            for directory, patterns in watches.items():
+                watch = libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+                if watch < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "inotify_add_watch failed for {}".format(directory))
+                self._patterns[watch] = patterns
+            event_loop.add_reader(self._fd, self._read_events)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            # Raises AttributeError on systems without inotify
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            watch, _, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            patterns = self._patterns.get(watch, ())
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                self._changed.set()
+
+    async def wait(self):
+        """
+        Wait until a watched file changes, or until it is time to rescan anyway.
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), self.interval, loop=self.event_loop)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        self.event_loop.remove_reader(self._fd)
+        os.close(self._fd)
+
+
+def make_device_watcher(event_loop, watches, interval):
+    """
+    Create an ``InotifyWatcher`` if possible, falling back to a ``PollingWatcher``.
+
+    Directories in ``watches`` that don't exist are skipped.
+    """
+    watches = {directory: patterns for directory, patterns in watches.items()
+               if os.path.isdir(directory)}
+    try:
+        return InotifyWatcher(event_loop, watches, interval)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(event_loop, interval)
+
+
+class CachedFile:
+    """
+    The contents of a text file, only re-read when its modification time changes.
+    A missing file reads as empty.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._contents = ""
+
+    def read(self):
+        """
+        Return the contents of the file.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self._mtime = None
+            self._contents = ""
+            return self._contents
+        if mtime != self._mtime:
+            try:
+                with open(self.path) as config_file:
+                    self._contents = config_file.read()
+            except OSError:
+                self._contents = ""
+            self._mtime = mtime
+        return self._contents
@@ -0,0 +1,345 @@
+"""
+Microbenchmarks for the Hibike wire protocol.
+
+usage:
+$ python3 hibike_benchmark.py                           # run and print results
+$ python3 hibike_benchmark.py --save baseline.json      # keep results as a baseline
+$ python3 hibike_benchmark.py --compare baseline.json   # flag regressions
+
+Fixtures are generated from hibikeDevices.json with a fixed seed, so runs
+on the same machine are comparable. Every device type is covered: devices
+with few params use every param subset, larger ones use a deterministic
+sample of subsets that always includes each single param and the full set.
+"""
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+
+import hibike_message as hm
+
+# Seed for fixture generation
+FIXTURE_SEED = 0xB0BA
+# Devices with more params than this get a sample of subsets instead of all of them
+MAX_SUBSETS_PER_DEVICE = 256
+# Minimum duration of a single timing round, in seconds
+MIN_ROUND_TIME = 0.2
+# Number of timing rounds; the fastest one is reported
+ROUNDS = 5
+# Relative slowdown in ns/op above which a benchmark counts as a regression
+DEFAULT_THRESHOLD = 0.10
+
+# Ranges of random values for each param type
+VALUE_GENERATORS = {
+    "bool": lambda rng: rng.randrange(2) == 0,
+    "uint8_t": lambda rng: rng.randrange(2 ** 8),
+    "int8_t": lambda rng: rng.randrange(-(2 ** 7), 2 ** 7),
+    "uint16_t": lambda rng: rng.randrange(2 ** 16),
+    "int16_t": lambda rng: rng.randrange(-(2 ** 15), 2 ** 15),
+    "uint32_t": lambda rng: rng.randrange(2 ** 32),
+    "int32_t": lambda rng: rng.randrange(-(2 ** 31), 2 ** 31),
+    "uint64_t": lambda rng: rng.randrange(2 ** 64),
+    "int64_t": lambda rng: rng.randrange(-(2 ** 63), 2 ** 63),
+    "float": lambda rng: rng.uniform(-1, 1),
+    "double": lambda rng: rng.uniform(-1, 1),
+}
+
+
+class NullConnection:
+    """
+    A connection that throws away everything written to it.
+    """
+    def write(self, data):
+        """Discard DATA."""
+
+
+class CaptureConnection:
+    """
+    A connection that keeps everything written to it.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data):
+        """Append DATA to the buffer."""
+        self.buf.extend(data)
+
+
+def param_subsets(device_id, rng):
+    """
+    Return the param subsets of DEVICE_ID to benchmark, as tuples of names.
+    """
+    params = [param["name"] for param in hm.DEVICES[device_id]["params"]]
+    if 2 ** len(params) <= MAX_SUBSETS_PER_DEVICE:
+        return [subset for size in range(1, len(params) + 1)
+                for subset in itertools.combinations(params, size)]
+    subsets = {(param,) for param in params}
+    subsets.add(tuple(params))
+    while len(subsets) < MAX_SUBSETS_PER_DEVICE:
+        size = rng.randrange(2, len(params))
+        subsets.add(tuple(sorted(rng.sample(params, size), key=params.index)))
+    return sorted(subsets, key=lambda subset: (len(subset), subset))
+
+
+def make_fixtures(seed=FIXTURE_SEED):
+    """
+    Build the fixtures shared by every benchmark.
+
+    Returns:
+        A dict with lists of ``(device_id, params_and_values)`` pairs,
+        DeviceData/DeviceWrite messages, raw message bytes, and encoded frames.
+    """
+    rng = random.Random(seed)
+    fixtures = {"params_and_values": [], "device_data": [], "device_write": [],
+                "message_bytes": [], "frames": [], "subscriptions": []}
+    for device_id in sorted(hm.DEVICES):
+        for subset in param_subsets(device_id, rng):
+            params_and_values = [(name, VALUE_GENERATORS[hm.param_type(device_id, name)](rng))
+                                 for name in subset]
+            data = hm.make_device_data(device_id, params_and_values)
+            write = hm.make_device_write(device_id, params_and_values)
+            fixtures["params_and_values"].append((device_id, params_and_values))
+            fixtures["device_data"].append((data, device_id))
+            fixtures["device_write"].append((write, device_id))
+            fixtures["subscriptions"].append((device_id, subset, 40))
+            for msg in (data, write):
+                conn = CaptureConnection()
+                hm.send(conn, msg)
+                fixtures["message_bytes"].append(msg.to_bytes())
+                fixtures["frames"].append(conn.buf)
+    return fixtures
+
+
+def bench_make_device_data(fixtures):
+    """Encode DeviceData messages."""
+    make_device_data = hm.make_device_data
+    cases = fixtures["params_and_values"]
+    def run():
+        for device_id, params_and_values in cases:
+            make_device_data(device_id, params_and_values)
+    return run, len(cases)
+
+
+def bench_make_device_write(fixtures):
+    """Encode DeviceWrite messages."""
+    make_device_write = hm.make_device_write
+    cases = fixtures["params_and_values"]
+    def run():
+        for device_id, params_and_values in cases:
+            make_device_write(device_id, params_and_values)
+    return run, len(cases)
+
+
+def bench_make_subscription_request(fixtures):
+    """Encode SubscriptionRequest messages."""
+    make_subscription_request = hm.make_subscription_request
+    cases = fixtures["subscriptions"]
+    def run():
+        for device_id, params, delay in cases:
+            make_subscription_request(device_id, params, delay)
+    return run, len(cases)
+
+
+def bench_checksum(fixtures):
+    """Checksum raw messages."""
+    checksum = hm.checksum
+    cases = fixtures["message_bytes"]
+    def run():
+        for message_bytes in cases:
+            checksum(message_bytes)
+    return run, len(cases)
+
+
+def bench_send(fixtures):
+    """Checksum, COBS-encode and frame messages."""
+    send = hm.send
+    conn = NullConnection()
+    cases = [msg for msg, _ in fixtures["device_data"]]
+    def run():
+        for msg in cases:
+            send(conn, msg)
+    return run, len(cases)
+
+
+def bench_parse_bytes(fixtures):
+    """Parse single frames."""
+    parse_bytes = hm.parse_bytes
+    cases = fixtures["frames"]
+    def run():
+        for frame in cases:
+            parse_bytes(frame)
+    return run, len(cases)
+
+
+def bench_parse_device_data(fixtures):
+    """Decode DeviceData payloads."""
+    parse_device_data = hm.parse_device_data
+    cases = fixtures["device_data"]
+    def run():
+        for msg, device_id in cases:
+            parse_device_data(msg, device_id)
+    return run, len(cases)
+
+
+def bench_decode_device_write(fixtures):
+    """Decode DeviceWrite payloads."""
+    decode_device_write = hm.decode_device_write
+    cases = fixtures["device_write"]
+    def run():
+        for msg, device_id in cases:
+            decode_device_write(msg, device_id)
+    return run, len(cases)
+
+
+def bench_deframe_stream(fixtures):
+    """Split a stream of back-to-back frames into packets."""
+    stream = b"".join(fixtures["frames"])
+    # Feed the stream in chunks about the size of a serial read
+    chunks = [stream[i:i + 64] for i in range(0, len(stream), 64)]
+    num_frames = len(fixtures["frames"])
+    def run():
+        deframer = hm.PacketDeframer()
+        for chunk in chunks:
+            deframer.feed(chunk)
+            for _ in deframer.packets():
+                pass
+    return run, num_frames
+
+
+BENCHMARKS = {
+    "encode.make_device_data": bench_make_device_data,
+    "encode.make_device_write": bench_make_device_write,
+    "encode.make_subscription_request": bench_make_subscription_request,
+    "encode.checksum": bench_checksum,
+    "encode.send": bench_send,
+    "decode.parse_bytes": bench_parse_bytes,
+    "decode.parse_device_data": bench_parse_device_data,
+    "decode.decode_device_write": bench_decode_device_write,
+    "decode.deframe_stream": bench_deframe_stream,
+}
+
+
+def time_benchmark(run, ops_per_run, min_round_time=MIN_ROUND_TIME, rounds=ROUNDS):
+    """
+    Time RUN, which performs OPS_PER_RUN operations per call.
+
+    Returns:
+        The best observed time per operation, in nanoseconds.
+    """
+    # Calibrate the number of calls so that one round lasts at least MIN_ROUND_TIME
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_round_time:
+            break
+        calls *= 2
+    best = elapsed
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e9 / (calls * ops_per_run)
+
+
+def run_benchmarks(names, min_round_time=MIN_ROUND_TIME, rounds=ROUNDS):
+    """
+    Run the benchmarks in NAMES.
+
+    Returns:
+        A dict mapping benchmark names to ``{"ns_per_op": ..., "ops_per_sec": ...}``.
+    """
+    fixtures = make_fixtures()
+    results = {}
+    for name in names:
+        run, ops_per_run = BENCHMARKS[name](fixtures)
+        ns_per_op = time_benchmark(run, ops_per_run, min_round_time, rounds)
+        results[name] = {"ns_per_op": ns_per_op, "ops_per_sec": 1e9 / ns_per_op}
+        print("{:<40} {:>12.1f} ns/op {:>14.0f} ops/sec".format(
+            name, ns_per_op, 1e9 / ns_per_op))
+    return results
+
+
+def environment_info():
+    """
+    Describe the machine the benchmarks ran on.
+    """
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "fixture_seed": FIXTURE_SEED,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compare RESULTS against BASELINE.
+
+    Returns:
+        A list of names of benchmarks that slowed down by more than THRESHOLD.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print("{:<40} (no baseline)".format(name))
+            continue
+        old_ns = baseline[name]["ns_per_op"]
+        change = (result["ns_per_op"] - old_ns) / old_ns
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print("{:<40} {:>12.1f} -> {:>10.1f} ns/op {:>+8.1%} {}".format(
+            name, old_ns, result["ns_per_op"], change, flag))
+    return regressions
+
+
+def main():
+    """
+    Run the benchmarks, optionally saving or comparing against a baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Hibike wire protocol.")
+    parser.add_argument("-b", "--benchmark", action="append", choices=sorted(BENCHMARKS),
+                        help="benchmark to run (may be repeated; default: all)")
+    parser.add_argument("-s", "--save", metavar="FILE",
+                        help="save results to FILE as a JSON baseline")
+    parser.add_argument("-c", "--compare", metavar="FILE",
+                        help="compare results against the JSON baseline in FILE")
+    parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown that counts as a regression (default: %(default)s)")
+    parser.add_argument("--min-time", type=float, default=MIN_ROUND_TIME,
+                        help="minimum duration of a timing round in seconds")
+    parser.add_argument("--rounds", type=int, default=ROUNDS,
+                        help="number of timing rounds per benchmark")
+    args = parser.parse_args()
+
+    names = args.benchmark or list(BENCHMARKS)
+    results = run_benchmarks(names, args.min_time, args.rounds)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({"environment": environment_info(), "results": results},
+                      baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\nCompared against {} ({})".format(args.compare,
+                                                  baseline["environment"].get("machine")))
+        regressions = compare_results(results, baseline["results"], args.threshold)
+        if regressions:
+            print("\n{} benchmark(s) regressed by more than {:.0%}: {}".format(
+                len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,6 @@ import struct
 import os
 import json
 import threading
-from functools import lru_cache
 
 from cobs import cobs
 
@@ -48,6 +47,63 @@ PARAM_TYPES = {
     "double": "d"
 }
 
+# Dictionary mapping device ids to {param name: bitmask bit}
+PARAM_BITS = {device_id: {name: 1 << param[0] for name, param in params.items()}
+              for device_id, params in PARAM_MAP.items()}
+
+BITMASK_STRUCT = struct.Struct("<H")
+
+# Dictionary mapping device ids to {param name: deadband} for float params
+# with a "deadband" in hibikeDevices.json. Changes smaller than the deadband
+# are not worth reporting upstream.
+DEADBANDS = {device["id"]: {param["name"]: param["deadband"] for param in device["params"]
+                            if "deadband" in param and param["type"] in ("float", "double")}
+             for device in DEVICES.values()}
+
+
+
+class ParamCodec:
+    """
+    A precompiled layout for one set of parameters of a device type.
+
+    ``struct`` packs and unpacks a whole DeviceData/DeviceWrite payload,
+    bitmask included. Bits in the bitmask that don't name a parameter
+    are ignored, which matches how the firmware treats them.
+    """
+    __slots__ = ("device_id", "bitmask", "params", "struct")
+
+    def __init__(self, device_id, bitmask):
+        self.device_id = device_id
+        self.bitmask = bitmask
+        device_params = sorted(DEVICES[device_id]["params"], key=lambda p: p["number"])
+        selected = [param for param in device_params if bitmask & (1 << param["number"])]
+        self.params = tuple(param["name"] for param in selected)
+        self.struct = struct.Struct(
+            "<H" + "".join(PARAM_TYPES[param["type"]] for param in selected))
+
+    def pack(self, values):
+        """
+        Pack a payload from VALUES, a mapping of param name to value.
+        """
+        return self.struct.pack(self.bitmask, *[values[name] for name in self.params])
+
+
+class CodecTable(dict):
+    """
+    Mapping from (device_id, bitmask) to a ``ParamCodec``.
+
+    Codecs are built the first time a combination is seen and kept
+    for the life of the process; in practice only a handful of
+    combinations are ever used per device type.
+    """
+    def __missing__(self, key):
+        codec = ParamCodec(*key)
+        self[key] = codec
+        return codec
+
+
+CODECS = CodecTable()
+
 # Dictionary of message types: message id
 MESSAGE_TYPES = {
     "Ping":                 0x10,
@@ -144,18 +200,27 @@ def checksum(data):
     return chk
 
 
-def send(connection, message):
+def encode_frame(message):
     """
-    Send ``message`` over ``connection``.
-
-    This function accepts regular serial ports or asynchronous transports.
+    Return ``message`` as a frame, ready to be written to a serial port.
     """
     m_buff = message.to_bytes()
     chk = checksum(m_buff)
     m_buff.append(chk)
     encoded = cobs_encode(m_buff)
-    out_buf = bytearray([0x00, len(encoded)]) + encoded
+    return bytearray([0x00, len(encoded)]) + encoded
+
+
+def send(connection, message):
+    """
+    Send ``message`` over ``connection``.
+
+    This function accepts regular serial ports or asynchronous transports.
+    Returns the number of bytes written.
+    """
+    out_buf = encode_frame(message)
     connection.write(out_buf)
+    return len(out_buf)
 
 
 def encode_params(device_id, params):
@@ -168,15 +233,13 @@ def encode_params(device_id, params):
     Returns:
         An int representing the bitmask of a set of parameters.
     """
-    param_nums = [PARAM_MAP[device_id][name][0] for name in params]
-    entries = [1 << num for num in param_nums]
+    param_bits = PARAM_BITS[device_id]
     mask = 0
-    for entry in entries:
-        mask = mask | entry
+    for name in params:
+        mask |= param_bits[name]
     return mask
 
 
-@lru_cache(maxsize=128)
 def decode_params(device_id, params_bitmask):
     """
     Decode PARAMS_BITMASK.
@@ -187,37 +250,36 @@ def decode_params(device_id, params_bitmask):
     Returns:
         A list of names symbolizing the encoded parameters.
     """
-    converted_params = []
-    for param_count in range(16):
-        if (params_bitmask & (1 << param_count)) > 0:
-            converted_params.append(param_count)
-    named_params = []
-    for param in converted_params:
-        if param >= len(DEVICES[device_id]["params"]):
-            break
-        named_params.append(DEVICES[device_id]["params"][param]["name"])
-    return named_params
+    return list(CODECS[device_id, params_bitmask].params)
 
 
-@lru_cache(maxsize=128)
-def format_string_cached(device_id, params):
+def format_string(device_id, params):
     """
     A string representation of the types of PARAMS.
     """
-    param_types = [PARAM_MAP[device_id][name][1] for name in params]
+    param_map = PARAM_MAP[device_id]
+    return ''.join(PARAM_TYPES[param_map[name][1]] for name in params)
 
-    type_string = ''
-    for ptype_key in param_types:
-        type_string += PARAM_TYPES[ptype_key]
-    return type_string
 
+def pack_params(device_id, params_and_values):
+    """
+    Pack PARAMS_AND_VALUES into a DeviceData/DeviceWrite payload.
 
-def format_string(device_id, params):
+    Values are laid out in parameter number order, regardless of
+    the order of PARAMS_AND_VALUES.
+    """
+    values = dict(params_and_values)
+    codec = CODECS[device_id, encode_params(device_id, values)]
+    return bytearray(codec.pack(values))
+
+
+def unpack_params(device_id, payload):
     """
-    Shim for ``format_string``, to ensure all argumets
-    have hashable types.
+    Unpack a DeviceData/DeviceWrite payload into (param, value) tuples.
     """
-    return format_string_cached(device_id, tuple(params))
+    params_bitmask, = BITMASK_STRUCT.unpack_from(payload)
+    codec = CODECS[device_id, params_bitmask]
+    return list(zip(codec.params, codec.struct.unpack(payload)[1:]))
 
 
 def make_ping():
@@ -309,7 +371,6 @@ def make_device_read(device_id, params):
 def make_device_write(device_id, params_and_values):
     """
     Makes and returns DeviceWrite message.
-    If all the params cannot fit, it will fill as many as it can.
 
     Looks up config data about the specified
     device_id to properly construct the message.
@@ -317,15 +378,7 @@ def make_device_write(device_id, params_and_values):
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params_and_values = sorted(
-        params_and_values, key=lambda x: PARAM_MAP[device_id][x[0]][0])
-    params = [param[0] for param in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param[1] for param in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
+    payload = pack_params(device_id, params_and_values)
     message = HibikeMessage(MESSAGE_TYPES["DeviceWrite"], payload)
     return message
 
@@ -334,22 +387,13 @@ def make_device_data(device_id, params_and_values):
     """
     Makes and returns DeviceData message.
 
-    If all the params cannot fit, it will fill as many as it can.
     Looks up config data about the specified
     device_id to properly construct the message.
     Parameters:
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params = [param_tuple[0] for param_tuple in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param_tuple[1] for param_tuple in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
-
+    payload = pack_params(device_id, params_and_values)
     message = HibikeMessage(MESSAGE_TYPES["DeviceData"], payload)
     return message
 
@@ -375,6 +419,16 @@ def parse_subscription_response(msg):
     return (params, delay, uid)
 
 
+def parse_heartbeat(msg):
+    """
+    Return the id of a HeartBeatRequest or HeartBeatResponse, MSG.
+    """
+    assert msg.get_message_id() in (MESSAGE_TYPES["HeartBeatRequest"],
+                                    MESSAGE_TYPES["HeartBeatResponse"])
+    payload = msg.get_payload()
+    return payload[0] if payload else 0
+
+
 def decode_device_write(msg, device_id):
     """
     Decode a DeviceWrite packet, MSG, into its constituent parts.
@@ -382,11 +436,7 @@ def decode_device_write(msg, device_id):
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceWrite"]
     payload = msg.get_payload()
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    return unpack_params(device_id, payload)
 
 
 def parse_device_data(msg, device_id):
@@ -396,11 +446,7 @@ def parse_device_data(msg, device_id):
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceData"]
     payload = msg.get_payload()
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    return unpack_params(device_id, payload)
 
 
 def parse_bytes(msg_bytes):
@@ -412,98 +458,160 @@ def parse_bytes(msg_bytes):
     cobs_frame, message_size = msg_bytes[:2]
     if cobs_frame != 0 or len(msg_bytes) < message_size + 2:
         return None
-    message = cobs_decode(msg_bytes[2:message_size + 2])
+    return parse_frame(msg_bytes[2:message_size + 2])
+
+
+def parse_frame(encoded):
+    """
+    Parse the COBS-encoded body of a frame (everything after the zero
+    byte and the length byte) into a HibikeMessage, or None if it is invalid.
+    """
+    return check_frame(encoded)[0]
+
+
+# Reasons a frame can be rejected, counted by ``PacketDeframer.errors``
+FRAME_ERRORS = ("cobs", "length", "checksum", "truncated")
+
+
+def check_frame(encoded):
+    """
+    Like ``parse_frame``, but also say why an invalid frame was rejected.
+
+    Returns:
+        ``(message, None)`` for a valid frame, or ``(None, reason)``
+        where reason is one of ``FRAME_ERRORS``.
+    """
+    message = cobs_decode(encoded)
 
     if len(message) < 2:
-        return None
+        return None, "cobs"
     message_id, payload_length = message[0], message[1]
     if len(message) < 2 + payload_length + 1:
-        return None
+        return None, "length"
     payload = message[2:2 + payload_length]
     chk = message[2 + payload_length]
     if chk != checksum(message[:-1]):
-        return None
-    return HibikeMessage(message_id, payload)
+        return None, "checksum"
+    return HibikeMessage(message_id, payload), None
+
+
+class PacketDeframer:
+    """
+    Split a stream of bytes into Hibike packets.
+
+    Bytes are appended with ``feed`` and complete packets are pulled out
+    with ``packets``. Instead of re-slicing the buffer after every packet,
+    a read cursor is advanced and consumed bytes are only discarded once
+    enough of them have piled up.
+
+    The number of frames skipped for each reason in ``FRAME_ERRORS`` is
+    kept in ``errors``.
+    """
+    PACKET_BOUNDARY = 0
+    # Consumed bytes to allow at the front of the buffer before compacting it
+    COMPACT_THRESHOLD = 512
+
+    __slots__ = ("_buf", "_pos", "errors")
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self.errors = dict.fromkeys(FRAME_ERRORS, 0)
+
+    def feed(self, data):
+        """
+        Append DATA to the buffer.
+        """
+        if self._pos >= self.COMPACT_THRESHOLD or self._pos == len(self._buf):
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf.extend(data)
+
+    def packets(self):
+        """
+        Yield every complete packet currently in the buffer.
+
+        Invalid frames are skipped. An incomplete frame at the end of
+        the buffer is kept until more bytes arrive.
+        """
+        buf = self._buf
+        while True:
+            start = buf.find(self.PACKET_BOUNDARY, self._pos)
+            if start == -1:
+                self._pos = len(buf)
+                return
+            self._pos = start
+            if start + 2 > len(buf):
+                return
+            end = start + 2 + buf[start + 1]
+            if end > len(buf):
+                # COBS data never contains a zero, so another zero means
+                # this frame was cut short and a new one has started.
+                next_start = buf.find(self.PACKET_BOUNDARY, start + 2)
+                if next_start == -1:
+                    return
+                self.errors["truncated"] += 1
+                self._pos = next_start
+                continue
+            next_start = buf.find(self.PACKET_BOUNDARY, start + 2, end)
+            if next_start != -1:
+                self.errors["truncated"] += 1
+                self._pos = next_start
+                continue
+            packet, error = check_frame(buf[start + 2:end])
+            if packet is None:
+                self.errors[error] += 1
+                self._pos = start + 1
+                continue
+            self._pos = end
+            yield packet
+
+    @property
+    def bytes_needed(self):
+        """
+        The number of bytes still missing from a partially received
+        frame at the end of the buffer, or 0 if there is none.
+        """
+        buf, pos = self._buf, self._pos
+        if pos >= len(buf) or buf[pos] != self.PACKET_BOUNDARY:
+            return 0
+        if pos + 2 > len(buf):
+            return 1
+        return max(pos + 2 + buf[pos + 1] - len(buf), 0)
 
 
 def blocking_read_generator(serial_conn, stop_event=threading.Event()):
     """
     Yield packets from SERIAL_CONN, stopping if STOP_EVENT is set.
     """
-    zero_byte = bytes([0])
-    packets_buffer = bytearray()
+    deframer = PacketDeframer()
     # Switch to nonblocking mode so that we don't get stuck reading
     old_timeout = serial_conn.timeout
     serial_conn.timeout = 0
     while not stop_event.is_set():
-        # Wait for a 0 byte to appear
-        if packets_buffer.find(zero_byte) == -1:
-            new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-            packets_buffer.extend(new_bytes)
-            continue
-
-        # Truncate incomplete packets at start of buffer
-        packets_buffer = packets_buffer[packets_buffer.find(zero_byte):]
-
-        # Attempt to parse a packet
-        packet = parse_bytes(packets_buffer)
-
-        if packet != None:
-            # Chop off a byte so we don't output this packet again
-            packets_buffer = packets_buffer[1:]
+        deframer.feed(serial_conn.read(max(1, serial_conn.inWaiting())))
+        for packet in deframer.packets():
+            if stop_event.is_set():
+                break
             yield packet
-        else:
-            # If there's another packet in the buffer
-            # we can safely jump to it for the next iteration
-            if packets_buffer.count(zero_byte) > 1:
-                new_packet = packets_buffer[1:].find(zero_byte) + 1
-                packets_buffer = packets_buffer[new_packet:]
-            # Otherwise, there might be more incoming bytes for the current packet,
-            # so we do a read and try again
-            else:
-                new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-                packets_buffer.extend(new_bytes)
 
     serial_conn.timeout = old_timeout
 
 
-
 def blocking_read(serial_conn):
     """
     Read a list of packets from SERIAL_CONN, blocking until a complete packet is received.
     """
-    zero_byte = bytes([0])
-    packets = bytearray()
-    while packets.find(zero_byte) == -1:
-        packets.extend(serial_conn.read(max(1, serial_conn.inWaiting())))
-
-    # Truncate incomplete packets at start of buffer
-    packets = packets[packets.find(zero_byte):]
-
-    # Read until we have no incomplete packets
-    last_zero = packets.rfind(zero_byte)
-    if last_zero == len(packets) - 1:
-        packets.extend(serial_conn.read(size=1))
-    last_message_size = packets[last_zero + 1]
-
-    # -2 because payload length and zero byte are not counted
-    received_payload = len(packets) - last_zero - 2
-
-    # We don't need to account for the checksum because it is part of the payload
-    packets.extend(serial_conn.read(last_message_size - received_payload))
-
+    deframer = PacketDeframer()
     packet_list = []
-    while packets:
-        next_packet = packets[1:].find(zero_byte)
-        if next_packet == -1:
-            next_packet = len(packets)
-        else:
-            # because we searched in packets[1:] instead of packets
-            next_packet += 1
-        packet = parse_bytes(packets)
-        if packet != None:
-            packet_list.append(packet)
-        packets = packets[next_packet:]
+    while not packet_list:
+        deframer.feed(serial_conn.read(max(1, serial_conn.inWaiting())))
+        packet_list.extend(deframer.packets())
+
+    # Finish reading a packet that was cut off by the last read
+    while deframer.bytes_needed:
+        deframer.feed(serial_conn.read(deframer.bytes_needed))
+        packet_list.extend(deframer.packets())
 
     return packet_list
 
@@ -10,10 +10,13 @@ import time
 
 import serial_asyncio
 import aioprocessing
-import aiofiles
 
 
 import hibike_message as hm
+from device_watcher import CachedFile, make_device_watcher
+from link_stats import HeartbeatMonitor, LinkStats
+from serial_capture import CaptureFile
+from transports import port_name
 try:
     import hibike_packet
     USING_PACKET_EXTENSION = True
@@ -24,53 +27,74 @@ __all__ = ["hibike_process"]
 
 # .04 milliseconds sleep is the same frequency we subscribe to devices at
 BATCH_SLEEP_TIME = .04
-# Time in seconds to wait until reading from a potential sensor
+# Whether to only send sensor values that changed since the previous batch
+USE_DELTA_BATCHING = True
+# Send every value, changed or not, once every this many batches
+KEYFRAME_INTERVAL = 25
+# Maximum time in seconds to wait for a potential sensor to identify itself
 IDENTIFY_TIMEOUT = 1
+# Time in seconds to wait for a reply to the first identifying ping;
+# each retry waits IDENTIFY_BACKOFF times longer than the previous one
+IDENTIFY_RETRY_DELAY = 0.05
+IDENTIFY_BACKOFF = 2
 # Time in seconds to wait between checking for new devices
-# and cleaning up old ones.
+# and cleaning up old ones. If inotify is available, we also
+# check as soon as a serial port appears or disappears.
 HOTPLUG_POLL_INTERVAL = 1
-# Whether to use profiling or not. On the BBB, profiling adds a significant overhead (~30%).
-USE_PROFILING = False
-# Where to output profiling statistics. By default, this is in Callgrind format
-PROFILING_OUTPUT_FILE = "func_stats"
-# The time period to take measurements over, in seconds
-PROFILING_PERIOD = 60
+# Directories and file name patterns of serial ports that might be smart sensors
+# The last pattern is included so that it's compatible with OS X Sierra
+SERIAL_PORT_PATTERNS = {"/dev": ["ttyACM*", "ttyUSB*", "tty.usbmodem*"]}
+# Extra serial ports to try, separated by whitespace (see spawn_virtual_devices.py)
+VIRTUAL_DEVICE_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          "virtual_devices.txt")
 PAUSE_QUEUE_SIZE = 10
 RESUME_QUEUE_SIZE = 2
+# If set, every frame sent and received is appended to this file (see serial_capture.py)
+CAPTURE_FILE = os.environ.get("HIBIKE_CAPTURE_FILE")
+# Time in seconds between flushes of the capture file
+CAPTURE_FLUSH_INTERVAL = 1
+# Time in seconds between sending link statistics to StateManager
+STATS_EXPORT_INTERVAL = 5
+# Time in seconds between heartbeat requests sent to each device
+HEARTBEAT_INTERVAL = 0.25
+# Time in seconds after which an unanswered heartbeat request counts as missed
+HEARTBEAT_TIMEOUT = 0.5
+# Number of heartbeats in a row a device may miss before it is considered dead
+HEARTBEAT_MAX_MISSED = 4
 
 def scan_for_serial_ports():
     """
     Scan for serial ports that look like an Arduino.
     """
-    # Last command is included so that it's compatible with OS X Sierra
     # Note: If you are running OS X Sierra, do not access the directory through vagrant ssh
     # Instead access it through Volumes/vagrant/PieCentral
-    return set(glob.glob("/dev/ttyACM*") +\
-               glob.glob("/dev/ttyUSB*") +\
-               glob.glob("/dev/tty.usbmodem*"))
+    ports = set()
+    for directory, patterns in SERIAL_PORT_PATTERNS.items():
+        for pattern in patterns:
+            ports.update(glob.glob(os.path.join(directory, pattern)))
+    return ports
 
 
-async def get_working_serial_ports(event_loop, excludes=()):
+async def get_working_serial_ports(event_loop, excludes=(), virtual_devices=None):
     """
     Scan for open COM ports, except those in `excludes`.
 
+    :param virtual_devices: A `CachedFile` listing extra ports to try
     Returns:
         A list of port names.
     """
     excludes = set(excludes)
     ports = await event_loop.run_in_executor(None, scan_for_serial_ports)
-    try:
-        virtual_device_config_file = os.path.join(os.path.dirname(__file__), "virtual_devices.txt")
-        async with aiofiles.open(virtual_device_config_file, loop=event_loop) as f:
-            contents = await f.read()
-            ports.update(contents.split())
-    except IOError:
-        pass
+    if virtual_devices is None:
+        virtual_devices = CachedFile(VIRTUAL_DEVICE_CONFIG_FILE)
+    ports.update(virtual_devices.read().split())
     ports.difference_update(excludes)
     return list(ports)
 
 
-async def hotplug_async(devices, batched_data, error_queue, state_queue, event_loop):
+# pylint: disable=too-many-arguments, too-many-locals
+async def hotplug_async(devices, batched_data, error_queue, state_queue, event_loop,
+                        sensor_table=None, capture_file=None, last_sent=None):
     """
     Scan for new devices on serial ports and automatically spin them up.
     """
@@ -80,22 +104,33 @@ async def hotplug_async(devices, batched_data, error_queue, state_queue, event_l
         Create a `SmartSensorProtocol` with necessary parameters filled in.
         """
         return SmartSensorProtocol(devices, batched_data, error_queue,
-                                   state_queue, event_loop, pending)
-
-    while True:
-        await asyncio.sleep(HOTPLUG_POLL_INTERVAL, loop=event_loop)
-        port_names = set([dev.transport.serial.name for dev in devices.values()\
-                          if dev.transport is not None and dev.transport.serial is not None])
-        port_names.update(pending)
-        new_serials = await get_working_serial_ports(event_loop, port_names)
-        for port in new_serials:
-            try:
-                pending.add(port)
-                await serial_asyncio.create_serial_connection(event_loop, protocol_factory, port,
-                                                              baudrate=115200)
-            except serial_asyncio.serial.SerialException:
-                pass
-        await remove_disconnected_devices(error_queue, devices, state_queue, event_loop)
+                                   state_queue, event_loop, pending, sensor_table,
+                                   capture_file, last_sent)
+
+    virtual_devices = CachedFile(VIRTUAL_DEVICE_CONFIG_FILE)
+    watches = {directory: list(patterns) for directory, patterns in SERIAL_PORT_PATTERNS.items()}
+    watches.setdefault(os.path.dirname(VIRTUAL_DEVICE_CONFIG_FILE), []).append(
+        os.path.basename(VIRTUAL_DEVICE_CONFIG_FILE))
+    watcher = make_device_watcher(event_loop, watches, HOTPLUG_POLL_INTERVAL)
+    try:
+        while True:
+            await watcher.wait()
+            port_names = set(port_name(dev.transport) for dev in devices.values()
+                             if dev.transport is not None)
+            port_names.discard(None)
+            port_names.update(pending)
+            new_serials = await get_working_serial_ports(event_loop, port_names, virtual_devices)
+            for port in new_serials:
+                try:
+                    pending.add(port)
+                    await serial_asyncio.create_serial_connection(event_loop, protocol_factory,
+                                                                  port, baudrate=115200)
+                except serial_asyncio.serial.SerialException:
+                    # Most likely the port isn't ready yet; try again next time
+                    pending.discard(port)
+            await remove_disconnected_devices(error_queue, devices, state_queue, event_loop)
+    finally:
+        watcher.close()
 
 
 class SmartSensorProtocol(asyncio.Protocol):
@@ -109,115 +144,256 @@ class SmartSensorProtocol(asyncio.Protocol):
     :param event_loop: The event loop
     :param set pending: Set of serial connections that may or may not
     have devices on them.
+    :param sensor_table: The shared `SensorTable` to write values into, if any
+    :param capture_file: The `CaptureFile` to record traffic in, if any
+    :param dict last_sent: The values `batch_data` last sent, which are
+    forgotten whenever the sensor is subscribed again
     """
-    PACKET_BOUNDARY = bytes([0])
-    __slots__ = ("uid", "write_queue", "batched_data", "read_queue", "error_queue",
-                 "state_queue", "instance_id", "transport", "_ready", "serial_buf")
+    __slots__ = ("uid", "write_queue", "batched_data", "last_sent", "read_queue", "error_queue",
+                 "state_queue", "instance_id", "transport", "_ready", "_identified",
+                 "serial_buf", "sensor_table", "write_stats", "link_stats", "heartbeats",
+                 "capture_file", "capture", "identify_stats", "event_loop", "_writable",
+                 "tasks")
     # pylint: disable=too-many-arguments
-    def __init__(self, devices, batched_data, error_queue, state_queue, event_loop, pending: set):
+    def __init__(self, devices, batched_data, error_queue, state_queue, event_loop, pending: set,
+                 sensor_table=None, capture_file=None, last_sent=None):
         # We haven't found out what our UID is yet
         self.uid = None
 
         self.write_queue = asyncio.Queue(loop=event_loop)
         self.batched_data = batched_data
+        self.last_sent = {} if last_sent is None else last_sent
         self.read_queue = asyncio.Queue(loop=event_loop)
         self.error_queue = error_queue
         self.state_queue = state_queue
+        self.sensor_table = sensor_table
+        # Writes folded into a later write, and param values overwritten before being sent
+        self.write_stats = {"merged": 0, "stale": 0}
+        self.link_stats = LinkStats()
+        # How identification went: the port, time to get the UID in seconds, and pings retried
+        self.identify_stats = None
+        self.heartbeats = HeartbeatMonitor(HEARTBEAT_TIMEOUT, HEARTBEAT_MAX_MISSED)
         self.instance_id = random.getrandbits(128)
+        self.capture_file = capture_file
+        self.capture = None
 
         self.transport = None
+        self.event_loop = event_loop
+        # Cleared while the transport is still sending earlier messages
+        self._writable = asyncio.Event(loop=event_loop)
+        self._writable.set()
         self._ready = asyncio.Event(loop=event_loop)
+        self._identified = asyncio.Event(loop=event_loop)
         if USING_PACKET_EXTENSION:
             # pylint: disable=no-member
             self.serial_buf = hibike_packet.RingBuffer()
         else:
-            self.serial_buf = bytearray()
+            self.serial_buf = hm.PacketDeframer()
 
-        event_loop.create_task(self.register_sensor(event_loop, devices, pending))
-        event_loop.create_task(self.send_messages())
-        event_loop.create_task(self.recv_messages())
+        # Tasks serving this sensor, cancelled by `stop`
+        self.tasks = [event_loop.create_task(self.register_sensor(event_loop, devices, pending)),
+                      event_loop.create_task(self.send_messages()),
+                      event_loop.create_task(self.recv_messages())]
 
     async def register_sensor(self, event_loop, devices, pending):
         """
         Try to get our UID from the sensor and register it with `hibike_process`.
+
+        Pings are retried with exponential backoff until the sensor answers
+        or `IDENTIFY_TIMEOUT` runs out.
         """
         await self._ready.wait()
-        hm.send(self.transport, hm.make_ping())
-        await asyncio.sleep(IDENTIFY_TIMEOUT, loop=event_loop)
+        port = port_name(self.transport)
+        start = event_loop.time()
+        deadline = start + IDENTIFY_TIMEOUT
+        retry_delay = IDENTIFY_RETRY_DELAY
+        retries = 0
+        while True:
+            self.send(hm.make_ping())
+            try:
+                await asyncio.wait_for(self._identified.wait(),
+                                       min(retry_delay, deadline - event_loop.time()),
+                                       loop=event_loop)
+                break
+            except asyncio.TimeoutError:
+                if event_loop.time() >= deadline:
+                    break
+                retries += 1
+                retry_delay *= IDENTIFY_BACKOFF
+        self.identify_stats = {
+            "port": port,
+            "time_to_uid": event_loop.time() - start if self.uid is not None else None,
+            "retries": retries,
+        }
         if self.uid is None:
             self.quit()
         else:
-            hm.send(self.transport, hm.make_ping())
-            hm.send(self.transport,
-                    hm.make_subscription_request(hm.uid_to_device_id(self.uid), [], 0))
+            self.send(hm.make_ping())
+            self.send(hm.make_subscription_request(hm.uid_to_device_id(self.uid), [], 0))
             devices[self.uid] = self
-        pending.remove(self.transport.serial.name)
+            self.tasks.append(event_loop.create_task(self.send_heartbeats(event_loop)))
+        pending.remove(port)
+
+    async def send_heartbeats(self, event_loop):
+        """
+        Send heartbeat requests to the sensor, and close the connection if
+        it stops answering them even though the serial port is still open.
+        """
+        while not self.transport.is_closing():
+            self.send(hm.make_heartbeat_request(self.heartbeats.request()))
+            await asyncio.sleep(HEARTBEAT_INTERVAL, loop=event_loop)
+            self.heartbeats.expire()
+            if self.heartbeats.dead:
+                print("Device {} missed {} heartbeats; disconnecting".format(
+                    self.uid, self.heartbeats.consecutive_missed))
+                self.quit()
 
     async def send_messages(self):
         """
         Send messages in the queue to the sensor.
+
+        Nothing is sent while the transport still has earlier messages to
+        send. Everything that is queued once it can take more is sent
+        together, with back-to-back writes merged by `coalesce_writes`.
         """
         await self._ready.wait()
         while not self.transport.is_closing():
-            instruction, args = await self.write_queue.get()
-            if instruction == "ping":
-                hm.send(self.transport, hm.make_ping())
-            elif instruction == "subscribe":
-                uid, delay, params = args
-                hm.send(self.transport,
-                        hm.make_subscription_request(hm.uid_to_device_id(uid),
-                                                     params, delay))
-            elif instruction == "read":
-                uid, params = args
-                hm.send(self.transport, hm.make_device_read(hm.uid_to_device_id(uid), params))
-            elif instruction == "write":
-                uid, params_and_values = args
-                hm.send(self.transport, hm.make_device_write(hm.uid_to_device_id(uid),
-                                                             params_and_values))
-            elif instruction == "disable":
-                hm.send(self.transport, hm.make_disable())
-            elif instruction == "heartResp":
-                uid = args[0]
-                hm.send(self.transport, hm.make_heartbeat_response(self.read_queue.qsize()))
+            instructions = [await self.write_queue.get()]
+            await self._writable.wait()
+            while not self.write_queue.empty():
+                instructions.append(self.write_queue.get_nowait())
+            if len(instructions) > 1:
+                instructions, merged, stale = coalesce_writes(instructions)
+                self.write_stats["merged"] += merged
+                self.write_stats["stale"] += stale
+            for instruction, args in instructions:
+                self.send_instruction(instruction, args)
+
+    def send(self, message):
+        """
+        Send a single message to the sensor.
+        """
+        frame = hm.encode_frame(message)
+        self.transport.write(frame)
+        self.link_stats.bytes_out += len(frame)
+        if self.capture is not None:
+            self.capture.sent(frame)
+
+    def send_instruction(self, instruction, args):
+        """
+        Send the message for a single instruction from the queue.
+        """
+        if instruction == "ping":
+            self.send(hm.make_ping())
+        elif instruction == "subscribe":
+            uid, delay, params = args
+            self.send(hm.make_subscription_request(hm.uid_to_device_id(uid), params, delay))
+        elif instruction == "read":
+            uid, params = args
+            self.send(hm.make_device_read(hm.uid_to_device_id(uid), params))
+        elif instruction == "write":
+            uid, params_and_values = args
+            self.send(hm.make_device_write(hm.uid_to_device_id(uid), params_and_values))
+        elif instruction == "disable":
+            self.send(hm.make_disable())
+        elif instruction == "heartResp":
+            self.send(hm.make_heartbeat_response(self.read_queue.qsize()))
 
     async def recv_messages(self):
         """
         Process received messages.
         """
         await self._ready.wait()
+        paused = False
         while not self.transport.is_closing():
             if self.read_queue.qsize() >= PAUSE_QUEUE_SIZE:
                 self.transport.pause_reading()
+                if not paused:
+                    self.link_stats.pauses += 1
+                    paused = True
             if self.read_queue.qsize() <= RESUME_QUEUE_SIZE:
                 self.transport.resume_reading()
+                if paused:
+                    self.link_stats.resumes += 1
+                    paused = False
             packet = await self.read_queue.get()
             message_type = packet.get_message_id()
+            self.link_stats.record_packet(message_type, self.read_queue.qsize() + 1)
             if message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
                 params, delay, uid = hm.parse_subscription_response(packet)
                 self.uid = uid
+                self._identified.set()
+                if self.capture is not None:
+                    self.capture.identified(uid)
                 await self.state_queue.coro_put(("device_subscribed", [uid, delay, params]))
+                # StateManager resets the device's params when it is subscribed,
+                # so every value must be sent again
+                self.forget_values()
             elif message_type == hm.MESSAGE_TYPES["DeviceData"]:
                 # This is kind of a hack, but it allows us to use `recv_messages` for
                 # detecting new smart sensors as well as reading from known ones.
                 if self.uid is not None:
                     params_and_values = hm.parse_device_data(packet, hm.uid_to_device_id(self.uid))
-                    self.batched_data[uid] = params_and_values
+                    self.batched_data[self.uid] = params_and_values
+                    if self.sensor_table is not None:
+                        self.sensor_table.write(self.uid, params_and_values)
             elif message_type == hm.MESSAGE_TYPES["HeartBeatRequest"]:
                 if self.uid is not None:
                     self.write_queue.put_nowait(("heartResp", [self.uid]))
+            elif message_type == hm.MESSAGE_TYPES["HeartBeatResponse"]:
+                self.heartbeats.response(hm.parse_heartbeat(packet))
 
     def connection_made(self, transport):
         self.transport = transport
+        # Pause writing whenever anything is left in the write buffer
+        transport.set_write_buffer_limits(high=0)
+        if self.capture_file is not None:
+            self.capture = self.capture_file.channel(port_name(transport))
         self._ready.set()
 
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def forget_values(self):
+        """
+        Forget the sensor's latest values and those `batch_data` last sent.
+        """
+        self.batched_data.pop(self.uid, None)
+        self.last_sent.pop(self.uid, None)
+
     def quit(self):
         """
         Stop processing packets and close the serial connection.
         """
         self.transport.abort()
 
+    async def stop(self):
+        """
+        Quit, and wait for the tasks serving the sensor to finish.
+        """
+        self.quit()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, loop=self.event_loop, return_exceptions=True)
+
+    def stats(self):
+        """
+        Summarize the state of the link to the sensor.
+        """
+        return self.link_stats.snapshot(self.read_queue.qsize(),
+                                        getattr(self.serial_buf, "errors", None),
+                                        writes=dict(self.write_stats),
+                                        heartbeat=self.heartbeats.snapshot(),
+                                        identify=self.identify_stats)
+
     if USING_PACKET_EXTENSION:
         def data_received(self, data):
+            self.link_stats.bytes_in += len(data)
+            if self.capture is not None:
+                self.capture.received(data)
             self.serial_buf.extend(data)
             # pylint: disable=no-member
             maybe_packet = hibike_packet.process_buffer(self.serial_buf)
@@ -227,27 +403,60 @@ class SmartSensorProtocol(asyncio.Protocol):
                 self.read_queue.put_nowait(message)
     else:
         def data_received(self, data):
-            self.serial_buf.extend(data)
-            zero_loc = self.serial_buf.find(self.PACKET_BOUNDARY)
-            if zero_loc != -1:
-                self.serial_buf = self.serial_buf[zero_loc:]
-                packet = hm.parse_bytes(self.serial_buf)
-                if packet != None:
-                    # Chop off a byte so we don't output this packet again
-                    self.serial_buf = self.serial_buf[1:]
-                    self.read_queue.put_nowait(packet)
-                elif self.serial_buf.count(self.PACKET_BOUNDARY) > 1:
-                    # If there's another packet in the buffer
-                    # we can safely jump to it for the next iteration
-                    new_packet = self.serial_buf[1:].find(self.PACKET_BOUNDARY) + 1
-                    self.serial_buf = self.serial_buf[new_packet:]
+            self.link_stats.bytes_in += len(data)
+            if self.capture is not None:
+                self.capture.received(data)
+            self.serial_buf.feed(data)
+            for packet in self.serial_buf.packets():
+                self.read_queue.put_nowait(packet)
 
     def connection_lost(self, exc):
+        # Let send_messages see that the transport is closing
+        self._writable.set()
         if self.uid is not None:
-            error = Disconnect(uid=self.uid, instance_id=self.instance_id, accessed=False)
+            # A device that stopped answering heartbeats is known to be gone,
+            # so there is no need to wait another cycle to confirm it
+            error = Disconnect(uid=self.uid, instance_id=self.instance_id,
+                               accessed=self.heartbeats.dead)
             self.error_queue.put_nowait(error)
 
 
+def coalesce_writes(instructions):
+    """
+    Merge each run of consecutive "write" instructions into a single write
+    per UID carrying every param written in the run, with its newest value.
+
+    Other instructions are left in place, so a write is never moved past
+    a "disable" or "subscribe".
+
+    :param list instructions: (instruction, args) pairs, oldest first
+    :returns: A tuple of the merged instructions, the number of writes that
+    were folded into an earlier one, and the number of stale param values dropped
+    """
+    coalesced = []
+    merged = stale = 0
+    # {uid: {param: value}} for the current run of writes, in arrival order
+    pending = {}
+    for instruction, args in instructions:
+        if instruction == "write":
+            uid, params_and_values = args
+            if uid in pending:
+                merged += 1
+            values = pending.setdefault(uid, {})
+            for param, value in params_and_values:
+                if param in values:
+                    stale += 1
+                values[param] = value
+            continue
+        for uid, values in pending.items():
+            coalesced.append(("write", (uid, list(values.items()))))
+        pending = {}
+        coalesced.append((instruction, args))
+    for uid, values in pending.items():
+        coalesced.append(("write", (uid, list(values.items()))))
+    return coalesced, merged, stale
+
+
 class Disconnect:
     """
     Information about a device disconnect.
@@ -276,6 +485,7 @@ async def remove_disconnected_devices(error_queue, devices, state_queue, event_l
                 # The device has reconnected in the meantime
                 continue
             uid = error.uid
+            pack.forget_values()
             del devices[uid]
             await state_queue.coro_put(("device_disconnected", [uid]), loop=event_loop)
         except asyncio.QueueEmpty:
@@ -284,30 +494,94 @@ async def remove_disconnected_devices(error_queue, devices, state_queue, event_l
             return
 
 
-async def batch_data(sensor_values, state_queue, event_loop):
+async def batch_data(sensor_values, state_queue, event_loop, last_sent=None):
     """
     Periodically send sensor values to `StateManager`.
+
+    With `USE_DELTA_BATCHING`, only values that changed since they were
+    last sent go out, except for a full keyframe every `KEYFRAME_INTERVAL`
+    batches so that StateManager can recover from anything it missed.
+    What was sent is kept in LAST_SENT, shared with the devices'
+    `SmartSensorProtocol`, which forget a device's entry when it is
+    subscribed again or disconnects.
     """
+    if last_sent is None:
+        last_sent = {}
+    batch_count = 0
     while True:
         await asyncio.sleep(BATCH_SLEEP_TIME, loop=event_loop)
-        await state_queue.coro_put(("device_values", [sensor_values]), loop=event_loop)
+        if not USE_DELTA_BATCHING or batch_count % KEYFRAME_INTERVAL == 0:
+            batch = dict(sensor_values)
+            last_sent.clear()
+            last_sent.update((uid, dict(params_and_values))
+                             for uid, params_and_values in batch.items())
+        else:
+            batch = changed_values(sensor_values, last_sent)
+        batch_count += 1
+        if batch:
+            await state_queue.coro_put(("device_values", [batch]), loop=event_loop)
 
 
-async def print_profiler_stats(event_loop, time_delay):
+def changed_values(sensor_values, last_sent):
     """
-    Print profiler statistics after a number of seconds.
+    Find the values in `sensor_values` that differ from those in `last_sent`.
+
+    Float params with a deadband in hibikeDevices.json only count as changed
+    once they move by at least the deadband. `last_sent` is updated with the
+    values that are returned.
+
+    :param dict sensor_values: Mapping from UIDs to lists of (param, value)
+    :param dict last_sent: Mapping from UIDs to {param: value} as last sent
+    :returns: A mapping from UIDs to lists of changed (param, value)
     """
-    try:
-        import yappi
-    except ImportError:
-        return
-    await asyncio.sleep(time_delay, loop=event_loop)
-    print("Printing profiler stats")
-    yappi.get_func_stats().print_all(out=sys.stdout,
-                                     columns={0: ("name", 60), 1: ("ncall", 5), 2: ("tsub", 8),
-                                              3: ("ttot", 8), 4: ("tavg", 8)})
-    yappi.get_func_stats().save(PROFILING_OUTPUT_FILE, type="callgrind")
-    yappi.get_thread_stats().print_all()
+    changes = {}
+    for uid, params_and_values in sensor_values.items():
+        sent = last_sent.setdefault(uid, {})
+        deadbands = hm.DEADBANDS[hm.uid_to_device_id(uid)]
+        changed = []
+        for param, value in params_and_values:
+            if param in sent:
+                deadband = deadbands.get(param)
+                if deadband is None:
+                    if value == sent[param]:
+                        continue
+                elif abs(value - sent[param]) < deadband:
+                    continue
+            sent[param] = value
+            changed.append((param, value))
+        if changed:
+            changes[uid] = changed
+    return changes
+
+
+def device_stats(devices):
+    """
+    Collect link statistics for every device.
+
+    Returns:
+        A mapping from UIDs to the devices' `SmartSensorProtocol.stats`.
+    """
+    return {uid: dev.stats() for uid, dev in devices.items()}
+
+
+async def export_stats(devices, state_queue, event_loop):
+    """
+    Periodically send link statistics to `StateManager`.
+    """
+    while True:
+        await asyncio.sleep(STATS_EXPORT_INTERVAL, loop=event_loop)
+        if devices:
+            await state_queue.coro_put(("device_stats", [device_stats(devices)]),
+                                       loop=event_loop)
+
+
+async def flush_capture(capture_file, event_loop):
+    """
+    Flush the capture file regularly, so a crash loses little of it.
+    """
+    while True:
+        await asyncio.sleep(CAPTURE_FLUSH_INTERVAL, loop=event_loop)
+        capture_file.flush()
 
 
 class QueueContext:
@@ -322,6 +596,30 @@ class QueueContext:
         return self._queue
 
 
+def add_runtime_to_path():
+    """
+    Make runtime modules importable.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    parent_path = path.rstrip("hibike")
+    runtime = os.path.join(parent_path, "runtime")
+    if runtime not in sys.path:
+        sys.path.insert(1, runtime)
+
+
+def attach_sensor_table():
+    """
+    Attach to runtime's shared sensor table, or return None if there isn't one.
+    """
+    add_runtime_to_path()
+    try:
+        # pylint: disable=import-error
+        from sensortable import SensorTable
+    except ImportError:
+        return None
+    return SensorTable.attach()
+
+
 def hibike_process(bad_things_queue, state_queue, pipe_from_child):
     """
     Run the main hibike processs.
@@ -334,23 +632,23 @@ def hibike_process(bad_things_queue, state_queue, pipe_from_child):
 
     devices = {}
     batched_data = {}
+    last_sent = {}
     event_loop = asyncio.get_event_loop()
     error_queue = asyncio.Queue(loop=event_loop)
-
-    event_loop.create_task(batch_data(batched_data, state_queue, event_loop))
+    sensor_table = attach_sensor_table()
+    capture_file = None
+    if CAPTURE_FILE:
+        capture_file = CaptureFile(CAPTURE_FILE)
+        event_loop.create_task(flush_capture(capture_file, event_loop))
+
+    event_loop.create_task(batch_data(batched_data, state_queue, event_loop, last_sent))
+    event_loop.create_task(export_stats(devices, state_queue, event_loop))
     event_loop.create_task(hotplug_async(devices, batched_data, error_queue,
-                                         state_queue, event_loop))
+                                         state_queue, event_loop, sensor_table,
+                                         capture_file, last_sent))
     event_loop.create_task(dispatch_instructions(devices, bad_things_queue, state_queue,
                                                  pipe_from_child, event_loop))
     # start event loop
-    if USE_PROFILING:
-        try:
-            import yappi
-            yappi.start()
-            event_loop.create_task(print_profiler_stats(event_loop, PROFILING_PERIOD))
-        except ImportError:
-            print("Unable to import profiler. Make sure you installed with the '--dev' flag.")
-
     event_loop.run_forever()
 
 
@@ -359,14 +657,12 @@ async def dispatch_instructions(devices, bad_things_queue, state_queue,
     """
     Respond to instructions from `StateManager`.
     """
-    path = os.path.dirname(os.path.abspath(__file__))
-    parent_path = path.rstrip("hibike")
-    runtime = os.path.join(parent_path, "runtime")
-    sys.path.insert(1, runtime)
+    add_runtime_to_path()
     # Pylint doesn't understand our import shenanigans
     # pylint: disable=import-error
     import runtimeUtil
 
+    runtimeUtil.process_ready(state_queue)
     while True:
         instruction, args = await pipe_from_child.coro_recv(loop=event_loop)
         try:
@@ -389,6 +685,9 @@ async def dispatch_instructions(devices, bad_things_queue, state_queue,
                 timestamp = time.time()
                 args.append(timestamp)
                 await state_queue.coro_put(("timestamp_up", args), loop=event_loop)
+            elif instruction == "stats":
+                await state_queue.coro_put(("device_stats", [device_stats(devices)]),
+                                           loop=event_loop)
         except KeyError as e:
             await bad_things_queue.coro_put(runtimeUtil.BadThing(
                 sys.exc_info(),
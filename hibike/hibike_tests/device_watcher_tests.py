@@ -0,0 +1,143 @@
+"""
+Unit tests for device_watcher.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from device_watcher import CachedFile, InotifyWatcher, PollingWatcher, make_device_watcher
+from hibike_tests.utils import AsyncTestCase
+
+
+def inotify_available():
+    """Return whether this system supports inotify."""
+    event_loop = asyncio.new_event_loop()
+    try:
+        InotifyWatcher(event_loop, {}, 1).close()
+    except (OSError, AttributeError, TypeError):
+        return False
+    finally:
+        event_loop.close()
+    return True
+
+
+class WatcherTestCase(AsyncTestCase):
+    """
+    A test case with a temporary directory to watch.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def touch(self, name):
+        """Create the file NAME in the watched directory."""
+        with open(os.path.join(self.directory, name), "w"):
+            pass
+
+    def wait_time(self, watcher, action=None):
+        """Return how long WATCHER.wait() takes when ACTION is run right after it starts."""
+        async def timed_wait():
+            start = self.loop.time()
+            await watcher.wait()
+            return self.loop.time() - start
+        task = self.loop.create_task(timed_wait())
+        if action is not None:
+            self.loop.call_later(0.01, action)
+        return self.loop.run_until_complete(task)
+
+
+class PollingWatcherTests(WatcherTestCase):
+    """
+    Test that `PollingWatcher` wakes up on its interval.
+    """
+    def test_interval(self):
+        """
+        Waiting should take one interval, whatever happens to the files.
+        """
+        watcher = PollingWatcher(self.loop, 0.1)
+        self.assertGreaterEqual(self.wait_time(watcher, lambda: self.touch("ttyACM0")), 0.09)
+        watcher.close()
+
+
+@unittest.skipUnless(inotify_available(), "inotify is not available")
+class InotifyWatcherTests(WatcherTestCase):
+    """
+    Test that `InotifyWatcher` wakes up early only for matching files.
+    """
+    INTERVAL = 0.5
+
+    def setUp(self):
+        super().setUp()
+        self.watcher = InotifyWatcher(self.loop, {self.directory: ["ttyACM*"]}, self.INTERVAL)
+        self.addCleanup(self.watcher.close)
+
+    def test_matching_file(self):
+        """
+        Creating and removing a matching file should end the wait right away.
+        """
+        self.assertLess(self.wait_time(self.watcher, lambda: self.touch("ttyACM0")), 0.25)
+        self.assertLess(self.wait_time(
+            self.watcher, lambda: os.remove(os.path.join(self.directory, "ttyACM0"))), 0.25)
+
+    def test_other_file(self):
+        """
+        Files that don't match any pattern should not end the wait.
+        """
+        self.assertGreaterEqual(self.wait_time(self.watcher, lambda: self.touch("ttyS0")),
+                                self.INTERVAL * 0.9)
+
+    def test_factory(self):
+        """
+        `make_device_watcher` should skip missing directories and prefer inotify.
+        """
+        watcher = make_device_watcher(self.loop, {self.directory: ["ttyACM*"],
+                                                  os.path.join(self.directory, "missing"): ["*"]},
+                                      self.INTERVAL)
+        self.assertIsInstance(watcher, InotifyWatcher)
+        watcher.close()
+
+
+class CachedFileTests(unittest.TestCase):
+    """
+    Test that `CachedFile` only re-reads a file that changed.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "virtual_devices.txt")
+        self.cached = CachedFile(self.path)
+
+    def write(self, contents, mtime):
+        """Write CONTENTS to the file and set its modification time to MTIME."""
+        with open(self.path, "w") as config_file:
+            config_file.write(contents)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_missing(self):
+        """
+        A missing file should read as empty.
+        """
+        self.assertEqual(self.cached.read(), "")
+
+    def test_reread_on_change(self):
+        """
+        New contents should be read once the modification time changes.
+        """
+        self.write("/dev/pts/1", 1000)
+        self.assertEqual(self.cached.read(), "/dev/pts/1")
+        self.write("/dev/pts/2", 2000)
+        self.assertEqual(self.cached.read(), "/dev/pts/2")
+        os.remove(self.path)
+        self.assertEqual(self.cached.read(), "")
+
+    def test_cached(self):
+        """
+        The file should not be read again while its modification time stays the same.
+        """
+        self.write("/dev/pts/1", 1000)
+        self.cached.read()
+        self.write("/dev/pts/3", 1000)
+        self.assertEqual(self.cached.read(), "/dev/pts/1")
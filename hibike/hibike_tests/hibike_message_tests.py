@@ -131,6 +131,15 @@ class ParamsTests(unittest.TestCase):
         run_with_random_data(assert_params_same,
                              self.gen_random_device_id_and_params, times=1000)
 
+    def test_codecs_are_reused(self):
+        """ The same (device_id, bitmask) pair maps to the same codec. """
+        device_id = random.choice(DEVICE_TYPES)
+        params = hibike_message.all_params_for_device_id(device_id)
+        bitmask = hibike_message.encode_params(device_id, params)
+        codec = hibike_message.CODECS[device_id, bitmask]
+        self.assertIs(codec, hibike_message.CODECS[device_id, bitmask])
+        self.assertEqual(sorted(codec.params), sorted(params))
+
 
 class ParsingTests(unittest.TestCase):
     """ Tests for parsing Hibike messages. """
@@ -236,6 +245,29 @@ class ParsingTests(unittest.TestCase):
                 run_with_random_data(assert_parse_is_not_none,
                                      func, times=100)
 
+    def test_device_data_round_trip(self):
+        """ Packing and unpacking a payload gives back the same values. """
+        def assert_round_trip(device_id, params):
+            """
+            Check that a DeviceData made from PARAMS decodes to the same
+            params and values, in parameter number order.
+            """
+            values = random_values(device_id, params)
+            msg = hibike_message.make_device_data(device_id, list(zip(params, values)))
+            decoded = hibike_message.parse_device_data(msg, device_id)
+            expected = sorted(zip(params, values),
+                              key=lambda pv: hibike_message.PARAM_MAP[device_id][pv[0]][0])
+            self.assertEqual(len(decoded), len(expected))
+            for (name, value), (exp_name, exp_value) in zip(decoded, expected):
+                self.assertEqual(name, exp_name)
+                if isinstance(exp_value, float):
+                    self.assertAlmostEqual(value, exp_value, places=5)
+                else:
+                    self.assertEqual(value, exp_value)
+
+        run_with_random_data(assert_round_trip,
+                             ParamsTests.gen_random_device_id_and_params, times=1000)
+
     def test_parse_bad_checksum(self):
         """ Packets with bad checksums should not be parsed. """
         def screw_up_checksum(valid_packet):
@@ -275,6 +307,83 @@ class ParsingTests(unittest.TestCase):
                 run_with_random_data(assert_parse_idempotent, func, times=100)
 
 
+class PacketDeframerTests(unittest.TestCase):
+    """ Tests for the streaming packet deframer. """
+    @staticmethod
+    def gen_packet_stream():
+        """ Generate a few encoded packets, and the messages they hold. """
+        messages = []
+        for _ in range(random.randrange(1, 10)):
+            device_id = random.choice(DEVICE_TYPES)
+            messages.append(random.choice([
+                hibike_message.make_ping(),
+                hibike_message.make_heartbeat_request(random.randrange(256)),
+                hibike_message.make_subscription_request(
+                    device_id, random_params(device_id), random.randrange(100)),
+            ]))
+        stream = bytearray()
+        for msg in messages:
+            stream.extend(ParsingTests.encode_packet(msg))
+        return (stream, messages)
+
+    def assert_messages_equal(self, received, expected):
+        """ Check that two lists of HibikeMessages have the same contents. """
+        self.assertEqual([(m.get_message_id(), m.get_payload()) for m in received],
+                         [(m.get_message_id(), m.get_payload()) for m in expected])
+
+    def test_burst(self):
+        """ A burst of packets fed at once should all come out in one pass. """
+        def assert_all_packets(stream, messages):
+            """ Feed STREAM in one go and check that MESSAGES come out. """
+            deframer = hibike_message.PacketDeframer()
+            deframer.feed(stream)
+            self.assert_messages_equal(list(deframer.packets()), messages)
+            self.assertEqual(deframer.bytes_needed, 0)
+
+        run_with_random_data(assert_all_packets, self.gen_packet_stream, times=100)
+
+    def test_split_reads(self):
+        """ Packets split across many reads are reassembled. """
+        def assert_all_packets(stream, messages):
+            """ Feed STREAM in random chunks and check that MESSAGES come out. """
+            deframer = hibike_message.PacketDeframer()
+            received = []
+            pos = 0
+            while pos < len(stream):
+                chunk_len = random.randrange(1, 8)
+                deframer.feed(stream[pos:pos + chunk_len])
+                received.extend(deframer.packets())
+                pos += chunk_len
+            self.assert_messages_equal(received, messages)
+
+        run_with_random_data(assert_all_packets, self.gen_packet_stream, times=100)
+
+    def test_skip_garbage(self):
+        """ Leading garbage and truncated frames are skipped. """
+        def assert_recovers(stream, messages):
+            """ Prefix STREAM with junk and check that MESSAGES still come out. """
+            junk = bytearray(random.randrange(1, 256) for _ in range(random.randrange(10)))
+            truncated = ParsingTests.encode_packet(hibike_message.make_ping())[:-1]
+            deframer = hibike_message.PacketDeframer()
+            deframer.feed(junk + truncated + stream)
+            self.assert_messages_equal(list(deframer.packets()), messages)
+
+        run_with_random_data(assert_recovers, self.gen_packet_stream, times=100)
+
+    def test_error_counts(self):
+        """ Skipped frames are counted by the reason they were rejected. """
+        ping = ParsingTests.encode_packet(hibike_message.make_ping())
+        message = hibike_message.make_ping().to_bytes()
+        message.append(hibike_message.checksum(message) ^ 0xFF)
+        encoded = hibike_message.cobs_encode(message)
+        bad_checksum = bytearray([0, len(encoded)]) + encoded
+        deframer = hibike_message.PacketDeframer()
+        deframer.feed(ping[:-1] + bad_checksum + ping)
+        self.assertEqual(len(list(deframer.packets())), 1)
+        self.assertEqual(deframer.errors["truncated"], 1)
+        self.assertEqual(deframer.errors["checksum"], 1)
+
+
 class BlockingReadGeneratorTests(unittest.TestCase):
     """ Tests for blocking_read_generator. """
     DUMMY_DEVICE_TYPE = "LimitSwitch"
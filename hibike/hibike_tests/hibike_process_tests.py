@@ -7,15 +7,20 @@ import random
 import sys
 import time
 import unittest
+from unittest import mock
 
 import aioprocessing
 import serial
 
 from spawn_virtual_devices import spawn_device, get_virtual_ports
-from hibike_process import hotplug_async
+import hibike_process
+from hibike_process import (hotplug_async, changed_values, coalesce_writes, batch_data,
+                            remove_disconnected_devices, SmartSensorProtocol)
 from hibike_tests.utils import AsyncTestCase
 import hibike_message as hm
 from hibike_tester import Hibike
+from transports import connect_loopback
+from virtual_device import VirtualDevice
 
 def add_runtime_to_path():
     """
@@ -196,3 +201,329 @@ class ReadWriteTests(unittest.TestCase):
         """
         self.read("0x123456789", "duty_cycle")
         self.hibike.bad_things_queue.get(block=False)
+
+
+class DeltaBatchingTests(unittest.TestCase):
+    """
+    Test that only changed sensor values are batched.
+    """
+    POT_UID = hm.device_name_to_id("Potentiometer") << 72 | 1
+    SWITCH_UID = hm.device_name_to_id("LimitSwitch") << 72 | 2
+
+    def test_unchanged_values_not_sent(self):
+        """
+        Values that were already sent should not be sent again.
+        """
+        last_sent = {}
+        values = {self.SWITCH_UID: [("switch0", True), ("switch1", False)]}
+        self.assertEqual(changed_values(values, last_sent), values)
+        self.assertEqual(changed_values(values, last_sent), {})
+        values = {self.SWITCH_UID: [("switch0", True), ("switch1", True)]}
+        self.assertEqual(changed_values(values, last_sent),
+                         {self.SWITCH_UID: [("switch1", True)]})
+
+    def test_deadband(self):
+        """
+        Float params should only be sent once they move past their deadband.
+        """
+        deadband = hm.DEADBANDS[hm.device_name_to_id("Potentiometer")]["pot0"]
+        last_sent = {}
+        changed_values({self.POT_UID: [("pot0", 0.5)]}, last_sent)
+        self.assertEqual(changed_values({self.POT_UID: [("pot0", 0.5 + deadband / 2)]},
+                                        last_sent), {})
+        self.assertEqual(changed_values({self.POT_UID: [("pot0", 0.5 + deadband * 2)]},
+                                        last_sent), {self.POT_UID: [("pot0", 0.5 + deadband * 2)]})
+
+
+class CoalesceWritesTests(unittest.TestCase):
+    """
+    Test that pending writes to a device are merged.
+    """
+    UID = hm.device_name_to_id("YogiBear") << 72 | 1
+
+    def test_latest_value_wins(self):
+        """
+        Consecutive writes should become one write with the newest values.
+        """
+        instructions = [("write", (self.UID, [("duty_cycle", 0.1)])),
+                        ("write", (self.UID, [("pid_pos_kp", 1.0), ("duty_cycle", 0.2)])),
+                        ("write", (self.UID, [("duty_cycle", 0.3)]))]
+        coalesced, merged, stale = coalesce_writes(instructions)
+        self.assertEqual(coalesced,
+                         [("write", (self.UID, [("duty_cycle", 0.3), ("pid_pos_kp", 1.0)]))])
+        self.assertEqual((merged, stale), (2, 2))
+
+    def test_order_kept(self):
+        """
+        Writes should not be merged across other instructions.
+        """
+        instructions = [("write", (self.UID, [("duty_cycle", 0.1)])),
+                        ("disable", ()),
+                        ("write", (self.UID, [("duty_cycle", 0.2)]))]
+        coalesced, merged, stale = coalesce_writes(instructions)
+        self.assertEqual(coalesced, instructions)
+        self.assertEqual((merged, stale), (0, 0))
+
+
+class RecordingStateQueue:
+    """
+    Stands in for the queue to StateManager, keeping everything put in it.
+    """
+    def __init__(self):
+        self.items = []
+
+    # pylint: disable=unused-argument
+    async def coro_put(self, item, loop=None):
+        """Keep ITEM."""
+        self.items.append(item)
+
+    def of_type(self, message_type):
+        """Return the arguments of every message of MESSAGE_TYPE, oldest first."""
+        return [args for kind, args in self.items if kind == message_type]
+
+
+class LoopbackTestCase(AsyncTestCase):
+    """
+    A test case that connects `SmartSensorProtocol` to virtual devices over
+    in-memory loopback transports.
+    """
+    def setUp(self):
+        super().setUp()
+        self.devices = {}
+        self.batched_data = {}
+        self.last_sent = {}
+        self.pending = set()
+        self.error_queue = asyncio.Queue(loop=self.loop)
+        self.state_queue = RecordingStateQueue()
+
+    def connect(self, device_name, serial_no=1, device_factory=None, bytes_per_sec=None):
+        """
+        Connect a virtual DEVICE_NAME, or the protocol DEVICE_FACTORY makes
+        for its UID, to a new `SmartSensorProtocol` over a link of BYTES_PER_SEC.
+
+        Returns:
+            ``(uid, host, device_transport)``
+        """
+        uid = hm.device_name_to_id(device_name) << 72 | serial_no
+        name = "loop{}".format(serial_no)
+        self.pending.add(name)
+        if device_factory is None:
+            device_factory = VirtualDevice
+        (_, host), (device_transport, _) = connect_loopback(
+            self.loop,
+            lambda: SmartSensorProtocol(self.devices, self.batched_data, self.error_queue,
+                                        self.state_queue, self.loop, self.pending,
+                                        last_sent=self.last_sent),
+            lambda: device_factory(uid, self.loop), name, bytes_per_sec)
+        return uid, host, device_transport
+
+    def wait_until_identified(self, timeout=1):
+        """Run the event loop until every connected device is identified or TIMEOUT runs out."""
+        deadline = self.loop.time() + timeout
+        while self.pending and self.loop.time() < deadline:
+            self.run_for(0.01)
+
+    def run_for(self, seconds):
+        """Run the event loop for SECONDS."""
+        self.loop.run_until_complete(asyncio.sleep(seconds, loop=self.loop))
+
+
+class BatchDataTests(LoopbackTestCase):
+    """
+    Test that `batch_data` sends every value again after a device is subscribed.
+    """
+    PARAMS = ["switch1", "switch2"]
+
+    def batches_for(self, uid, since):
+        """Return the values of UID in each batch sent after the first SINCE messages."""
+        return [args[0][uid] for kind, args in self.state_queue.items[since:]
+                if kind == "device_values" and uid in args[0]]
+
+    def test_resubscribe_resends(self):
+        """
+        A new subscription response should make unchanged values go out again.
+        """
+        uid, host, _ = self.connect("LimitSwitch")
+        self.wait_until_identified()
+        # Only the first batch is a keyframe
+        with mock.patch.object(hibike_process, "KEYFRAME_INTERVAL", 10 ** 6):
+            self.loop.create_task(batch_data(self.batched_data, self.state_queue, self.loop,
+                                             self.last_sent))
+            host.write_queue.put_nowait(("subscribe", (uid, 10, self.PARAMS)))
+            self.run_for(0.2)
+            self.assertEqual(len(self.batches_for(uid, 0)), 1)
+
+            since = len(self.state_queue.items)
+            host.write_queue.put_nowait(("subscribe", (uid, 10, self.PARAMS)))
+            self.run_for(0.2)
+        self.assertEqual(self.batches_for(uid, since), [[("switch1", True), ("switch2", False)]])
+
+    def test_disconnect_forgets_values(self):
+        """
+        Values of a device that disconnected should be forgotten.
+        """
+        uid, host, device_transport = self.connect("LimitSwitch")
+        self.wait_until_identified()
+        self.loop.create_task(batch_data(self.batched_data, self.state_queue, self.loop,
+                                         self.last_sent))
+        host.write_queue.put_nowait(("subscribe", (uid, 10, self.PARAMS)))
+        self.run_for(0.2)
+        self.assertIn(uid, self.batched_data)
+        self.assertIn(uid, self.last_sent)
+
+        device_transport.close()
+        self.run_for(0.01)
+        for _ in range(2):
+            self.loop.run_until_complete(remove_disconnected_devices(
+                self.error_queue, self.devices, self.state_queue, self.loop))
+        self.assertNotIn(uid, self.devices)
+        self.assertNotIn(uid, self.batched_data)
+        self.assertNotIn(uid, self.last_sent)
+
+
+class WriteCountingDevice(VirtualDevice):
+    """
+    A virtual device that keeps every device write it receives.
+    """
+    def __init__(self, uid, event_loop):
+        super().__init__(uid, event_loop)
+        self.device_writes = []
+
+    def _process_device_write(self, msg):
+        device_id = hm.uid_to_device_id(self.uid)
+        self.device_writes.append(hm.decode_device_write(msg, device_id))
+        super()._process_device_write(msg)
+
+
+class WriteCoalescingTests(LoopbackTestCase):
+    """
+    Test that writes queued for a device are merged before they are sent.
+    """
+    VALUES = [i / 10 for i in range(10)]
+
+    def write_all(self, host, pause=None):
+        """
+        Queue a duty cycle write of each of `VALUES`, running the loop for
+        PAUSE in between, or not at all if PAUSE is None.
+        """
+        for value in self.VALUES:
+            host.write_queue.put_nowait(("write", (host.uid, [("duty_cycle", value)])))
+            if pause is not None:
+                self.run_for(pause)
+        self.run_for(0.2)
+
+    def assert_coalesced(self, host, device):
+        """Check that fewer writes reached DEVICE than were queued, ending with the last one."""
+        self.assertLess(len(device.device_writes), len(self.VALUES))
+        self.assertGreater(host.write_stats["merged"], 0)
+        (param, value), = device.device_writes[-1]
+        self.assertEqual(param, "duty_cycle")
+        self.assertAlmostEqual(value, self.VALUES[-1], places=6)
+
+    def connect_yogi_bear(self, bytes_per_sec=None):
+        """Connect and identify a `WriteCountingDevice` YogiBear."""
+        _, host, device_transport = self.connect("YogiBear", device_factory=WriteCountingDevice,
+                                                 bytes_per_sec=bytes_per_sec)
+        self.wait_until_identified()
+        return host, device_transport.get_protocol()
+
+    def test_writes_in_same_tick(self):
+        """
+        Writes StateManager sends one after another should be merged.
+        """
+        host, device = self.connect_yogi_bear()
+        self.write_all(host)
+        self.assert_coalesced(host, device)
+
+    def test_writes_to_slow_port(self):
+        """
+        Writes should be held and merged while the port is still sending earlier ones.
+        """
+        # Each device write takes about 20 ms to send
+        host, device = self.connect_yogi_bear(bytes_per_sec=1000)
+        self.write_all(host, pause=0.005)
+        self.assert_coalesced(host, device)
+
+    def test_lone_write_not_delayed(self):
+        """
+        A write with nothing to merge with should be sent as soon as it is queued.
+        """
+        host, device = self.connect_yogi_bear()
+        host.write_queue.put_nowait(("write", (host.uid, [("duty_cycle", 0.5)])))
+        self.run_for(0)
+        self.assertEqual(len(device.device_writes), 1)
+        self.assertEqual(host.write_stats["merged"], 0)
+
+
+class SlowToAnswerDevice(VirtualDevice):
+    """
+    A virtual device that ignores the first `IGNORED_PINGS` pings.
+    """
+    IGNORED_PINGS = 2
+
+    def __init__(self, uid, event_loop):
+        super().__init__(uid, event_loop)
+        self.ignored = 0
+
+    def _process_ping(self, msg):
+        if self.ignored < self.IGNORED_PINGS:
+            self.ignored += 1
+            return
+        super()._process_ping(msg)
+
+
+class SilentDevice(asyncio.Protocol):
+    """
+    Something on a serial port that never answers.
+    """
+    def __init__(self, *_):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+class IdentifyTests(LoopbackTestCase):
+    """
+    Test identification of devices, and the stats kept about it.
+    """
+    def test_identified_early(self):
+        """
+        A device that answers the first ping should be identified right away.
+        """
+        uid, host, _ = self.connect("LimitSwitch")
+        self.wait_until_identified()
+        self.assertIn(uid, self.devices)
+        identify = host.stats()["identify"]
+        self.assertEqual(identify["port"], "loop1")
+        self.assertEqual(identify["retries"], 0)
+        self.assertLess(identify["time_to_uid"], hibike_process.IDENTIFY_RETRY_DELAY)
+
+    def test_retry_backoff(self):
+        """
+        Pings should be retried, each waiting longer than the last, until one is answered.
+        """
+        uid, host, _ = self.connect("LimitSwitch", device_factory=SlowToAnswerDevice)
+        self.wait_until_identified()
+        self.assertIn(uid, self.devices)
+        identify = hibike_process.device_stats(self.devices)[uid]["identify"]
+        self.assertEqual(identify["retries"], SlowToAnswerDevice.IGNORED_PINGS)
+        # The answered ping was sent after the first two retry delays
+        delay = hibike_process.IDENTIFY_RETRY_DELAY
+        waited = delay + delay * hibike_process.IDENTIFY_BACKOFF
+        self.assertGreaterEqual(identify["time_to_uid"], waited)
+        self.assertLess(identify["time_to_uid"], waited + delay)
+        self.assertFalse(host.transport.is_closing())
+
+    def test_no_answer(self):
+        """
+        Ports that never answer should be closed once identification times out.
+        """
+        with mock.patch.object(hibike_process, "IDENTIFY_TIMEOUT", 0.2):
+            _, host, _ = self.connect("LimitSwitch", device_factory=SilentDevice)
+            self.wait_until_identified()
+            self.run_for(0.01)
+        self.assertEqual((self.devices, self.pending), ({}, set()))
+        self.assertTrue(host.transport.is_closing())
+        self.assertEqual(host.stats()["identify"]["time_to_uid"], None)
+        self.assertEqual(host.stats()["identify"]["retries"], 2)
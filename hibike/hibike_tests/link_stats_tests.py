@@ -0,0 +1,59 @@
+"""
+Unit tests for link_stats.
+"""
+import unittest
+
+from link_stats import HeartbeatMonitor
+from hibike_tests.utils import FakeClock
+
+
+class HeartbeatMonitorTests(unittest.TestCase):
+    """
+    Test round trip time measurement and missed heartbeat detection.
+    """
+    TIMEOUT = 0.5
+    MAX_MISSED = 3
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.monitor = HeartbeatMonitor(self.TIMEOUT, self.MAX_MISSED, clock=self.clock)
+
+    def test_rtt(self):
+        """
+        Responses should be matched to requests by id.
+        """
+        first = self.monitor.request()
+        self.clock.time += 0.01
+        second = self.monitor.request()
+        self.clock.time += 0.01
+        self.assertAlmostEqual(self.monitor.response(second), 0.01)
+        self.assertAlmostEqual(self.monitor.response(first), 0.02)
+        self.assertIsNone(self.monitor.response(first))
+        stats = self.monitor.snapshot()
+        self.assertEqual((stats["sent"], stats["answered"], stats["missed"]), (2, 2, 0))
+        self.assertAlmostEqual(stats["rtt_max"], 0.02)
+
+    def test_unknown_id_matches_oldest(self):
+        """
+        A response with an unexpected id should answer the oldest request.
+        """
+        self.monitor.request()
+        self.clock.time += 0.03
+        self.monitor.request()
+        self.assertAlmostEqual(self.monitor.response(200), 0.03)
+
+    def test_dead_after_missed_beats(self):
+        """
+        A device should be dead once it misses too many heartbeats in a row,
+        and come back to life as soon as it answers one.
+        """
+        for _ in range(self.MAX_MISSED):
+            self.assertFalse(self.monitor.dead)
+            self.monitor.request()
+            self.clock.time += self.TIMEOUT
+            self.monitor.expire()
+        self.assertTrue(self.monitor.dead)
+        self.assertEqual(self.monitor.snapshot()["missed"], self.MAX_MISSED)
+        heartbeat_id = self.monitor.request()
+        self.monitor.response(heartbeat_id)
+        self.assertFalse(self.monitor.dead)
@@ -0,0 +1,79 @@
+"""
+Unit tests for serial captures.
+"""
+import os
+import tempfile
+import unittest
+
+import serial_capture
+from serial_capture import CaptureFile, read_capture
+
+
+class SerialCaptureTests(unittest.TestCase):
+    """
+    Test writing and reading capture files.
+    """
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def capture(self, start_time=0):
+        """
+        Write a short session with one connection, with timestamps from START_TIME.
+        """
+        times = iter(range(start_time, start_time + 100))
+        capture_file = CaptureFile(self.path, clock=lambda: next(times))
+        channel = capture_file.channel("/dev/ttyACM0")
+        channel.sent(b"\x00\x03ping")
+        channel.received(b"\x00\x05abc")
+        channel.identified(0xABC << 72 | 0x1234)
+        capture_file.close()
+
+    def test_round_trip(self):
+        """
+        Records should be read back as they were written.
+        """
+        self.capture()
+        records = list(read_capture(self.path))
+        self.assertEqual([record.kind for record in records],
+                         [serial_capture.SESSION, serial_capture.PORT, serial_capture.SENT,
+                          serial_capture.RECEIVED, serial_capture.UID])
+        self.assertEqual([record.timestamp for record in records], [0, 1, 2, 3, 4])
+        self.assertEqual(records[1].data, "/dev/ttyACM0")
+        self.assertEqual(records[2].data, b"\x00\x03ping")
+        self.assertEqual(records[3].data, b"\x00\x05abc")
+        self.assertEqual(records[4].data, 0xABC << 72 | 0x1234)
+
+    def test_append_sessions(self):
+        """
+        Opening an existing capture should start a new session at its end.
+        """
+        self.capture()
+        self.capture(start_time=50)
+        records = list(read_capture(self.path))
+        self.assertEqual(len(records), 10)
+        self.assertEqual(records[5].kind, serial_capture.SESSION)
+        self.assertEqual(records[6].channel, 0)
+
+    def test_truncated(self):
+        """
+        A record cut off by a crash should be ignored.
+        """
+        self.capture()
+        with open(self.path, "r+b") as capture:
+            capture.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual(len(list(read_capture(self.path))), 4)
+
+    def test_not_a_capture(self):
+        """
+        Files without the magic number should be rejected.
+        """
+        with open(self.path, "wb") as capture:
+            capture.write(b"not a capture")
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
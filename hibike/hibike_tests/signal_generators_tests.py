@@ -0,0 +1,74 @@
+"""
+Unit tests for virtual device signal generators.
+"""
+import random
+import unittest
+
+from signal_generators import make_generator
+
+
+class SignalGeneratorTests(unittest.TestCase):
+    """
+    Test generators made from virtual device default values.
+    """
+    def test_constant(self):
+        """
+        Values that are not generator descriptions should never change.
+        """
+        generator = make_generator(3.5)
+        self.assertEqual([generator(t) for t in (0, 1, 100)], [3.5] * 3)
+
+    def test_periodic(self):
+        """
+        Sine waves, ramps and steps should repeat every period.
+        """
+        sine = make_generator({"type": "sine", "amplitude": 2, "offset": 1, "period": 4})
+        self.assertAlmostEqual(sine(1), 3)
+        self.assertAlmostEqual(sine(5), 3)
+        ramp = make_generator({"type": "ramp", "start": 10, "stop": 20, "period": 2})
+        self.assertAlmostEqual(ramp(1), 15)
+        self.assertAlmostEqual(ramp(3), 15)
+        step = make_generator({"type": "step", "values": [1, 2, 3], "period": 0.5})
+        self.assertEqual([step(t) for t in (0, 0.6, 1.1, 1.6)], [1, 2, 3, 1])
+
+    def test_random_walk_bounds(self):
+        """
+        A random walk should stay within its bounds and be reproducible.
+        """
+        spec = {"type": "random_walk", "start": 0, "step": 0.5, "min": -1, "max": 1}
+        first = make_generator(spec, random.Random(1))
+        values = [first(t) for t in range(1000)]
+        self.assertTrue(all(-1 <= value <= 1 for value in values))
+        second = make_generator(spec, random.Random(1))
+        self.assertEqual(values, [second(t) for t in range(1000)])
+
+    def test_random_walk_follows_time(self):
+        """
+        A random walk should depend on the time it is read at, not on how often it is read.
+        """
+        spec = {"type": "random_walk", "start": 0, "step": 0.1, "interval": 0.1}
+        often = make_generator(spec, random.Random(2))
+        values = [often(t / 100) for t in range(501)]
+        rarely = make_generator(spec, random.Random(2))
+        self.assertEqual(rarely(5), values[-1])
+        self.assertEqual(rarely(5), values[-1])
+        # Nothing moves within one interval
+        self.assertEqual(values[:10], [0] * 10)
+        self.assertNotEqual(values[-1], 0)
+
+    def test_trace(self):
+        """
+        A trace should hold each sample until the next one, looping by default.
+        """
+        samples = [[0, 5], [1, 6], [2, 7]]
+        looped = make_generator({"type": "trace", "samples": samples})
+        self.assertEqual([looped(t) for t in (0, 0.5, 1.5, 2.5)], [5, 5, 6, 5])
+        once = make_generator({"type": "trace", "samples": samples, "loop": False})
+        self.assertEqual(once(10), 7)
+
+    def test_unknown_type(self):
+        """
+        Unknown generator types should be rejected.
+        """
+        with self.assertRaises(ValueError):
+            make_generator({"type": "square"})
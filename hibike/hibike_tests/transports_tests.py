@@ -0,0 +1,79 @@
+"""
+Unit tests for transports.
+"""
+import asyncio
+import unittest
+
+from transports import connect_loopback, port_name
+
+
+class RecordingProtocol(asyncio.Protocol):
+    """
+    A protocol that remembers what happened to it.
+    """
+    def __init__(self):
+        self.transport = None
+        self.received = []
+        self.lost = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.received.append(data)
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+
+class LoopbackTransportTests(unittest.TestCase):
+    """
+    Test the in-memory loopback transport.
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        (self.host_transport, self.host), (self.device_transport, self.device) = \
+            connect_loopback(self.loop, RecordingProtocol, RecordingProtocol, "loop0")
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_once(self):
+        """
+        Let the event loop run the callbacks that are ready.
+        """
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_writes_delivered_together(self):
+        """
+        Writes made in one iteration should arrive together in the next one.
+        """
+        self.host_transport.write(b"abc")
+        self.host_transport.write(bytearray(b"def"))
+        self.assertEqual(self.device.received, [])
+        self.run_once()
+        self.assertEqual(self.device.received, [b"abcdef"])
+        self.assertEqual(self.host.received, [])
+
+    def test_pause_reading(self):
+        """
+        Nothing should be delivered while reading is paused.
+        """
+        self.device_transport.pause_reading()
+        self.host_transport.write(b"abc")
+        self.run_once()
+        self.assertEqual(self.device.received, [])
+        self.device_transport.resume_reading()
+        self.run_once()
+        self.assertEqual(self.device.received, [b"abc"])
+
+    def test_close(self):
+        """
+        Closing one end should close both.
+        """
+        self.assertEqual(port_name(self.host_transport), "loop0")
+        self.host_transport.abort()
+        self.run_once()
+        self.assertTrue(self.host.lost and self.device.lost)
+        self.assertTrue(self.device_transport.is_closing())
+        self.assertIsNone(port_name(self.host_transport))
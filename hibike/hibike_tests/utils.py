@@ -15,6 +15,19 @@ def run_with_random_data(func, arg_func, kwarg_func=lambda: {}, times=5):
         func(*arg_func(), **kwarg_func())
 
 
+class FakeClock:
+    """
+    A clock that only moves when told to, counting how often it is read.
+    """
+    def __init__(self, start=0.0):
+        self.time = start
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.time
+
+
 class AsyncTestCase(unittest.TestCase):
     """
     A test case that creates an event loop before a test and
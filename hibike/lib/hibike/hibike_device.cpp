@@ -111,8 +111,8 @@ void hibike_loop() {
 					break;
 
 				case HEART_BEAT_REQUEST:
-					// send heart beat response
-					send_heartbeat_response(1);
+					// send heart beat response, echoing the request's id
+					send_heartbeat_response(hibike_buff.payload[0]);
 					break;
 
 				case HEART_BEAT_RESPONSE:
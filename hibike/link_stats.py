@@ -0,0 +1,226 @@
+"""
+Live counters describing the serial link to a single smart sensor.
+
+Each ``SmartSensorProtocol`` owns a ``LinkStats`` and records every packet
+and byte going through it, and a ``HeartbeatMonitor`` that times its own
+heartbeat requests. ``snapshot`` turns either into a plain dict that can be
+sent to StateManager.
+"""
+import collections
+import time
+
+import hibike_message as hm
+
+__all__ = ["LinkStats", "HeartbeatMonitor", "DATA_INTERVAL_BUCKETS"]
+
+# Length of the window packet rates are measured over, in seconds
+RATE_WINDOW = 1
+# Upper bounds, in milliseconds, of the buckets of the histogram of
+# time between DeviceData packets; the last bucket catches everything else
+DATA_INTERVAL_BUCKETS = (5, 10, 20, 40, 80, 160, 320, float("inf"))
+
+# Weight of each new sample in the smoothed round trip time
+RTT_EWMA_WEIGHT = 0.125
+# Number of recent round trip times to compute percentiles over
+RTT_SAMPLES = 100
+# Heartbeat ids are a single byte
+MAX_HEARTBEAT_ID = 255
+
+MESSAGE_NAMES = {message_id: name for name, message_id in hm.MESSAGE_TYPES.items()}
+
+
+class LinkStats:
+    """
+    Counters and a histogram for one serial link.
+
+    :param clock: Function returning the current time in seconds
+    """
+    __slots__ = ("clock", "packets", "bytes_in", "bytes_out", "pauses", "resumes",
+                 "max_queue_depth", "last_device_data", "data_intervals",
+                 "_window_start", "_window_packets", "_rates")
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # Total packets received, by message id
+        self.packets = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pauses = 0
+        self.resumes = 0
+        self.max_queue_depth = 0
+        self.last_device_data = None
+        self.data_intervals = [0] * len(DATA_INTERVAL_BUCKETS)
+        self._window_start = clock()
+        self._window_packets = {}
+        # Packet rates over the last full window, or None before the first one ends
+        self._rates = None
+
+    def _roll_window(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW:
+            self._rates = {message_id: count / elapsed
+                           for message_id, count in self._window_packets.items()}
+            self._window_packets = {}
+            self._window_start = now
+
+    def record_packet(self, message_id, queue_depth):
+        """
+        Count a received packet, and the depth of the read queue it was taken from.
+        """
+        now = self.clock()
+        self._roll_window(now)
+        self.packets[message_id] = self.packets.get(message_id, 0) + 1
+        self._window_packets[message_id] = self._window_packets.get(message_id, 0) + 1
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+        if message_id == hm.MESSAGE_TYPES["DeviceData"]:
+            if self.last_device_data is not None:
+                interval = (now - self.last_device_data) * 1000
+                for bucket, upper_bound in enumerate(DATA_INTERVAL_BUCKETS):
+                    if interval <= upper_bound:
+                        self.data_intervals[bucket] += 1
+                        break
+            self.last_device_data = now
+
+    def snapshot(self, queue_depth=0, frame_errors=None, **extra):
+        """
+        Return the current counters as a dict of plain values.
+
+        :param queue_depth: The current depth of the read queue
+        :param dict frame_errors: Number of invalid frames by reason, if known
+        :param extra: Additional entries to include
+        """
+        now = self.clock()
+        self._roll_window(now)
+        rates = self._rates
+        if rates is None:
+            elapsed = max(now - self._window_start, 1e-9)
+            rates = {message_id: count / elapsed
+                     for message_id, count in self._window_packets.items()}
+        stats = {
+            "packets": {MESSAGE_NAMES.get(message_id, message_id): count
+                        for message_id, count in self.packets.items()},
+            "packets_per_sec": {MESSAGE_NAMES.get(message_id, message_id): rate
+                                for message_id, rate in rates.items()},
+            "frame_errors": dict(frame_errors) if frame_errors is not None else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "pauses": self.pauses,
+            "resumes": self.resumes,
+            "since_device_data": (now - self.last_device_data
+                                  if self.last_device_data is not None else None),
+            "device_data_intervals": {"{:g}".format(upper_bound): count for upper_bound, count
+                                      in zip(DATA_INTERVAL_BUCKETS, self.data_intervals)},
+        }
+        stats.update(extra)
+        return stats
+
+
+class HeartbeatMonitor:
+    """
+    Match heartbeat responses to requests to measure round trip times,
+    and count requests that were never answered.
+
+    Requests carry an id that the device echoes back. Responses with an id
+    that is not outstanding (older firmware always answers with the same id)
+    are matched to the oldest outstanding request instead.
+
+    :param timeout: Seconds after which an unanswered request counts as missed
+    :param max_missed: Number of consecutive missed heartbeats after which
+    the device is considered dead
+    :param clock: Function returning the current time in seconds
+    """
+    __slots__ = ("clock", "timeout", "max_missed", "outstanding", "next_id", "rtt_ewma",
+                 "rtts", "sent", "answered", "missed", "consecutive_missed")
+
+    def __init__(self, timeout, max_missed, clock=time.monotonic):
+        self.clock = clock
+        self.timeout = timeout
+        self.max_missed = max_missed
+        # {heartbeat id: time sent}, oldest first
+        self.outstanding = collections.OrderedDict()
+        self.next_id = 0
+        self.rtt_ewma = None
+        self.rtts = collections.deque(maxlen=RTT_SAMPLES)
+        self.sent = 0
+        self.answered = 0
+        self.missed = 0
+        self.consecutive_missed = 0
+
+    @property
+    def dead(self):
+        """
+        Whether too many heartbeats in a row went unanswered.
+        """
+        return self.consecutive_missed >= self.max_missed
+
+    def expire(self):
+        """
+        Count requests that have been outstanding for longer than the timeout as missed.
+        """
+        deadline = self.clock() - self.timeout
+        while self.outstanding:
+            heartbeat_id, sent_at = next(iter(self.outstanding.items()))
+            if sent_at > deadline:
+                break
+            del self.outstanding[heartbeat_id]
+            self.missed += 1
+            self.consecutive_missed += 1
+
+    def request(self):
+        """
+        Record that a heartbeat request is being sent, and return its id.
+        """
+        self.expire()
+        heartbeat_id = self.next_id
+        self.next_id = (self.next_id + 1) % (MAX_HEARTBEAT_ID + 1)
+        # An id that is still outstanding after wrapping around will never be answered
+        self.outstanding.pop(heartbeat_id, None)
+        self.outstanding[heartbeat_id] = self.clock()
+        self.sent += 1
+        return heartbeat_id
+
+    def response(self, heartbeat_id):
+        """
+        Record a heartbeat response, returning the round trip time in
+        seconds, or None if no request was waiting for it.
+        """
+        if heartbeat_id in self.outstanding:
+            sent_at = self.outstanding.pop(heartbeat_id)
+        elif self.outstanding:
+            _, sent_at = self.outstanding.popitem(last=False)
+        else:
+            return None
+        rtt = self.clock() - sent_at
+        self.rtts.append(rtt)
+        if self.rtt_ewma is None:
+            self.rtt_ewma = rtt
+        else:
+            self.rtt_ewma += RTT_EWMA_WEIGHT * (rtt - self.rtt_ewma)
+        self.answered += 1
+        self.consecutive_missed = 0
+        return rtt
+
+    def snapshot(self):
+        """
+        Return round trip times, in seconds, and heartbeat counts as a dict.
+        """
+        rtts = sorted(self.rtts)
+        def percentile(fraction):
+            if not rtts:
+                return None
+            return rtts[min(int(fraction * len(rtts)), len(rtts) - 1)]
+        return {
+            "rtt_ewma": self.rtt_ewma,
+            "rtt_p50": percentile(0.5),
+            "rtt_p90": percentile(0.9),
+            "rtt_p99": percentile(0.99),
+            "rtt_max": rtts[-1] if rtts else None,
+            "sent": self.sent,
+            "answered": self.answered,
+            "missed": self.missed,
+            "consecutive_missed": self.consecutive_missed,
+            "dead": self.dead,
+        }
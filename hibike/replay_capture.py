@@ -0,0 +1,218 @@
+"""
+Feed a capture from ``serial_capture.py`` back through Hibike.
+
+usage:
+$ HIBIKE_CAPTURE_FILE=match.cap python3 runtime.py   # capture while running
+$ python3 replay_capture.py match.cap                # as fast as possible
+$ python3 replay_capture.py match.cap --realtime     # at recorded speed
+
+Every captured serial connection gets its own ``SmartSensorProtocol``, and
+the bytes it received are handed to ``data_received`` in the chunks they
+arrived in, so replays go through the same deframing, parsing and
+``batch_data`` code as the real thing. Whatever Hibike sends back is
+discarded.
+
+Replaying as fast as possible still yields to the event loop after every
+chunk and respects flow control, so it gives a repeatable throughput
+benchmark for parser changes. Replaying at recorded speed reproduces the
+timing of the original traffic, for chasing lag seen at competition.
+"""
+import argparse
+import asyncio
+import time
+
+import serial_capture
+from device_farm import LoopLagMonitor, StateQueueSink, count_frame_errors
+from hibike_process import SmartSensorProtocol, batch_data
+
+__all__ = ["ReplayTransport", "replay"]
+
+
+class ReplayTransport(asyncio.Transport):
+    """
+    A transport that drops everything written to it and lets the replay
+    driver know when the protocol pauses reading.
+    """
+    def __init__(self, event_loop, name):
+        super().__init__(extra={"port_name": name})
+        self._protocol = None
+        self._closing = False
+        self.reading = asyncio.Event(loop=event_loop)
+        self.reading.set()
+        self.bytes_written = 0
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_write_buffer_limits(self):
+        return (0, 0)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def can_write_eof(self):
+        return False
+
+    def write_eof(self):
+        raise NotImplementedError("A replayed link cannot half-close")
+
+    def pause_reading(self):
+        self.reading.clear()
+
+    def resume_reading(self):
+        self.reading.set()
+
+    def is_reading(self):
+        return self.reading.is_set()
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._extra = {}
+            # Let a replay waiting for reading to resume finish
+            self.reading.set()
+            self._protocol.connection_lost(None)
+
+    def abort(self):
+        self.close()
+
+
+async def drain(links, event_loop):
+    """
+    Wait until every protocol in LINKS has processed the packets it received.
+    """
+    while any(host.read_queue.qsize() for host, _ in links.values()):
+        await asyncio.sleep(0, loop=event_loop)
+
+
+# pylint: disable=too-many-locals
+async def replay(event_loop, records, state_queue, realtime=False):
+    """
+    Feed the received bytes in RECORDS to new `SmartSensorProtocol`s, and
+    batch what they decode into STATE_QUEUE.
+
+    Returns the protocols and their transports as ``[(protocol, transport)]``.
+    """
+    devices = {}
+    batched_data = {}
+    last_sent = {}
+    pending = set()
+    error_queue = asyncio.Queue(loop=event_loop)
+    # {channel: (protocol, transport)} for the current session
+    links = {}
+    finished = []
+    # Difference between loop time and capture timestamps in the current session
+    offset = None
+    batch_task = event_loop.create_task(batch_data(batched_data, state_queue, event_loop,
+                                                      last_sent))
+
+    for record in records:
+        if record.kind == serial_capture.SESSION:
+            await drain(links, event_loop)
+            finished.extend(links.values())
+            links = {}
+            offset = None
+        elif record.kind == serial_capture.PORT:
+            name = "{}#{}".format(record.data, len(finished) + len(links))
+            transport = ReplayTransport(event_loop, name)
+            host = SmartSensorProtocol(devices, batched_data, error_queue, state_queue,
+                                       event_loop, pending, last_sent=last_sent)
+            pending.add(name)
+            transport.set_protocol(host)
+            host.connection_made(transport)
+            links[record.channel] = (host, transport)
+        elif record.kind == serial_capture.RECEIVED and record.channel in links:
+            host, transport = links[record.channel]
+            if realtime:
+                if offset is None:
+                    offset = event_loop.time() - record.timestamp
+                delay = record.timestamp + offset - event_loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay, loop=event_loop)
+            await transport.reading.wait()
+            if not transport.is_closing():
+                host.data_received(record.data)
+            await asyncio.sleep(0, loop=event_loop)
+
+    await drain(links, event_loop)
+    # A fast replay can finish before the first batch is sent, so send a
+    # keyframe of what was read for StateManager to get every value
+    batch = dict(batched_data)
+    if batch:
+        await state_queue.coro_put(("device_values", [batch]), loop=event_loop)
+    batch_task.cancel()
+    await asyncio.gather(batch_task, loop=event_loop, return_exceptions=True)
+    finished.extend(links.values())
+    return finished
+
+
+async def run_replay(event_loop, path, realtime):
+    """
+    Replay the capture at PATH and print how fast Hibike got through it.
+    """
+    records = list(serial_capture.read_capture(path))
+    received = sum(len(record.data) for record in records
+                   if record.kind == serial_capture.RECEIVED)
+    sink = StateQueueSink()
+    lag_monitor = LoopLagMonitor(event_loop)
+    lag_task = event_loop.create_task(lag_monitor.run())
+
+    start = event_loop.time()
+    cpu_start = time.process_time()
+    links = await replay(event_loop, records, sink, realtime)
+    elapsed = event_loop.time() - start
+    cpu = time.process_time() - cpu_start
+    lag_task.cancel()
+    await asyncio.gather(lag_task, loop=event_loop, return_exceptions=True)
+
+    packets = {}
+    frame_errors = count_frame_errors(links)
+    for host, _ in links:
+        for message_type, count in host.stats()["packets"].items():
+            packets[message_type] = packets.get(message_type, 0) + count
+        await host.stop()
+    total_packets = sum(packets.values())
+    mean_lag, p99_lag, max_lag = lag_monitor.summary()
+
+    print("Records:               {} ({} connections)".format(len(records), len(links)))
+    print("Replayed:              {} bytes in {:.3f} s ({:.0f} kB/s)".format(
+        received, elapsed, received / elapsed / 1000 if elapsed else 0))
+    print("Packets decoded:       {} ({:.0f}/s)".format(
+        total_packets, total_packets / elapsed if elapsed else 0))
+    for message_type, count in sorted(packets.items()):
+        print("  {:20} {}".format(message_type, count))
+    print("Invalid frames:        {}".format(frame_errors))
+    print("Values to StateManager {}".format(sink.values))
+    print("Event loop lag:        mean {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        mean_lag, p99_lag, max_lag))
+    print("CPU:                   {:.3f} s".format(cpu))
+
+
+def main():
+    """
+    Parse arguments and replay a capture.
+    """
+    parser = argparse.ArgumentParser(description="Replay a Hibike serial capture.")
+    parser.add_argument("capture", help="capture file written by hibike_process")
+    parser.add_argument("--realtime", action="store_true",
+                        help="replay at recorded speed instead of as fast as possible")
+    args = parser.parse_args()
+
+    event_loop = asyncio.get_event_loop()
+    event_loop.run_until_complete(run_replay(event_loop, args.capture, args.realtime))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Raw captures of the bytes Hibike sends to and receives from smart sensors.
+
+A capture file starts with ``MAGIC`` and is followed by records, each a
+``RECORD_HEADER`` (kind, ``time.monotonic()`` timestamp, channel, length)
+and ``length`` bytes of payload:
+
+* ``SESSION``: a process started capturing; the payload is the wall clock
+  time as a double. Channels are numbered from 0 again in every session,
+  and timestamps are only comparable within a session.
+* ``PORT``: a new serial connection, named by the UTF-8 payload.
+* ``UID``: the device on a channel identified itself; the payload is its
+  UID as ``UID_BYTES`` little-endian bytes.
+* ``RECEIVED``: bytes exactly as the serial port delivered them, so
+  replaying them exercises the deframer the same way.
+* ``SENT``: a single frame written to the serial port.
+
+Files are only ever appended to. A capture cut off by a crash ends with at
+most one truncated record, which ``read_capture`` ignores.
+See ``replay_capture.py`` to feed a capture back through Hibike.
+"""
+import collections
+import struct
+import time
+
+__all__ = ["CaptureFile", "read_capture", "Record"]
+
+MAGIC = b"HBKCAP01"
+# Record kind, timestamp, channel, payload length
+RECORD_HEADER = struct.Struct("<BdHI")
+SESSION_PAYLOAD = struct.Struct("<d")
+# UIDs are 88 bits long
+UID_BYTES = 11
+
+# Record kinds
+SESSION = 0
+PORT = 1
+UID = 2
+RECEIVED = 3
+SENT = 4
+
+# Size in bytes of the write buffer in front of the capture file
+BUFFER_SIZE = 1 << 16
+
+Record = collections.namedtuple("Record", ["kind", "timestamp", "channel", "data"])
+
+
+class CaptureFile:
+    """
+    Append records to the capture file at PATH, starting a new session.
+    """
+    def __init__(self, path, clock=time.monotonic):
+        self.clock = clock
+        self.records = 0
+        self.bytes_written = 0
+        self._channels = 0
+        self._file = open(path, "ab", buffering=BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._write(SESSION, 0, SESSION_PAYLOAD.pack(time.time()))
+
+    def _write(self, kind, channel, data):
+        header = RECORD_HEADER.pack(kind, self.clock(), channel, len(data))
+        self._file.write(header)
+        self._file.write(data)
+        self.records += 1
+        self.bytes_written += len(header) + len(data)
+
+    def channel(self, port):
+        """
+        Start capturing a connection to PORT. Returns a `ChannelCapture`.
+        """
+        channel = self._channels
+        self._channels += 1
+        self._write(PORT, channel, (port or "").encode("utf-8"))
+        return ChannelCapture(self, channel)
+
+    def flush(self):
+        """
+        Write buffered records to the file.
+        """
+        self._file.flush()
+
+    def close(self):
+        """
+        Flush and close the file.
+        """
+        self._file.close()
+
+
+class ChannelCapture:
+    """
+    Records for a single serial connection in a `CaptureFile`.
+    """
+    __slots__ = ("capture_file", "channel")
+
+    def __init__(self, capture_file, channel):
+        self.capture_file = capture_file
+        self.channel = channel
+
+    # pylint: disable=protected-access
+    def identified(self, uid):
+        """
+        Record that the device on this channel has UID.
+        """
+        self.capture_file._write(UID, self.channel, uid.to_bytes(UID_BYTES, "little"))
+
+    def received(self, data):
+        """
+        Record bytes received from the serial port.
+        """
+        self.capture_file._write(RECEIVED, self.channel, data)
+
+    def sent(self, frame):
+        """
+        Record a frame sent to the serial port.
+        """
+        self.capture_file._write(SENT, self.channel, frame)
+
+
+def read_capture(path):
+    """
+    Yield every `Record` in the capture file at PATH.
+
+    ``SESSION`` records have the wall clock time as their data, ``PORT``
+    records the port name and ``UID`` records the UID.
+    """
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a Hibike capture".format(path))
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, timestamp, channel, length = RECORD_HEADER.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                return
+            if kind == SESSION:
+                data, = SESSION_PAYLOAD.unpack(data)
+            elif kind == PORT:
+                data = data.decode("utf-8")
+            elif kind == UID:
+                data = int.from_bytes(data, "little")
+            yield Record(kind, timestamp, channel, data)
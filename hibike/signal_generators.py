@@ -0,0 +1,142 @@
+"""
+Time-varying parameter values for virtual devices.
+
+In ``virtual_device_defaults.json``, each param is either a constant or an
+object describing a generator::
+
+    {"type": "sine", "amplitude": 1, "offset": 0, "period": 2}
+    {"type": "ramp", "start": 0, "stop": 100, "period": 5}
+    {"type": "random_walk", "start": 0, "step": 0.01, "interval": 0.02, "min": -1, "max": 1}
+    {"type": "step", "values": [false, true], "period": 0.5}
+    {"type": "trace", "samples": [[0, 0.0], [0.1, 0.2]], "loop": true}
+    {"type": "trace", "file": "traces/pot.csv"}
+
+Times are in seconds. A ramp goes from ``start`` to ``stop`` over ``period``
+and starts again. A step generator holds each of ``values`` for ``period``.
+A random walk moves by up to ``step`` every ``interval`` (by default 20 ms)
+of elapsed time, however often it is read. A trace holds each recorded
+value until the next sample, and by default
+starts over once it runs out. Traces in a file are two-column CSV
+(time, value); relative paths are relative to this directory.
+
+``make_generator`` turns a constant or an object into a function from time
+to value.
+"""
+import bisect
+import csv
+import math
+import os
+import random
+
+__all__ = ["make_generator", "GENERATORS"]
+
+
+def constant(value):
+    """A value that never changes."""
+    return lambda _: value
+
+
+def sine(amplitude=1.0, offset=0.0, period=1.0, phase=0.0):
+    """A sine wave."""
+    return lambda t: offset + amplitude * math.sin(2 * math.pi * (t / period + phase))
+
+
+def ramp(start=0.0, stop=1.0, period=1.0):
+    """A sawtooth from START to STOP, repeating every PERIOD."""
+    return lambda t: start + (stop - start) * ((t / period) % 1)
+
+
+def stepped(values=(False, True), period=1.0):
+    """Cycle through VALUES, holding each for PERIOD."""
+    values = list(values)
+    return lambda t: values[int(t / period) % len(values)]
+
+
+# Default time in seconds between the steps of a random walk
+RANDOM_WALK_INTERVAL = 0.02
+
+
+class RandomWalk:
+    """
+    A value that moves by up to STEP_SIZE every INTERVAL seconds, staying
+    within [MINIMUM, MAXIMUM]. Its value depends only on the time it is read
+    at, not on how often it is read.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, rng, start=0.0, step_size=0.01, interval=RANDOM_WALK_INTERVAL,
+                 minimum=-math.inf, maximum=math.inf):
+        self.rng = rng
+        self.value = start
+        self.step_size = step_size
+        self.interval = interval
+        self.minimum = minimum
+        self.maximum = maximum
+        # Number of steps taken so far
+        self.steps = 0
+
+    def __call__(self, t):
+        # Catch up on every step due by T; reading at an earlier time changes nothing
+        for _ in range(self.steps, int(t / self.interval)):
+            self.value += self.rng.uniform(-self.step_size, self.step_size)
+            self.value = min(max(self.value, self.minimum), self.maximum)
+            self.steps += 1
+        return self.value
+
+
+def random_walk(rng, start=0.0, step=0.01, interval=RANDOM_WALK_INTERVAL, min=-math.inf,
+                max=math.inf):
+    # pylint: disable=redefined-builtin, too-many-arguments
+    """A random walk; see ``RandomWalk``."""
+    return RandomWalk(rng, start, step, interval, min, max)
+
+
+def load_trace(path):
+    """Read (time, value) samples from a CSV file."""
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    with open(path) as trace_file:
+        return [(float(row[0]), float(row[1])) for row in csv.reader(trace_file) if row]
+
+
+def trace(samples=None, file=None, loop=True):
+    # pylint: disable=redefined-builtin
+    """Replay recorded SAMPLES, or samples loaded from FILE."""
+    if file is not None:
+        samples = load_trace(file)
+    samples = sorted((float(t), value) for t, value in samples)
+    times = [t for t, _ in samples]
+    start, end = times[0], times[-1]
+    def value_at(t):
+        t += start
+        if loop and end > start:
+            t = start + (t - start) % (end - start)
+        return samples[max(bisect.bisect_right(times, t) - 1, 0)][1]
+    return value_at
+
+
+# Generator names in the defaults file, and whether they need a random number generator
+GENERATORS = {
+    "sine": (sine, False),
+    "ramp": (ramp, False),
+    "step": (stepped, False),
+    "random_walk": (random_walk, True),
+    "trace": (trace, False),
+}
+
+
+def make_generator(spec, rng=random):
+    """
+    Make a function from time in seconds to a param value out of SPEC,
+    a constant or a generator description from the defaults file.
+    """
+    if not isinstance(spec, dict):
+        return constant(spec)
+    spec = dict(spec)
+    kind = spec.pop("type")
+    try:
+        factory, needs_rng = GENERATORS[kind]
+    except KeyError as exc:
+        raise ValueError("Unknown generator type: {}".format(kind)) from exc
+    if needs_rng:
+        return factory(rng, **spec)
+    return factory(**spec)
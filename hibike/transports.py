@@ -0,0 +1,186 @@
+"""
+Transports that Hibike protocols can run on.
+
+``SmartSensorProtocol`` and ``VirtualDevice`` only use the parts of the
+``asyncio.Transport`` interface that every transport here provides, so they
+can talk over a real serial port (``serial_asyncio.SerialTransport``) or over
+an in-memory ``LoopbackTransport`` pair inside a single event loop::
+
+    (host_transport, host), (device_transport, device) = connect_loopback(
+        event_loop, make_host_protocol, make_device_protocol, "loop0")
+
+Use ``port_name`` rather than ``transport.serial.name`` to find out which
+port a transport is connected to.
+"""
+import asyncio
+
+__all__ = ["LoopbackTransport", "connect_loopback", "port_name"]
+
+
+def port_name(transport):
+    """
+    Return the name of the port under TRANSPORT, or None if it is closed.
+    """
+    serial = transport.get_extra_info("serial")
+    if serial is not None:
+        return serial.name
+    return transport.get_extra_info("port_name")
+
+
+# pylint: disable=too-many-instance-attributes
+class LoopbackTransport(asyncio.Transport):
+    """
+    One end of an in-memory byte pipe.
+
+    Bytes written to one end arrive at the protocol on the other end in a
+    later iteration of the event loop. Writes made in the same iteration
+    are delivered together, like a serial read returning several frames.
+
+    When emulating a link speed, bytes that have not arrived yet count as
+    buffered, and the writing protocol is paused and resumed around the
+    write buffer limits like on a real serial port.
+
+    :param event_loop: The event loop
+    :param str name: Port name reported by ``port_name``
+    :param bytes_per_sec: If given, delay delivery to emulate a link of this speed
+    """
+    def __init__(self, event_loop, name, bytes_per_sec=None):
+        super().__init__(extra={"port_name": name})
+        self._loop = event_loop
+        self._name = name
+        self._bytes_per_sec = bytes_per_sec
+        self._protocol = None
+        self._peer = None
+        self._closing = False
+        self._paused = False
+        self._inbound = bytearray()
+        self._flush_scheduled = False
+        # When the emulated link will have finished sending what was already written
+        self._busy_until = 0
+        # Bytes written that the emulated link has not delivered yet
+        self._buffered = 0
+        self._write_limits = (16 * 1024, 64 * 1024)
+        self._writing_paused = False
+        self.bytes_written = 0
+        self.writes = 0
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        if self._closing:
+            return
+        self.bytes_written += len(data)
+        self.writes += 1
+        if self._bytes_per_sec is None:
+            self._peer.feed_data(bytes(data))
+            return
+        now = self._loop.time()
+        self._busy_until = max(self._busy_until, now) + len(data) / self._bytes_per_sec
+        self._buffered += len(data)
+        self._loop.call_at(self._busy_until, self._deliver, bytes(data))
+        if not self._writing_paused and self._buffered > self._write_limits[1]:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def _deliver(self, data):
+        self._buffered -= len(data)
+        self._peer.feed_data(data)
+        if self._writing_paused and self._buffered <= self._write_limits[0] and not self._closing:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    def get_write_buffer_size(self):
+        return self._buffered
+
+    def get_write_buffer_limits(self):
+        return self._write_limits
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError("high ({}) must be >= low ({}) must be >= 0".format(high, low))
+        self._write_limits = (low, high)
+
+    def can_write_eof(self):
+        return False
+
+    def write_eof(self):
+        raise NotImplementedError("A loopback link cannot half-close")
+
+    def pause_reading(self):
+        self._paused = True
+
+    def resume_reading(self):
+        if self._paused:
+            self._paused = False
+            self._schedule_flush()
+
+    def is_reading(self):
+        return not self._paused and not self._closing
+
+    def feed_data(self, data):
+        """Deliver DATA written by the other end to this end's protocol."""
+        if self._closing:
+            return
+        self._inbound.extend(data)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and self._inbound and not self._paused:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._closing or self._paused or not self._inbound:
+            return
+        data, self._inbound = bytes(self._inbound), bytearray()
+        self._protocol.data_received(data)
+
+    def close(self):
+        """
+        Close both ends, as if the cable had been unplugged.
+        """
+        if self._closing:
+            return
+        self._closing = True
+        self._extra = {}
+        self._loop.call_soon(self._protocol.connection_lost, None)
+        self._peer.close()
+
+    def abort(self):
+        self.close()
+
+    def __repr__(self):
+        return "<LoopbackTransport {}>".format(self._name)
+
+
+def connect_loopback(event_loop, host_factory, device_factory, name, bytes_per_sec=None):
+    """
+    Create a protocol with each factory and connect them to each other.
+
+    Returns:
+        ``((host_transport, host_protocol), (device_transport, device_protocol))``
+    """
+    host_transport = LoopbackTransport(event_loop, name, bytes_per_sec)
+    device_transport = LoopbackTransport(event_loop, name, bytes_per_sec)
+    # pylint: disable=protected-access
+    host_transport._peer = device_transport
+    device_transport._peer = host_transport
+    host_protocol = host_factory()
+    device_protocol = device_factory()
+    host_transport.set_protocol(host_protocol)
+    device_transport.set_protocol(device_protocol)
+    host_protocol.connection_made(host_transport)
+    device_protocol.connection_made(device_transport)
+    return (host_transport, host_protocol), (device_transport, device_protocol)
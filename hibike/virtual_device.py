@@ -11,38 +11,57 @@ $ python3.5 virtual_device.py -d LimitSwitch -p /dev/pts/26
 import argparse
 import asyncio
 import json
+import os
 import random
 import struct
-import time
 
 # pylint: disable=import-error
 import serial_asyncio
 import hibike_message as hm
+from signal_generators import make_generator
 
 
 # Format of default values storage:
-# {"DeviceName": {"param1": value1, "param2": value2}}
-DEFAULT_VALUES_FILE = "virtual_device_defaults.json"
+# {"DeviceName": {"param1": value1, "param2": {"type": "sine", ...}}}
+# where each value is a constant or a generator (see signal_generators.py)
+DEFAULT_VALUES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "virtual_device_defaults.json")
 with open(DEFAULT_VALUES_FILE) as f:
     DEFAULT_VALUES = json.load(f)
 
+# How devices answer subscription requests:
+# "default" sends the requested params at the requested delay,
+# "stress" sends every param it can at the minimum delay
+PROFILES = ("default", "stress")
+STRESS_DELAY_MS = 1
+
+# Functions converting generated values to each param type
+TYPE_CONVERSIONS = {
+    "bool": bool,
+    "float": float,
+    "double": float,
+}
+
 
 class VirtualDevice(asyncio.Protocol):
     """
     A fake Hibike smart sensor.
     """
     HEARTBEAT_DELAY_MS = 100
-    PACKET_BOUNDARY = bytes([0])
-    def __init__(self, uid, event_loop, verbose=False):
+    def __init__(self, uid, event_loop, verbose=False, profile="default"):
         self.uid = uid
         self.event_loop = event_loop
         self._ready = asyncio.Event(loop=event_loop)
-        self.serial_buf = bytearray()
+        self.serial_buf = hm.PacketDeframer()
         self.read_queue = asyncio.Queue(loop=event_loop)
         self.verbose = verbose
+        self.profile = profile
 
-        self.update_time = 0
         self.delay = 0
+        # Loop time the next subscribed data update is due, and the timer for it
+        self.next_update = 0
+        self.update_handle = None
+        self.start_time = event_loop.time()
         self.transport = None
 
         self.response_map = {
@@ -51,28 +70,21 @@ class VirtualDevice(asyncio.Protocol):
             hm.MESSAGE_TYPES["DeviceRead"]: self._process_device_read,
             hm.MESSAGE_TYPES["DeviceWrite"]: self._process_device_write,
             hm.MESSAGE_TYPES["Disable"]: self._process_disable,
+            hm.MESSAGE_TYPES["HeartBeatRequest"]: self._process_heartbeat_request,
             hm.MESSAGE_TYPES["HeartBeatResponse"]: self._process_heartbeat_response,
         }
-        self.param_values = DEFAULT_VALUES[hm.uid_to_device_name(uid)]
-        self.subscribed_params = set()
+        rng = random.Random(uid)
+        self.param_values = {param: make_generator(spec, rng) for param, spec
+                             in DEFAULT_VALUES[hm.uid_to_device_name(uid)].items()}
+        self.subscribed_params = []
 
         event_loop.create_task(self.process_messages())
-        event_loop.create_task(self.send_subscribed_params())
         event_loop.create_task(self.request_heartbeats())
 
     def data_received(self, data):
-        self.serial_buf.extend(data)
-        zero_loc = self.serial_buf.find(bytes([0]))
-        if zero_loc != -1:
-            self.serial_buf = self.serial_buf[zero_loc:]
-            packet = hm.parse_bytes(self.serial_buf)
-            if packet != None:
-                self.serial_buf = self.serial_buf[1:]
-                self.read_queue.put_nowait(packet)
-            elif self.serial_buf.count(self.PACKET_BOUNDARY) > 1:
-                new_packet = self.serial_buf[1:].find(self.PACKET_BOUNDARY) + 1
-                self.serial_buf = self.serial_buf[new_packet:]
-
+        self.serial_buf.feed(data)
+        for packet in self.serial_buf.packets():
+            self.read_queue.put_nowait(packet)
 
     def verbose_log(self, fmt_string, *fmt_args):
         """Log a message if verbosity is enabled."""
@@ -89,24 +101,40 @@ class VirtualDevice(asyncio.Protocol):
                 continue
             self.response_map[msg_type](msg)
 
-    async def send_subscribed_params(self):
-        """Send values of subscribed parameters at a regular interval."""
-        await self._ready.wait()
+    def read_params(self, params):
+        """Return the current value of each of PARAMS, as (param, value) pairs."""
         device_id = hm.uid_to_device_id(self.uid)
-        while not self.transport.is_closing():
-            await asyncio.sleep(0.005, loop=self.event_loop)
-            if self.update_time != 0 and self.delay != 0:
-                if time.time() - self.update_time >= self.delay * 0.001:
-                    # If the time equal to the delay has elapsed since the previous device data,
-                    # send a device data with the device id
-                    # and the device's subscribed params and values
-                    data = []
-                    for param in self.subscribed_params:
-                        data.append((param, self.param_values[param]))
-                    hm.send(self.transport, hm.make_device_data(device_id, data))
-                    self.update_time = time.time()
-                    self.verbose_log("Regular data update sent from {}",
-                                     hm.uid_to_device_name(self.uid))
+        now = self.event_loop.time() - self.start_time
+        values = []
+        for param in params:
+            value = self.param_values[param](now)
+            param_type = hm.param_type(device_id, param)
+            values.append((param, TYPE_CONVERSIONS.get(param_type, round)(value)))
+        return values
+
+    def schedule_update(self, delay):
+        """Send subscribed params every DELAY milliseconds, or never if DELAY is 0."""
+        if self.update_handle is not None:
+            self.update_handle.cancel()
+            self.update_handle = None
+        self.delay = delay
+        if delay != 0:
+            self.next_update = self.event_loop.time() + delay / 1000
+            self.update_handle = self.event_loop.call_at(self.next_update, self.send_update)
+
+    def send_update(self):
+        """Send the values of subscribed params and schedule the next update."""
+        if self.transport.is_closing():
+            self.update_handle = None
+            return
+        device_id = hm.uid_to_device_id(self.uid)
+        hm.send(self.transport,
+                hm.make_device_data(device_id, self.read_params(self.subscribed_params)))
+        self.verbose_log("Regular data update sent from {}", hm.uid_to_device_name(self.uid))
+        # Schedule from the previous deadline so updates don't drift,
+        # but don't try to catch up on updates that were missed entirely
+        self.next_update = max(self.next_update + self.delay / 1000, self.event_loop.time())
+        self.update_handle = self.event_loop.call_at(self.next_update, self.send_update)
 
     async def request_heartbeats(self):
         """Request heartbeats on a regular basis."""
@@ -124,15 +152,18 @@ class VirtualDevice(asyncio.Protocol):
 
     def _process_sub_request(self, msg):
         """Respond to a subscription request with an appropriate response."""
-        self.update_time = time.time()
         dev_id = hm.uid_to_device_id(self.uid)
         self.verbose_log("Subscription request received")
         params, delay = struct.unpack("<HH", msg.get_payload())
         subscribed_params = hm.decode_params(dev_id, params)
+        if self.profile == "stress" and delay != 0:
+            subscribed_params = [param for param in hm.all_params_for_device_id(dev_id)
+                                 if hm.readable(dev_id, param) and param in self.param_values]
+            delay = STRESS_DELAY_MS
         hm.send(self.transport,
                 hm.make_subscription_response(dev_id, subscribed_params, delay, self.uid))
-        self.delay = delay
-        self.subscribed_params.update(set(subscribed_params))
+        self.subscribed_params = subscribed_params
+        self.schedule_update(delay)
 
     def _process_device_read(self, msg):
         self.verbose_log("Device read received")
@@ -140,13 +171,11 @@ class VirtualDevice(asyncio.Protocol):
         # Send a device data with the requested param and value tuples
         params, = struct.unpack("<H", msg.get_payload())
         read_params = hm.decode_params(device_id, params)
-        read_data = []
 
         for param in read_params:
             if not (hm.readable(device_id, param) and param in self.param_values):
                 raise ValueError("Tried to read unreadable parameter {}".format(param))
-            read_data.append((param, self.param_values[param]))
-        hm.send(self.transport, hm.make_device_data(device_id, read_data))
+        hm.send(self.transport, hm.make_device_data(device_id, self.read_params(read_params)))
 
     def _process_device_write(self, msg):
         # Write to requested parameters
@@ -158,7 +187,8 @@ class VirtualDevice(asyncio.Protocol):
         for (param, value) in write_params_and_values:
             if not (hm.writable(device_id, param) and param in self.param_values):
                 raise ValueError("Tried to write read-only parameter: {}".format(param))
-            self.param_values[param] = value
+            # A written value replaces the param's generator
+            self.param_values[param] = make_generator(value)
 
         updated_params = []
         for (param, value) in write_params_and_values:
@@ -169,6 +199,10 @@ class VirtualDevice(asyncio.Protocol):
     def _process_disable(self, msg):
         pass
 
+    def _process_heartbeat_request(self, msg):
+        """Answer a heartbeat request with the same id."""
+        hm.send(self.transport, hm.make_heartbeat_response(hm.parse_heartbeat(msg)))
+
     def _process_heartbeat_response(self, msg):
         pass
 
@@ -194,6 +228,8 @@ def main():
     parser.add_argument('-v', '--verbose',
                         help='print messages when sending and receiving packets',
                         action="store_true")
+    parser.add_argument('--profile', choices=PROFILES, default="default",
+                        help='how to answer subscription requests')
     args = parser.parse_args()
 
     def verbose_log(fmt_string, *fmt_args):
@@ -223,7 +259,7 @@ def main():
 
     def protocol_factory():
         """Create a VirtualDevice with filled-in parameters."""
-        return VirtualDevice(uid, event_loop, args.verbose)
+        return VirtualDevice(uid, event_loop, args.verbose, args.profile)
 
     event_loop.create_task(serial_asyncio.create_serial_connection(event_loop, protocol_factory,
                                                                    port, baudrate=115200))
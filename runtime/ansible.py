@@ -6,7 +6,6 @@ import time
 import sys
 import selectors
 import csv
-import runtime_pb2
 import ansible_pb2
 import notification_pb2
 from runtimeUtil import *
@@ -102,8 +101,8 @@ class UDPSendClass(AnsibleHandler):
     This class extends AnsibleHandler, which handles the constructor and starting threads.
     UDPSend runs in its own process which is started in runtime.py, and spawns two
     threads from this process. One thread is for packaging, and one thread is for sending.
-    The packaging thread pulls the current state from SM, and packages the sensor data
-    into a proto. It shares the data to the send thread via a TwoBuffer. The send thread
+    The packaging thread pulls the current state from SM, already packaged into a proto,
+    and shares it with the send thread via a TwoBuffer. The send thread
     sends the data over a UDP socket to Dawn on the UDP_SEND_PORT
     """
 
@@ -123,52 +122,17 @@ class UDPSendClass(AnsibleHandler):
             pipe)
 
     def package_data(self, bad_things_queue, state_queue, pipe):
-        """Function run as a thread that packages data to be sent.
+        """Function run as a thread that gets the packaged state to be sent.
 
-        The robot's current state is received from the StateManager via the pipe and packaged
-        by the package function, defined internally. The packaged data is then placed
-        back into the TwoBuffer replacing the previous state.
+        StateManager keeps the robot's current state serialized as a RuntimeData proto,
+        re-encoding only the devices that changed, and sends it through the pipe. The
+        packaged data is then placed into the TwoBuffer replacing the previous state.
         """
-        def package(state):
-            """Helper function that packages the current state.
-
-            Parses through the state dictionary in key value pairs, creates a new message in the
-            proto for each sensor, and adds corresponding data to each field. Currently only
-            supports a single limit_switch switch as the rest of the state is just test fields.
-            """
-            try:
-                proto_message = runtime_pb2.RuntimeData()
-                proto_message.robot_state = state['studentCodeState'][0]
-                for uid, values in state['hibike'][0]['devices'][0].items():
-                    sensor = proto_message.sensor_data.add()
-                    sensor.uid = str(uid)
-                    sensor.device_type = SENSOR_TYPE[uid >> 72]
-                    for param, value in values[0].items():
-                        if value[0] is None:
-                            continue
-                        param_value_pair = sensor.param_value.add()
-                        param_value_pair.param = param
-                        if isinstance(value[0], bool):
-                            param_value_pair.bool_value = value[0]
-                        elif isinstance(value[0], float):
-                            param_value_pair.float_value = value[0]
-                        elif isinstance(value[0], int):
-                            param_value_pair.int_value = value[0]
-                return proto_message.SerializeToString()
-            except Exception as e:
-                bad_things_queue.put(
-                    BadThing(
-                        sys.exc_info(),
-                        "UDP packager thread has crashed with error:" +
-                        str(e),
-                        event=BAD_EVENTS.UDP_SEND_ERROR,
-                        printStackTrace=True))
         while True:
             try:
                 next_call = time.time()
                 state_queue.put([SM_COMMANDS.SEND_ANSIBLE, []])
-                raw_state = pipe.recv()
-                pack_state = package(raw_state)
+                pack_state = pipe.recv()
                 self.send_buffer.replace(pack_state)
                 next_call += 1.0 / PACKAGER_HZ
                 time.sleep(max(next_call - time.time(), 0))
@@ -0,0 +1,140 @@
+"""Student code, compiled and checked once per version of its source.
+
+``compile_student_code`` compiles studentCode.py and checks it without
+running it: it records every top-level function (the entry-point table) and
+finds the mistakes runtime would otherwise only report when the robot is
+enabled, like a syntax error, a missing or ``async`` setup or main function,
+or a student overriding ``Robot``.
+
+``CodeCache`` keeps the result in ``__pycache__`` next to the source, keyed
+by a hash of the source, so every process that starts student code only
+reads and hashes the file and loads the code object. The hash also tells
+running student code whether an upload changed the code it runs.
+"""
+import ast
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+
+# Functions runtime calls for each mode
+ENTRY_POINTS = ("autonomous_setup", "autonomous_main", "teleop_setup", "teleop_main")
+# Names student code must not define, since runtime gives them to it
+API_NAMES = ("Robot",)
+# Prefix of cache file names; the source hash follows
+CACHE_PREFIX = "studentCode-"
+
+# SOURCE_HASH is the hex SHA-256 of the source. CODE is None if it does not
+# compile. ENTRY_POINTS is {function name: whether it is ``async def``} for
+# every function defined at the top level. ERRORS are messages for students.
+CompiledCode = collections.namedtuple(
+    "CompiledCode", ["source_hash", "code", "entry_points", "errors"])
+
+
+def student_code_path():
+    """Return where studentCode.py is."""
+    spec = importlib.util.find_spec("studentCode")
+    if spec is None or spec.origin is None:
+        raise ImportError("No module named 'studentCode'")
+    return spec.origin
+
+
+def source_hash(source):
+    """Return the key SOURCE, as bytes, is cached under."""
+    return hashlib.sha256(source).hexdigest()
+
+
+def assigned_names(node):
+    """Yield the top-level names a statement in a module binds."""
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        yield node.name
+    elif isinstance(node, (ast.Import, ast.ImportFrom)):
+        for alias in node.names:
+            yield (alias.asname or alias.name).split(".")[0]
+    elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+        targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+        for target in targets:
+            for name in ast.walk(target):
+                if isinstance(name, ast.Name):
+                    yield name.id
+
+
+def compile_student_code(source, path):
+    """Compile and check SOURCE, the bytes of the student code at PATH. Returns `CompiledCode`."""
+    try:
+        tree = compile(source, path, "exec", ast.PyCF_ONLY_AST)
+        code = compile(tree, path, "exec")
+    except (SyntaxError, ValueError) as e:
+        return CompiledCode(source_hash(source), None, {},
+                            ["Student code has a syntax error: {}".format(e)])
+
+    entry_points = {}
+    errors = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            entry_points[node.name] = isinstance(node, ast.AsyncFunctionDef)
+        for name in assigned_names(node):
+            if name in API_NAMES:
+                errors.append(
+                    "Student code overrides `{}`, which is part of the API".format(name))
+    for name in ENTRY_POINTS:
+        if name not in entry_points:
+            errors.append("Student code failed to define '{}'".format(name))
+        elif entry_points[name]:
+            errors.append("{} is defined with `async def` instead of `def`".format(name))
+    return CompiledCode(source_hash(source), code, entry_points, errors)
+
+
+class CodeCache:
+    """
+    Compiled student code, in files in DIRECTORY (by default, ``__pycache__``
+    next to the source) named by the hash of the source.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def _cache_path(self, path, key):
+        directory = self.directory or os.path.join(os.path.dirname(path), "__pycache__")
+        return os.path.join(directory, CACHE_PREFIX + key)
+
+    def get(self, path):
+        """
+        Return `CompiledCode` for the source at PATH, compiling and caching
+        it if this version has not been seen yet.
+        """
+        with open(path, "rb") as source_file:
+            source = source_file.read()
+        key = source_hash(source)
+        cache_path = self._cache_path(path, key)
+        try:
+            with open(cache_path, "rb") as cache_file:
+                magic = cache_file.read(len(importlib.util.MAGIC_NUMBER))
+                if magic == importlib.util.MAGIC_NUMBER:
+                    return CompiledCode(key, *marshal.load(cache_file))
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        compiled = compile_student_code(source, path)
+        self._store(cache_path, compiled)
+        return compiled
+
+    @staticmethod
+    def _store(cache_path, compiled):
+        """
+        Write COMPILED to CACHE_PATH, so readers never see half a file, and
+        remove the code of older versions.
+        """
+        directory, name = os.path.split(cache_path)
+        temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(temp_path, "wb") as cache_file:
+                cache_file.write(importlib.util.MAGIC_NUMBER)
+                marshal.dump(tuple(compiled[1:]), cache_file)
+            os.replace(temp_path, cache_path)
+            for old_name in os.listdir(directory):
+                if old_name.startswith(CACHE_PREFIX) and old_name != name:
+                    os.remove(os.path.join(directory, old_name))
+        except OSError:
+            # Not being able to cache only makes the next start slower
+            pass
@@ -1,29 +1,40 @@
 import argparse
 import asyncio
+import contextlib
 import filecmp
+import importlib.util
 import inspect
 import multiprocessing
+import multiprocessing.forkserver
 import os
 import re
 import signal
 import sys
+import time
 import traceback
 import warnings
 
 from ansible import TCPClass, UDPRecvClass, UDPSendClass
+from codecache import CodeCache, student_code_path
 import runtime_pb2
 from runtimeUtil import (
     BAD_EVENTS,
     BadThing,
     HIBIKE_COMMANDS,
     PROCESS_NAMES,
+    process_ready,
+    process_spawned,
     restartEvents,
     RUNTIME_CONFIG,
     SM_COMMANDS,
     StudentAPIError,
 )
+import sampling_profiler
+from sensortable import SENSOR_TABLE_ENV, SensorTable
 from statemanager import StateManager
-from studentapi import Actions, Gamepad, Robot
+from statequeue import StateQueue
+from studentapi import Actions, Gamepad, Robot, StateCache
+from tickscheduler import OVERRUN_POLICIES, TickScheduler
 
 COROUTINE_WARNING = """
 The PiE API has upgraded the above RuntimeWarning to a runtime error!
@@ -54,6 +65,21 @@ Consider instead:
 
 ALL_PROCESSES = {}
 
+# Where StateManager puts the source hash of the latest student code upload
+UPLOAD_HASH_PATH = ("runtime_meta", "uploaded_code_hash")
+# Student code, compiled and checked once per version
+CODE_CACHE = CodeCache()
+# Ways process_factory can start child processes
+START_METHODS = ("fork", "forkserver")
+# Modules the forkserver imports once, before it starts any children. "runtime"
+# imports everything this file does; preloading "__main__" is broken before Python 3.12.
+FORKSERVER_PRELOAD = ("runtime", "hibike_process")
+# Times per second the main function of each mode runs; tests use RUNTIME_CONFIG.STUDENT_CODE_HZ
+STUDENT_CODE_HZ = {"autonomous": RUNTIME_CONFIG.STUDENT_CODE_HZ.value,
+                   "teleop": RUNTIME_CONFIG.STUDENT_CODE_HZ.value}
+# Time in seconds between publishing the tick stats of the running student code
+TICK_STATS_INTERVAL = 1
+
 
 def print_version():
     version_numbers = (
@@ -64,8 +90,19 @@ def print_version():
     print('.'.join([str(n.value) for n in version_numbers]))
 
 
-# pylint: disable=too-many-branches
-def runtime(test_name=""): # pylint: disable=too-many-statements
+# pylint: disable=too-many-branches, too-many-locals
+def runtime(test_name="", start_method="fork", # pylint: disable=too-many-statements
+            preload=FORKSERVER_PRELOAD, student_code_hz=None, overrun_policy="warn"):
+    """Run runtime, starting child processes with START_METHOD.
+
+    With "forkserver", one server process imports the PRELOAD modules and every
+    child is forked from it, instead of from runtime itself.
+
+    STUDENT_CODE_HZ maps modes to how often their main function runs, over
+    the defaults in `STUDENT_CODE_HZ`. OVERRUN_POLICY is what student code does
+    when its main function keeps missing deadlines; see `tickscheduler`.
+    """
+    mode_hz = dict(STUDENT_CODE_HZ, **(student_code_hz or {}))
     test_mode = test_name != ""
     max_iter = 3 if test_mode else None
 
@@ -74,9 +111,39 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
         if not test_mode:
             print(args)
 
-    bad_things_queue = multiprocessing.Queue()
-    state_queue = multiprocessing.Queue()
-    spawn_process = process_factory(bad_things_queue, state_queue)
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        # The forkserver starts with our sys.path, so it can preload hibike too
+        add_hibike_path()
+        context.set_forkserver_preload(list(preload))
+    bad_things_queue = context.Queue()
+    state_queue = StateQueue(context)
+    # Children find the sensor table through the environment, which the
+    # forkserver copies when it starts with the first child
+    sensor_table = SensorTable.create()
+    if sensor_table is not None:
+        os.environ[SENSOR_TABLE_ENV] = sensor_table.name
+    if start_method == "forkserver":
+        # Children hold profiler signals sent before they install the profiler,
+        # rather than being killed by them, if the forkserver starts with them blocked
+        sampling_profiler.block_signals()
+        multiprocessing.forkserver.ensure_running()
+    spawn_process = process_factory(bad_things_queue, state_queue, context=context)
+    sampling_profiler.install(PROCESS_NAMES.RUNTIME.value)
+
+    def start_student_code(name, iterations=None):
+        """Run student code in the warm standby process, if there is one, and prepare the next."""
+        rate_hz = mode_hz.get(name, RUNTIME_CONFIG.STUDENT_CODE_HZ.value)
+        standby = ALL_PROCESSES.pop(PROCESS_NAMES.STUDENT_CODE_STANDBY, None)
+        if standby is not None and standby.is_alive():
+            ALL_PROCESSES[PROCESS_NAMES.STUDENT_CODE] = standby
+            state_queue.put([SM_COMMANDS.PROMOTE_STANDBY,
+                             [name, iterations, rate_hz, overrun_policy]])
+        else:
+            spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, iterations,
+                          rate_hz, overrun_policy)
+        spawn_process(PROCESS_NAMES.STUDENT_CODE_STANDBY, run_standby_student_code)
+
     restart_count = 0
     emergency_stopped = False
 
@@ -84,6 +151,7 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
         spawn_process(PROCESS_NAMES.STATE_MANAGER, start_state_manager)
         spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver)
         spawn_process(PROCESS_NAMES.HIBIKE, start_hibike)
+        spawn_process(PROCESS_NAMES.STUDENT_CODE_STANDBY, run_standby_student_code)
         control_state = "idle"
         dawn_connected = False
 
@@ -123,18 +191,29 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
                     break
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_TELEOP and control_state != "teleop":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
-                    name = test_name or "teleop"
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, max_iter)
+                    start_student_code(test_name or "teleop", max_iter)
                     control_state = "teleop"
                     continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_AUTO and control_state != "auto":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, "autonomous")
+                    start_student_code("autonomous")
                     control_state = "auto"
                     continue
+                elif (new_bad_thing.event == BAD_EVENTS.STUDENT_CODE_RELOAD and
+                      control_state != "idle"):
+                    # Hot reload failed; a new process reports any error in the new code
+                    terminate_process(PROCESS_NAMES.STUDENT_CODE)
+                    if control_state == "teleop":
+                        start_student_code(test_name or "teleop", max_iter)
+                    else:
+                        start_student_code("autonomous")
+                    continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_IDLE and control_state != "idle":
                     control_state = "idle"
                     break
+                elif new_bad_thing.event == BAD_EVENTS.PROFILE:
+                    toggle_profiling(*new_bad_thing.data)
+                    continue
                 print(new_bad_thing.event)
                 non_test_mode_print(new_bad_thing.data)
                 if new_bad_thing.event in restartEvents:
@@ -152,6 +231,7 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
                 runtime_pb2.RuntimeData.STUDENT_STOPPED, ["studentCodeState"], False]])
             state_queue.put([SM_COMMANDS.END_STUDENT_CODE, []])
             state_queue.put([HIBIKE_COMMANDS.DISABLE, []])
+        terminate_process(PROCESS_NAMES.STUDENT_CODE_STANDBY)
         non_test_mode_print(RUNTIME_CONFIG.DEBUG_DELIMITER_STRING.value)
         print("Funtime Runtime is done having fun.")
         print("TERMINATING")
@@ -160,159 +240,288 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
         print("Funtime Runtime had too much fun.")
         print(e)
         print("".join(traceback.format_tb(sys.exc_info()[2])))
+    finally:
+        if sensor_table is not None:
+            del os.environ[SENSOR_TABLE_ENV]
+            sensor_table.close()
+            sensor_table.unlink()
 
 
-def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None): # pylint: disable=too-many-locals
-    try:
-        terminated = False
+def student_code_stamp(source_path=None):
+    """Return what identifies the current version of the files student code is loaded from.
 
-        def sig_term_handler(*_):
-            nonlocal terminated
-            terminated = True
-        signal.signal(signal.SIGTERM, sig_term_handler)
+    SOURCE_PATH is where studentCode.py is, if it has already been found.
+    """
+    stamp = []
+    if source_path is None:
+        spec = importlib.util.find_spec("studentCode")
+        source_path = spec and spec.origin
+    for path in (source_path, "namedPeripherals.csv"):
+        try:
+            stat = os.stat(path)
+            stamp.append((stat.st_mtime_ns, stat.st_size))
+        except (OSError, TypeError):
+            stamp.append(None)
+    return stamp
 
-        def timed_out_handler(*_):
-            raise TimeoutError("studentCode timed out")
-        signal.signal(signal.SIGALRM, timed_out_handler)
 
-        def check_timed_out(func, *args):
-            signal.alarm(RUNTIME_CONFIG.STUDENT_CODE_TIMELIMIT.value)
-            func(*args)
-            signal.alarm(0)
+def load_student_code(state_queue, pipe):
+    """Import studentCode and give it the student API. Returns it and its ``StateCache``."""
+    def timed_out_handler(*_):
+        raise TimeoutError("studentCode timed out")
+    signal.signal(signal.SIGALRM, timed_out_handler)
 
-        signal.alarm(RUNTIME_CONFIG.STUDENT_CODE_TIMELIMIT.value)
-        try:
-            import studentCode
-        except SyntaxError as e:
-            raise RuntimeError("Student code has a syntax error: {}".format(e))
-        signal.alarm(0)
+    student_code = exec_student_code(student_code_path())
+    ensure_not_overridden(student_code, "Robot")
 
-        if test_name != "":
-            test_name += "_"
-        try:
-            setup_fn = getattr(studentCode, test_name + "setup")
-        except AttributeError:
-            raise RuntimeError(
-                "Student code failed to define '{}'".format(test_name + "setup"))
+    state_cache = StateCache(state_queue, pipe)
+    robot = Robot(state_queue, pipe, make_func_map(student_code), state_cache)
+    attach_student_api(student_code, robot, Gamepad(state_queue, pipe, state_cache))
+    return student_code, state_cache
+
+
+def reload_student_code(student_code):
+    """Run the current studentCode.py in a new module that shares the API objects of STUDENT_CODE.
+
+    Returns the new module. Raises whatever importing the new code would, or
+    if it overrides the API.
+    """
+    robot, gamepad = student_code.Robot, student_code.Gamepad
+    module = exec_student_code(student_code.__file__)
+    ensure_not_overridden(module, "Robot")
+
+    # pylint: disable=protected-access
+    robot._stop_coroutines()
+    robot._create_sensor_mapping()
+    robot.func_map = make_func_map(module)
+    attach_student_api(module, robot, gamepad)
+    return module
+
+
+def exec_student_code(path):
+    """Run the student code at PATH, compiled by `CODE_CACHE`, as a new studentCode module.
+
+    The module's ``__source_hash__`` is the hash of the source it was run from.
+    """
+    compiled = CODE_CACHE.get(path)
+    if compiled.code is None:
+        raise RuntimeError(compiled.errors[0])
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_file_location("studentCode", path))
+    signal.alarm(RUNTIME_CONFIG.STUDENT_CODE_TIMELIMIT.value)
+    try:
+        exec(compiled.code, module.__dict__) # pylint: disable=exec-used
+    finally:
+        signal.alarm(0)
+    module.__source_hash__ = compiled.source_hash
+    sys.modules[module.__name__] = module
+    return module
+
+
+def make_func_map(student_code):
+    """Return the functions Solar Scramble power-up codes are generated with."""
+    # Solar Scramble specific handling
+    def stub_out(funcname):
+        def stub(_):
+            line1 = "Failed to generate power-up code: "
+            line2 = "you haven't defined {}".format(funcname)
+            raise AttributeError(line1 + line2)
+        return stub
+
+    def get_or_stub_out(funcname):
         try:
-            main_fn = getattr(studentCode, test_name + "main")
+            return getattr(student_code, funcname)
         except AttributeError:
-            raise RuntimeError(
-                "Student code failed to define '{}'".format(test_name + "main"))
-
-        ensure_is_function(test_name + "setup", setup_fn)
-        ensure_is_function(test_name + "main", main_fn)
-        ensure_not_overridden(studentCode, "Robot")
-
-        # Solar Scramble specific handling
-        def stub_out(funcname):
-            def stub(_):
-                line1 = "Failed to generate power-up code: "
-                line2 = "you haven't defined {}".format(funcname)
-                raise AttributeError(line1 + line2)
-            return stub
-
-        def get_or_stub_out(funcname):
-            try:
-                return getattr(studentCode, funcname)
-            except AttributeError:
-                return stub_out(funcname)
-
-        def identity(value):
-            '''
-            Used only in the (hopefully) rare event that none of the other
-            functions are bijections with a given domain of RFIDs
-            '''
-            return value
-
-        def limit_input_to(limit):
-            '''Generate a function to limit size of inputs'''
-            def retval(input_val):
-                while input_val > limit:
-                    input_val = (input_val % limit) + (input_val // limit)
-                return input_val
-            return retval
-
-        def compose_funcs(func_a, func_b):
-            '''
-            Composes two single-input functions together, A(B(x))
-            '''
-            return lambda x: func_a(func_b(x))
-
-        next_power = get_or_stub_out("next_power")
-        reverse_digits = get_or_stub_out("reverse_digits")
-        smallest_prime_fact = get_or_stub_out("smallest_prime_fact")
-        double_caesar_cipher = get_or_stub_out("double_caesar_cipher")
-        silly_base_two = get_or_stub_out("silly_base_two")
-        most_common_digit = get_or_stub_out("most_common_digit")
-        valid_isbn_ten = get_or_stub_out("valid_isbn_ten")
-        simd_four_square = get_or_stub_out("simd_four_square")
-
-        func_map = [
-            identity,
-            next_power,
-            reverse_digits,
-            compose_funcs(smallest_prime_fact, limit_input_to(1000000)),
-            double_caesar_cipher,
-            silly_base_two,
-            most_common_digit,
-            valid_isbn_ten,
-            simd_four_square
-        ]
-
-        studentCode.Robot = Robot(state_queue, pipe, func_map)
-        studentCode.Gamepad = Gamepad(state_queue, pipe)
-        studentCode.Actions = Actions
-        studentCode.print = studentCode.Robot._print # pylint: disable=protected-access
-
-        # remapping for non-class student API commands
-        studentCode.get_gamepad_value = studentCode.Gamepad.get_value
-        studentCode.get_robot_value = studentCode.Robot.get_value
-        studentCode.set_robot_value = studentCode.Robot.set_value
-        studentCode.is_robot_running = studentCode.Robot.is_running
-        studentCode.run_async = studentCode.Robot.run
-        studentCode.sleep_duration = studentCode.Actions.sleep
-
-        check_timed_out(setup_fn)
-
-        exception_cell = [None]
-        clarify_coroutine_warnings(exception_cell)
-
-        async def main_loop():
-            exec_count = 0
-            while not terminated and (exception_cell[0] is None) and (
-                    max_iter is None or exec_count < max_iter):
-                next_call = loop.time() + 1. / RUNTIME_CONFIG.STUDENT_CODE_HZ.value
-                studentCode.Robot._get_all_sensors() # pylint: disable=protected-access
-                studentCode.Gamepad._get_gamepad() # pylint: disable=protected-access
-                check_timed_out(main_fn)
-
-                # Throttle sending print statements
-                if (exec_count % 5) == 0:
-                    studentCode.Robot._send_prints() # pylint: disable=protected-access
-
-                sleep_time = max(next_call - loop.time(), 0.)
-                state_queue.put([SM_COMMANDS.STUDENT_MAIN_OK, []])
-                exec_count += 1
-                await asyncio.sleep(sleep_time)
-            if exception_cell[0] is not None:
-                raise exception_cell[0] # pylint: disable=raising-bad-type
-            if not terminated:
-                bad_things_queue.put(
-                    BadThing(
-                        sys.exc_info(),
-                        "Process Ended",
-                        event=BAD_EVENTS.END_EVENT))
+            return stub_out(funcname)
+
+    def identity(value):
+        '''
+        Used only in the (hopefully) rare event that none of the other
+        functions are bijections with a given domain of RFIDs
+        '''
+        return value
+
+    def limit_input_to(limit):
+        '''Generate a function to limit size of inputs'''
+        def retval(input_val):
+            while input_val > limit:
+                input_val = (input_val % limit) + (input_val // limit)
+            return input_val
+        return retval
+
+    def compose_funcs(func_a, func_b):
+        '''
+        Composes two single-input functions together, A(B(x))
+        '''
+        return lambda x: func_a(func_b(x))
+
+    next_power = get_or_stub_out("next_power")
+    reverse_digits = get_or_stub_out("reverse_digits")
+    smallest_prime_fact = get_or_stub_out("smallest_prime_fact")
+    double_caesar_cipher = get_or_stub_out("double_caesar_cipher")
+    silly_base_two = get_or_stub_out("silly_base_two")
+    most_common_digit = get_or_stub_out("most_common_digit")
+    valid_isbn_ten = get_or_stub_out("valid_isbn_ten")
+    simd_four_square = get_or_stub_out("simd_four_square")
+
+    func_map = [
+        identity,
+        next_power,
+        reverse_digits,
+        compose_funcs(smallest_prime_fact, limit_input_to(1000000)),
+        double_caesar_cipher,
+        silly_base_two,
+        most_common_digit,
+        valid_isbn_ten,
+        simd_four_square
+    ]
+
+    return func_map
+
+
+def attach_student_api(student_code, robot, gamepad):
+    """Give the studentCode module ROBOT, GAMEPAD and the rest of the student API."""
+    student_code.Robot = robot
+    student_code.Gamepad = gamepad
+    student_code.Actions = Actions
+    student_code.print = student_code.Robot._print # pylint: disable=protected-access
+
+    # remapping for non-class student API commands
+    student_code.get_gamepad_value = student_code.Gamepad.get_value
+    student_code.get_robot_value = student_code.Robot.get_value
+    student_code.set_robot_value = student_code.Robot.set_value
+    student_code.is_robot_running = student_code.Robot.is_running
+    student_code.run_async = student_code.Robot.run
+    student_code.sleep_duration = student_code.Actions.sleep
+
+
+def student_code_functions(student_code, test_name=""):
+    """Return the setup and main functions of TEST_NAME in student code."""
+    if test_name != "":
+        test_name += "_"
+    try:
+        setup_fn = getattr(student_code, test_name + "setup")
+    except AttributeError:
+        raise RuntimeError(
+            "Student code failed to define '{}'".format(test_name + "setup"))
+    try:
+        main_fn = getattr(student_code, test_name + "main")
+    except AttributeError:
+        raise RuntimeError(
+            "Student code failed to define '{}'".format(test_name + "main"))
+
+    ensure_is_function(test_name + "setup", setup_fn)
+    ensure_is_function(test_name + "main", main_fn)
+    return setup_fn, main_fn
 
-        loop = asyncio.get_event_loop()
 
-        def my_exception_handler(_loop, context):
-            if exception_cell[0] is None:
-                exception_cell[0] = context["exception"]
+# pylint: disable=too-many-arguments, too-many-locals, too-many-statements
+def run_loaded_student_code(bad_things_queue, state_queue, student_code, state_cache,
+                            test_name="", max_iter=None,
+                            rate_hz=RUNTIME_CONFIG.STUDENT_CODE_HZ.value,
+                            overrun_policy="warn"):
+    """Run the setup and main functions of TEST_NAME in student code from `load_student_code`.
+
+    The main function runs RATE_HZ times per second on a `TickScheduler` with
+    OVERRUN_POLICY, whose stats are published to ("runtime_meta", "student_loop").
+
+    When StateManager reports an upload of different code at `UPLOAD_HASH_PATH`,
+    the new code is loaded between ticks with `reload_student_code` and its
+    setup is run. If that fails, runtime is asked to start a new process instead.
+    """
+    terminated = False
+
+    def sig_term_handler(*_):
+        nonlocal terminated
+        terminated = True
+    signal.signal(signal.SIGTERM, sig_term_handler)
 
-        loop.set_exception_handler(my_exception_handler)
-        loop.run_until_complete(main_loop())
+    def check_timed_out(func, *args):
+        signal.alarm(RUNTIME_CONFIG.STUDENT_CODE_TIMELIMIT.value)
+        func(*args)
+        signal.alarm(0)
 
+    setup_fn, main_fn = student_code_functions(student_code, test_name)
+    check_timed_out(setup_fn)
+    # The refresh every tick brings any upload StateManager is told about
+    state_cache.track(*UPLOAD_HASH_PATH)
+
+    exception_cell = [None]
+    clarify_coroutine_warnings(exception_cell)
+
+    def send_console(message):
+        state_queue.put([SM_COMMANDS.SEND_CONSOLE, [message + "\n"]])
+
+    def publish_tick_stats():
+        state_queue.put([SM_COMMANDS.SET_VAL,
+                         [scheduler.summary(), ["runtime_meta", "student_loop"], False]])
+
+    async def main_loop():
+        nonlocal student_code, setup_fn, main_fn
+        exec_count = 0
+        # The upload hash last acted on, so each upload is reloaded at most once
+        handled_upload = None
+        published_at = loop.time()
+        while not terminated and (exception_cell[0] is None) and (
+                max_iter is None or exec_count < max_iter):
+            scheduler.tick_started()
+            state_cache.refresh()
+            uploaded = state_cache.get(*UPLOAD_HASH_PATH)
+            if uploaded != handled_upload:
+                handled_upload = uploaded
+                if uploaded not in (None, student_code.__source_hash__):
+                    # Swap in the uploaded code between ticks
+                    try:
+                        student_code = reload_student_code(student_code)
+                        setup_fn, main_fn = student_code_functions(student_code, test_name)
+                    except Exception: # pylint: disable=broad-except
+                        event = BAD_EVENTS.STUDENT_CODE_RELOAD
+                        bad_things_queue.put(BadThing(sys.exc_info(), event.value, event=event,
+                                                      printStackTrace=False))
+                        return
+                    check_timed_out(setup_fn)
+            main_started = loop.time()
+            check_timed_out(main_fn)
+            main_duration = loop.time() - main_started
+
+            # Throttle sending print statements
+            if (exec_count % 5) == 0:
+                student_code.Robot._send_prints() # pylint: disable=protected-access
+            if loop.time() - published_at >= TICK_STATS_INTERVAL:
+                publish_tick_stats()
+                published_at = loop.time()
+
+            state_queue.put([SM_COMMANDS.STUDENT_MAIN_OK, []])
+            exec_count += 1
+            await asyncio.sleep(scheduler.tick_finished(main_duration))
+        publish_tick_stats()
+        if exception_cell[0] is not None:
+            raise exception_cell[0] # pylint: disable=raising-bad-type
+        if not terminated:
+            bad_things_queue.put(
+                BadThing(
+                    sys.exc_info(),
+                    "Process Ended",
+                    event=BAD_EVENTS.END_EVENT))
+
+    loop = asyncio.get_event_loop()
+    scheduler = TickScheduler(rate_hz, overrun_policy,
+                              name=test_name + "_main" if test_name else "main",
+                              warn=send_console, clock=loop.time)
+
+    def my_exception_handler(_loop, context):
+        if exception_cell[0] is None:
+            exception_cell[0] = context["exception"]
+
+    loop.set_exception_handler(my_exception_handler)
+    loop.run_until_complete(main_loop())
+
+
+@contextlib.contextmanager
+def reporting_student_code_errors(bad_things_queue):
+    """Report anything raised while loading or running student code to runtime."""
+    try:
+        yield
     except TimeoutError:
         event = BAD_EVENTS.STUDENT_CODE_TIMEOUT
         bad_things_queue.put(BadThing(sys.exc_info(), event.value, event=event))
@@ -323,9 +532,45 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STUDENT_CODE_ERROR))
 
 
+# pylint: disable=too-many-arguments
+def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None,
+                     rate_hz=RUNTIME_CONFIG.STUDENT_CODE_HZ.value, overrun_policy="warn"):
+    with reporting_student_code_errors(bad_things_queue):
+        student_code, state_cache = load_student_code(state_queue, pipe)
+        process_ready(state_queue)
+        run_loaded_student_code(bad_things_queue, state_queue, student_code, state_cache,
+                                test_name, max_iter, rate_hz, overrun_policy)
+
+
+def run_standby_student_code(bad_things_queue, state_queue, pipe):
+    """Load student code ahead of time, then run it once StateManager promotes this process.
+
+    Errors while loading are only reported once the code is supposed to run. If student
+    code was uploaded in the meantime, it is loaded again before running.
+    """
+    stamp = student_code_stamp()
+    loaded, load_error = None, None
+    try:
+        loaded = load_student_code(state_queue, pipe)
+    except Exception as e: # pylint: disable=broad-except
+        load_error = e
+    process_ready(state_queue)
+    test_name, max_iter, rate_hz, overrun_policy = pipe.recv()
+    multiprocessing.current_process().name = PROCESS_NAMES.STUDENT_CODE.value
+    sampling_profiler.install(PROCESS_NAMES.STUDENT_CODE.value)
+    with reporting_student_code_errors(bad_things_queue):
+        if student_code_stamp() != stamp:
+            loaded = load_student_code(state_queue, pipe)
+        elif load_error is not None:
+            raise load_error
+        run_loaded_student_code(bad_things_queue, state_queue, *loaded, test_name, max_iter,
+                                rate_hz, overrun_policy)
+
+
 def start_state_manager(bad_things_queue, state_queue, runtime_pipe):
     try:
         state_manager = StateManager(bad_things_queue, state_queue, runtime_pipe)
+        process_ready(state_queue)
         state_manager.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STATE_MANAGER_CRASH))
@@ -334,6 +579,7 @@ def start_state_manager(bad_things_queue, state_queue, runtime_pipe):
 def start_udp_sender(bad_things_queue, state_queue, sm_pipe):
     try:
         send_class = UDPSendClass(bad_things_queue, state_queue, sm_pipe)
+        process_ready(state_queue)
         send_class.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.UDP_SEND_ERROR))
@@ -342,6 +588,7 @@ def start_udp_sender(bad_things_queue, state_queue, sm_pipe):
 def start_udp_receiver(bad_things_queue, state_queue, sm_pipe):
     try:
         recv_class = UDPRecvClass(bad_things_queue, state_queue, sm_pipe)
+        process_ready(state_queue)
         recv_class.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.UDP_RECV_ERROR))
@@ -350,19 +597,54 @@ def start_udp_receiver(bad_things_queue, state_queue, sm_pipe):
 def start_tcp(bad_things_queue, state_queue, sm_pipe):
     try:
         tcp_class = TCPClass(bad_things_queue, state_queue, sm_pipe)
+        process_ready(state_queue)
         tcp_class.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.TCP_ERROR))
 
 
-def process_factory(bad_things_queue, state_queue, _stdout_redirect=None):
+# pylint: disable=too-many-arguments
+def run_profilable(process_name, spawned_at, helper, bad_things_queue, state_queue, *args):
+    """Run HELPER in a child process that can be profiled on request.
+
+    SPAWNED_AT is ``time.monotonic()`` in runtime when the process was spawned.
+    HELPER calls `process_ready` once it is ready to work, which tells
+    StateManager how long the process took to start.
+    """
+    process_spawned(process_name, spawned_at)
+    sampling_profiler.install(process_name)
+    helper(bad_things_queue, state_queue, *args)
+
+
+def toggle_profiling(process_name, start):
+    """Start or stop the sampling profiler in PROCESS_NAME, or in every running process if None."""
+    if process_name is not None:
+        process_name = PROCESS_NAMES(getattr(process_name, "value", process_name))
+    pids = {name: process.pid for name, process in ALL_PROCESSES.items() if process.is_alive()}
+    pids[PROCESS_NAMES.RUNTIME] = os.getpid()
+    for name, pid in pids.items():
+        if process_name is None or name == process_name:
+            try:
+                sampling_profiler.signal_process(pid, start)
+            except ProcessLookupError:
+                # It exited since it was checked
+                pass
+
+
+def process_factory(bad_things_queue, state_queue, _stdout_redirect=None, context=multiprocessing):
+    """Return a function that starts child processes with CONTEXT.
+
+    The queues must come from the same CONTEXT.
+    """
     def spawn_process_helper(process_name, helper, *args):
-        pipe_to_child, pipe_from_child = multiprocessing.Pipe()
+        pipe_to_child, pipe_from_child = context.Pipe()
         if process_name != PROCESS_NAMES.STATE_MANAGER:
             state_queue.put([SM_COMMANDS.ADD, [process_name, pipe_to_child]], block=True)
             pipe_from_child.recv()
-        new_process = multiprocessing.Process(target=helper, name=process_name.value, args=[
-            bad_things_queue, state_queue, pipe_from_child] + list(args))
+        new_process = context.Process(
+            target=run_profilable, name=process_name.value,
+            args=[process_name.value, time.monotonic(), helper, bad_things_queue, state_queue,
+                  pipe_from_child] + list(args))
         ALL_PROCESSES[process_name] = new_process
         new_process.daemon = True
         new_process.start()
@@ -457,20 +739,22 @@ def test_success(test_file_name):
     return filecmp.cmp(expected_output, test_output)
 
 
+def add_hibike_path():
+    """Modify sys.path so we can find hibike.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    parent_path = path.rstrip("runtime")
+    hibike = os.path.join(parent_path, "hibike")
+    if hibike not in sys.path:
+        sys.path.insert(1, hibike)
+
+
 def start_hibike(bad_things_queue, state_queue, pipe):
     # bad_things_queue - queue to runtime
     # state_queue - queue to StateManager
     # pipe - pipe from statemanager
-    def add_paths():
-        """Modify sys.path so we can find hibike.
-        """
-        path = os.path.dirname(os.path.abspath(__file__))
-        parent_path = path.rstrip("runtime")
-        hibike = os.path.join(parent_path, "hibike")
-        sys.path.insert(1, hibike)
-
     try:
-        add_paths()
+        add_hibike_path()
         import hibike_process # pylint: disable=import-error
         hibike_process.hibike_process(bad_things_queue, state_queue, pipe)
     except Exception as e:
@@ -517,11 +801,27 @@ def main():
                         help="Run specified tests. If no arguments, run all tests.")
     parser.add_argument('-v', '--version', action='store_true',
                         help='Print the version and exit.')
+    parser.add_argument("--start-method", choices=START_METHODS, default="fork",
+                        help="How to start child processes. 'forkserver' imports the "
+                             "preloaded modules once and forks every child from a clean server.")
+    parser.add_argument("--preload", nargs="*", default=FORKSERVER_PRELOAD, metavar="MODULE",
+                        help="Modules the forkserver imports before starting children.")
+    parser.add_argument("--autonomous-hz", type=float, default=STUDENT_CODE_HZ["autonomous"],
+                        help="Times per second autonomous_main runs.")
+    parser.add_argument("--teleop-hz", type=float, default=STUDENT_CODE_HZ["teleop"],
+                        help="Times per second teleop_main runs.")
+    parser.add_argument("--overrun-policy", choices=OVERRUN_POLICIES, default="warn",
+                        help="What to do when the main function keeps running past its "
+                             "deadline: only skip missed ticks, lower its rate, or warn in "
+                             "Dawn's console.")
     arguments = parser.parse_args()
     if arguments.version:
         print_version()
     elif arguments.test is None:
-        runtime()
+        runtime(start_method=arguments.start_method, preload=arguments.preload,
+                student_code_hz={"autonomous": arguments.autonomous_hz,
+                                 "teleop": arguments.teleop_hz},
+                overrun_policy=arguments.overrun_policy)
     else:
         runtime_test(arguments.test)
 
@@ -6,6 +6,9 @@ import traceback
 import multiprocessing
 import os
 import json
+import importlib.util
+import sys
+import time
 
 __version__ = (1, 3, 1)
 
@@ -39,6 +42,7 @@ class BAD_EVENTS(Enum):
     STUDENT_CODE_ERROR        = "Student Code Crashed"
     STUDENT_CODE_VALUE_ERROR  = "Student Code Value Error"
     STUDENT_CODE_TIMEOUT      = "Student Code Timed Out"
+    STUDENT_CODE_RELOAD       = "Student Code needs a new process to reload"
     UNKNOWN_PROCESS           = "Unknown State Manager process name"
     STATE_MANAGER_KEY_ERROR   = "Error accessing key in State Manager"
     STATE_MANAGER_CRASH       = "State Manager has Crashed"
@@ -55,6 +59,7 @@ class BAD_EVENTS(Enum):
     DAWN_DISCONNECTED         = "Disconnected to Dawn"
     HIBIKE_NONEXISTENT_DEVICE = "Tried to access a nonexistent device"
     HIBIKE_INSTRUCTION_ERROR  = "Hibike received malformed instruction"
+    PROFILE                   = "Start or stop the sampling profiler"
 
 restartEvents = [BAD_EVENTS.STUDENT_CODE_VALUE_ERROR, BAD_EVENTS.STUDENT_CODE_ERROR,
                  BAD_EVENTS.STUDENT_CODE_TIMEOUT, BAD_EVENTS.END_EVENT, BAD_EVENTS.EMERGENCY_STOP]
@@ -65,6 +70,7 @@ studentErrorEvents = [BAD_EVENTS.STUDENT_CODE_ERROR, BAD_EVENTS.STUDENT_CODE_TIM
 class PROCESS_NAMES(Enum):
     """Names of processes."""
     STUDENT_CODE        = "studentProcess"
+    STUDENT_CODE_STANDBY = "studentStandbyProcess"
     STATE_MANAGER       = "stateProcess"
     RUNTIME             = "runtime"
     UDP_SEND_PROCESS    = "udpSendProcess"
@@ -82,6 +88,7 @@ class HIBIKE_COMMANDS(Enum):
     READ      = "read_params"
     DISABLE   = "disable_all"
     TIMESTAMP_DOWN = "timestamp_down"
+    STATS     = "stats"
 
 
 @unique
@@ -91,6 +98,7 @@ class HIBIKE_RESPONSE(Enum):
     DEVICE_VALUES = "device_values"
     DEVICE_DISCONNECT = "device_disconnected"
     TIMESTAMP_UP  = "timestamp_up"
+    DEVICE_STATS  = "device_stats"
 
 
 @unique
@@ -124,6 +132,11 @@ class SM_COMMANDS(AutoIntEnum):
     ENTER_AUTO          = auto()
     END_STUDENT_CODE    = auto()
     SET_TEAM            = auto()
+    PROFILE             = auto()
+    BATCH               = auto()
+    TICK_SNAPSHOT       = auto()
+    PROMOTE_STANDBY     = auto()
+    PROCESS_STARTED     = auto()
 
 
 class BadThing:
@@ -193,8 +206,54 @@ class StudentAPITypeError(StudentAPIError):
     pass
 
 
+# This process's name and when it was spawned, by ``time.monotonic()`` in the
+# process that spawned it, until it reports that it is ready
+_STARTING = []
+
+
+def process_spawned(process_name, spawned_at):
+    """Remember that this process is PROCESS_NAME, and was spawned at SPAWNED_AT."""
+    _STARTING[:] = [process_name, spawned_at]
+
+
+def process_ready(state_queue):
+    """Tell StateManager how long this process took from being spawned to being ready to work.
+
+    Only the first call after `process_spawned` is sent.
+    """
+    if _STARTING:
+        process_name, spawned_at = _STARTING
+        del _STARTING[:]
+        state_queue.put([SM_COMMANDS.PROCESS_STARTED,
+                         [process_name, time.monotonic() - spawned_at]])
+
+
+# Where Hibike is, whose hibikeDevices.json and hibike_message runtime shares
+HIBIKE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hibike")
+
+
+def load_hibike_devices():
+    """Return every device type Hibike knows about, as described in hibikeDevices.json."""
+    with open(os.path.join(HIBIKE_DIR, "hibikeDevices.json"), "r") as config_file:
+        return json.load(config_file)
+
+
+def import_hibike_message():
+    """Import hibike_message from `HIBIKE_DIR`, which need not be on sys.path."""
+    if "hibike_message" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "hibike_message", os.path.join(HIBIKE_DIR, "hibike_message.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    return sys.modules["hibike_message"]
+
+
+HIBIKE_DEVICES = load_hibike_devices()
+
 # Sensor type names are CamelCase, with the first letter capitalized as well
-# TODO: could we read this ahead of time and not keep the file open?
-CONFIG_FILE = open(os.path.join(os.path.dirname(__file__), '../hibike/hibikeDevices.json'), 'r')
-SENSOR_TYPE = {device_data["id"]: device_data["name"] for device_data in json.load(CONFIG_FILE)}
+SENSOR_TYPE = {device_data["id"]: device_data["name"] for device_data in HIBIKE_DEVICES}
 SENSOR_TYPE[-1] = "runtime_version"
+
+# Dictionary mapping param types to python struct format characters
+PARAM_TYPES = import_hibike_message().PARAM_TYPES
@@ -0,0 +1,188 @@
+"""
+Unit tests for codecache.
+"""
+import importlib.util
+import marshal
+import os
+import tempfile
+import unittest
+
+from codecache import CACHE_PREFIX, CodeCache, compile_student_code, source_hash
+
+# Student code that defines every entry point and nothing runtime complains about
+VALID_SOURCE = b"""
+def autonomous_setup():
+    pass
+
+def autonomous_main():
+    pass
+
+def teleop_setup():
+    pass
+
+def teleop_main():
+    pass
+
+def helper():
+    pass
+"""
+
+
+class CompileTests(unittest.TestCase):
+    """
+    Test the checks made when student code is compiled.
+    """
+    def test_valid(self):
+        """
+        Valid code should compile with every top-level function recorded and no errors.
+        """
+        compiled = compile_student_code(VALID_SOURCE, "studentCode.py")
+        self.assertEqual(compiled.source_hash, source_hash(VALID_SOURCE))
+        self.assertIsNotNone(compiled.code)
+        self.assertEqual(compiled.entry_points, {
+            "autonomous_setup": False, "autonomous_main": False, "teleop_setup": False,
+            "teleop_main": False, "helper": False})
+        self.assertEqual(compiled.errors, [])
+
+    def test_syntax_error(self):
+        """
+        Code that does not compile should have no code object and one error.
+        """
+        compiled = compile_student_code(b"def teleop_main(:\n", "studentCode.py")
+        self.assertIsNone(compiled.code)
+        self.assertEqual(compiled.entry_points, {})
+        self.assertEqual(len(compiled.errors), 1)
+        self.assertIn("syntax error", compiled.errors[0])
+
+    def test_missing_entry_point(self):
+        """
+        Every entry point that is not defined should be reported by name.
+        """
+        source = VALID_SOURCE.replace(b"def teleop_main", b"def teleop_mian")
+        compiled = compile_student_code(source, "studentCode.py")
+        self.assertIsNotNone(compiled.code)
+        self.assertEqual(compiled.errors, ["Student code failed to define 'teleop_main'"])
+
+    def test_async_entry_point(self):
+        """
+        An entry point defined with ``async def`` should be recorded as async and reported.
+        """
+        source = VALID_SOURCE.replace(b"def autonomous_main", b"async def autonomous_main")
+        compiled = compile_student_code(source, "studentCode.py")
+        self.assertTrue(compiled.entry_points["autonomous_main"])
+        self.assertEqual(compiled.errors,
+                         ["autonomous_main is defined with `async def` instead of `def`"])
+
+    def test_api_override(self):
+        """
+        Binding ``Robot`` at the top level, in any way, should be reported.
+        """
+        for statement in (b"Robot = None", b"from os import path as Robot",
+                          b"class Robot:\n    pass", b"Robot, x = 1, 2"):
+            with self.subTest(statement=statement):
+                compiled = compile_student_code(VALID_SOURCE + statement + b"\n",
+                                                "studentCode.py")
+                self.assertEqual(len(compiled.errors), 1)
+                self.assertIn("overrides `Robot`", compiled.errors[0])
+
+
+class CodeCacheTests(unittest.TestCase):
+    """
+    Test that compiled code is cached by source hash and read back.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.source_path = os.path.join(self.temp_dir.name, "studentCode.py")
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        self.cache = CodeCache(directory=self.cache_dir)
+        self.write_source(VALID_SOURCE)
+
+    def write_source(self, source):
+        """Replace the student code with SOURCE."""
+        with open(self.source_path, "wb") as source_file:
+            source_file.write(source)
+
+    def cache_path(self, source):
+        """Return where the code compiled from SOURCE is cached."""
+        return os.path.join(self.cache_dir, CACHE_PREFIX + source_hash(source))
+
+    def test_miss(self):
+        """
+        Code that has not been seen should be compiled and written to the cache.
+        """
+        compiled = self.cache.get(self.source_path)
+        self.assertEqual(compiled, compile_student_code(VALID_SOURCE, self.source_path))
+        self.assertEqual(os.listdir(self.cache_dir), [CACHE_PREFIX + compiled.source_hash])
+
+    def test_hit(self):
+        """
+        Code that has been seen should be read from the cache, not compiled again.
+        """
+        compiled = self.cache.get(self.source_path)
+        # Rewrite the cache file with different errors, which only a hit returns
+        with open(self.cache_path(VALID_SOURCE), "wb") as cache_file:
+            cache_file.write(importlib.util.MAGIC_NUMBER)
+            marshal.dump((compiled.code, compiled.entry_points, ["from the cache"]), cache_file)
+        self.assertEqual(self.cache.get(self.source_path).errors, ["from the cache"])
+        self.assertEqual(CodeCache(directory=self.cache_dir).get(self.source_path).errors,
+                         ["from the cache"])
+
+    def test_changed_source(self):
+        """
+        Changed code should be compiled again, and the old version's cache file removed.
+        """
+        first = self.cache.get(self.source_path)
+        source = VALID_SOURCE.replace(b"def helper", b"async def helper")
+        self.write_source(source)
+        second = self.cache.get(self.source_path)
+        self.assertNotEqual(second.source_hash, first.source_hash)
+        self.assertTrue(second.entry_points["helper"])
+        self.assertEqual(os.listdir(self.cache_dir), [CACHE_PREFIX + second.source_hash])
+
+    def test_corrupt_file(self):
+        """
+        A cache file that cannot be read should be replaced by compiling again.
+        """
+        os.makedirs(self.cache_dir)
+        for contents in (b"", importlib.util.MAGIC_NUMBER,
+                         importlib.util.MAGIC_NUMBER + b"\xff garbage"):
+            with self.subTest(contents=contents):
+                with open(self.cache_path(VALID_SOURCE), "wb") as cache_file:
+                    cache_file.write(contents)
+                compiled = self.cache.get(self.source_path)
+                self.assertEqual(compiled.errors, [])
+                self.assertIsNotNone(compiled.code)
+                self.assertEqual(self.cache.get(self.source_path), compiled)
+
+    def test_stale_magic(self):
+        """
+        A cache file written by another Python version should be ignored and replaced.
+        """
+        compiled = self.cache.get(self.source_path)
+        with open(self.cache_path(VALID_SOURCE), "r+b") as cache_file:
+            cache_file.write(b"\x00" * len(importlib.util.MAGIC_NUMBER))
+        self.assertEqual(self.cache.get(self.source_path), compiled)
+        with open(self.cache_path(VALID_SOURCE), "rb") as cache_file:
+            self.assertEqual(cache_file.read(len(importlib.util.MAGIC_NUMBER)),
+                             importlib.util.MAGIC_NUMBER)
+
+    def test_syntax_error_cached(self):
+        """
+        Code with a syntax error should be cached with its error, and no code object.
+        """
+        source = b"def teleop_main(:\n"
+        self.write_source(source)
+        self.cache.get(self.source_path)
+        compiled = self.cache.get(self.source_path)
+        self.assertIsNone(compiled.code)
+        self.assertIn("syntax error", compiled.errors[0])
+        self.assertTrue(os.path.exists(self.cache_path(source)))
+
+    def test_missing_source(self):
+        """
+        Student code that does not exist should raise OSError.
+        """
+        os.remove(self.source_path)
+        with self.assertRaises(OSError):
+            self.cache.get(self.source_path)
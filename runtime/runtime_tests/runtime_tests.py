@@ -0,0 +1,370 @@
+"""
+Unit tests for runtime.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import types
+import unittest
+import warnings
+from unittest import mock
+
+from codecache import CodeCache, source_hash
+import sampling_profiler
+from runtimeUtil import BAD_EVENTS, PROCESS_NAMES, SM_COMMANDS, process_ready
+
+import runtime
+
+
+class FakeProcess:
+    """
+    A child process that is alive or not, with a PID no process has.
+    """
+    def __init__(self, alive):
+        self.alive = alive
+        self.pid = -1
+
+    def is_alive(self):
+        """Whether the process is running."""
+        return self.alive
+
+
+class ToggleProfilingTests(unittest.TestCase):
+    """
+    Test that profiling is toggled in the processes that are running, and only them.
+    """
+    def setUp(self):
+        self.signalled = []
+        patcher = mock.patch.object(sampling_profiler, "signal_process", self.signal_process)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(runtime.ALL_PROCESSES, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def signal_process(self, pid, start):
+        """Record that PID was signalled, as if it had exited unless it is this process."""
+        if pid != os.getpid():
+            raise ProcessLookupError(pid)
+        self.signalled.append((pid, start))
+
+    def test_exited_process_skipped(self):
+        """
+        A child that exited and was reaped should not be signalled.
+        """
+        exited = multiprocessing.get_context("fork").Process(target=lambda: None)
+        exited.start()
+        exited.join()
+        runtime.ALL_PROCESSES[PROCESS_NAMES.HIBIKE] = exited
+        runtime.toggle_profiling(None, True)
+        self.assertEqual(self.signalled, [(os.getpid(), True)])
+
+    def test_process_gone(self):
+        """
+        A child that exits after it is found to be running should be skipped.
+        """
+        runtime.ALL_PROCESSES[PROCESS_NAMES.HIBIKE] = FakeProcess(alive=True)
+        runtime.toggle_profiling(None, False)
+        runtime.toggle_profiling(PROCESS_NAMES.HIBIKE.value, False)
+        self.assertEqual(self.signalled, [(os.getpid(), False)])
+
+    def test_one_process(self):
+        """
+        Naming a process should only signal that process.
+        """
+        runtime.ALL_PROCESSES[PROCESS_NAMES.HIBIKE] = FakeProcess(alive=True)
+        runtime.toggle_profiling(PROCESS_NAMES.RUNTIME.value, True)
+        self.assertEqual(self.signalled, [(os.getpid(), True)])
+
+
+class FakePipe:
+    """
+    The pipe a standby process waits on, which promotes it at once.
+    """
+    def __init__(self, start_args, received):
+        self.start_args = start_args
+        self.received = received
+
+    def recv(self):
+        """Note that the process waited to be promoted, and promote it."""
+        self.received.append("promoted")
+        return self.start_args
+
+
+class StandbyTests(unittest.TestCase):
+    """
+    Test loading student code in a standby process, and running it once promoted.
+    """
+    def setUp(self):
+        # What happened in the process, in order
+        self.events = []
+        self.stamps = iter([1, 1])
+        self.loads = iter([("first", "cache")])
+        self.bad_things_queue = mock.Mock()
+        self.bad_things_queue.put.side_effect = (
+            lambda bad_thing: self.events.append(("reported", bad_thing.event)))
+        self.pipe = FakePipe(["teleop", None, 20, "warn"], self.events)
+        process = multiprocessing.current_process()
+        self.addCleanup(setattr, process, "name", process.name)
+        for name, replacement in (("student_code_stamp", lambda: next(self.stamps)),
+                                  ("load_student_code", self.load_student_code),
+                                  ("run_loaded_student_code", self.run_loaded_student_code)):
+            patcher = mock.patch.object(runtime, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(sampling_profiler, "install")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load_student_code(self, _state_queue, pipe):
+        """Load the next version of student code, which may raise."""
+        self.assertIs(pipe, self.pipe)
+        loaded = next(self.loads)
+        self.events.append(("loaded", loaded))
+        if isinstance(loaded, Exception):
+            raise loaded
+        return loaded
+
+    def run_loaded_student_code(self, _bad_things_queue, _state_queue, *args):
+        """Note which student code ran, and how."""
+        self.events.append(("ran", args))
+
+    def run_standby(self):
+        """Run the standby process until its student code is done."""
+        runtime.run_standby_student_code(self.bad_things_queue, None, self.pipe)
+        self.assertEqual(multiprocessing.current_process().name,
+                         PROCESS_NAMES.STUDENT_CODE.value)
+
+    def test_loaded_ahead(self):
+        """
+        Student code should be loaded before promotion, and not again after it.
+        """
+        self.run_standby()
+        self.assertEqual(self.events, [
+            ("loaded", ("first", "cache")), "promoted",
+            ("ran", ("first", "cache", "teleop", None, 20, "warn"))])
+        self.bad_things_queue.put.assert_not_called()
+
+    def test_stale_stamp(self):
+        """
+        Student code changed while the process waited should be loaded again and run.
+        """
+        self.stamps = iter([1, 2])
+        self.loads = iter([("first", "cache"), ("second", "cache")])
+        self.run_standby()
+        self.assertEqual(self.events, [
+            ("loaded", ("first", "cache")), "promoted", ("loaded", ("second", "cache")),
+            ("ran", ("second", "cache", "teleop", None, 20, "warn"))])
+
+    def test_deferred_load_error(self):
+        """
+        An error loading student code should only be reported once it is promoted.
+        """
+        error = RuntimeError("Student code failed to define 'teleop_main'")
+        self.loads = iter([error])
+        self.run_standby()
+        self.assertEqual(self.events, [("loaded", error), "promoted",
+                                       ("reported", BAD_EVENTS.STUDENT_CODE_ERROR)])
+        (bad_thing,), _ = self.bad_things_queue.put.call_args
+        self.assertEqual(bad_thing.data, str(error))
+
+    def test_load_error_fixed(self):
+        """
+        An error loading student code should be dropped if the code was fixed meanwhile.
+        """
+        self.stamps = iter([1, 2])
+        self.loads = iter([SyntaxError("invalid syntax"), ("fixed", "cache")])
+        self.run_standby()
+        self.assertEqual(self.events[-1], ("ran", ("fixed", "cache", "teleop", None, 20, "warn")))
+        self.bad_things_queue.put.assert_not_called()
+
+
+class RunProfilableTests(unittest.TestCase):
+    """
+    Test reporting how long a process took to be ready.
+    """
+    def setUp(self):
+        patcher = mock.patch.object(sampling_profiler, "install")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state_queue = mock.Mock()
+
+    def helper(self, _bad_things_queue, state_queue, *args):
+        """Get ready, checking that nothing was reported before, and report it twice."""
+        self.assertEqual(args, ("pipe",))
+        state_queue.put.assert_not_called()
+        process_ready(state_queue)
+        process_ready(state_queue)
+
+    def test_reported_when_ready(self):
+        """
+        The time from spawning the process until it is ready should be reported once.
+        """
+        spawned_at = time.monotonic() - 2.0
+        runtime.run_profilable(PROCESS_NAMES.HIBIKE.value, spawned_at, self.helper, None,
+                               self.state_queue, "pipe")
+        (command,), _ = self.state_queue.put.call_args
+        self.assertEqual(self.state_queue.put.call_count, 1)
+        self.assertEqual(command[0], SM_COMMANDS.PROCESS_STARTED)
+        process_name, startup_time = command[1]
+        self.assertEqual(process_name, PROCESS_NAMES.HIBIKE.value)
+        self.assertGreaterEqual(startup_time, 2.0)
+
+    def test_not_spawned(self):
+        """
+        A process that was not started by runtime should not report anything.
+        """
+        process_ready(self.state_queue)
+        self.state_queue.put.assert_not_called()
+
+
+class ReloadTests(unittest.TestCase):
+    """
+    Test swapping uploaded student code into a running process.
+    """
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "studentCode.py")
+        cache = CodeCache(directory=os.path.join(temp_dir.name, "cache"))
+        for patcher in (mock.patch.object(runtime, "CODE_CACHE", cache),
+                        mock.patch.dict(sys.modules)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.robot, self.gamepad = mock.Mock(), mock.Mock()
+        self.write_source(b"VERSION = 1\n")
+        self.student_code = runtime.exec_student_code(self.path)
+        runtime.attach_student_api(self.student_code, self.robot, self.gamepad)
+
+    def write_source(self, source):
+        """Replace the student code with SOURCE."""
+        with open(self.path, "wb") as source_file:
+            source_file.write(source)
+
+    def test_swap(self):
+        """
+        The new code should run in a new module, with the API objects of the old one.
+        """
+        source = b"VERSION = 2\ndef next_power(x):\n    return x + 1\n"
+        self.write_source(source)
+        module = runtime.reload_student_code(self.student_code)
+        self.assertIsNot(module, self.student_code)
+        self.assertEqual((module.VERSION, self.student_code.VERSION), (2, 1))
+        self.assertEqual(module.__source_hash__, source_hash(source))
+        self.assertIs(sys.modules["studentCode"], module)
+        self.assertIs(module.Robot, self.robot)
+        self.assertIs(module.Gamepad, self.gamepad)
+        self.assertIs(module.get_robot_value, self.robot.get_value)
+        # pylint: disable=protected-access
+        self.robot._stop_coroutines.assert_called_once_with()
+        self.robot._create_sensor_mapping.assert_called_once_with()
+        self.assertEqual(self.robot.func_map[1](1), 2)
+
+    def test_robot_overridden(self):
+        """
+        Code that overrides `Robot` should raise, leaving the running code alone.
+        """
+        self.write_source(b"VERSION = 2\nRobot = None\n")
+        with self.assertRaises(RuntimeError) as raised:
+            runtime.reload_student_code(self.student_code)
+        self.assertIn("overrides `Robot`", str(raised.exception))
+        self.assertIs(self.student_code.Robot, self.robot)
+        self.robot._stop_coroutines.assert_not_called() # pylint: disable=protected-access
+
+    def test_syntax_error(self):
+        """
+        Code that does not compile should raise, leaving the running code alone.
+        """
+        self.write_source(b"VERSION = \n")
+        with self.assertRaises(RuntimeError):
+            runtime.reload_student_code(self.student_code)
+        self.assertIs(sys.modules["studentCode"], self.student_code)
+        self.robot._stop_coroutines.assert_not_called() # pylint: disable=protected-access
+
+
+class FakeStateCache:
+    """
+    A `StateCache` that always has UPLOADED as the hash of the uploaded code.
+    """
+    def __init__(self, uploaded):
+        self.uploaded = uploaded
+
+    def track(self, *path):
+        """Only the upload hash is tracked."""
+        assert path == runtime.UPLOAD_HASH_PATH
+
+    def refresh(self):
+        """Nothing changes."""
+
+    def get(self, *path):
+        """Return the upload hash."""
+        assert path == runtime.UPLOAD_HASH_PATH
+        return self.uploaded
+
+
+class HotReloadTests(unittest.TestCase):
+    """
+    Test reloading uploaded code between ticks, and falling back to a new process.
+    """
+    def setUp(self):
+        # The setup and main functions that ran, in order
+        self.calls = []
+        self.bad_things_queue = mock.Mock()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
+        patcher = mock.patch.object(warnings, "showwarning", warnings.showwarning)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.old = self.make_student_code("old")
+
+    def make_student_code(self, name):
+        """Return student code hashed NAME, whose functions note when they are called."""
+        module = types.ModuleType("studentCode")
+        module.__source_hash__ = name
+        module.Robot = mock.Mock()
+        module.setup = lambda: self.calls.append((name, "setup"))
+        module.main = lambda: self.calls.append((name, "main"))
+        return module
+
+    def run_student_code(self, uploaded, reload_student_code):
+        """Run the old code for three ticks, with UPLOADED as the upload hash."""
+        with mock.patch.object(runtime, "reload_student_code", reload_student_code):
+            runtime.run_loaded_student_code(self.bad_things_queue, mock.Mock(), self.old,
+                                            FakeStateCache(uploaded), max_iter=3, rate_hz=1000)
+        return [bad_thing.event for (bad_thing,), _ in self.bad_things_queue.put.call_args_list]
+
+    def test_swap(self):
+        """
+        Uploaded code should be swapped in before the first tick, and set up once.
+        """
+        new = self.make_student_code("new")
+        reload_student_code = mock.Mock(return_value=new)
+        events = self.run_student_code("new", reload_student_code)
+        reload_student_code.assert_called_once_with(self.old)
+        self.assertEqual(self.calls, [("old", "setup"), ("new", "setup")] + [("new", "main")] * 3)
+        self.assertEqual(events, [BAD_EVENTS.END_EVENT])
+
+    def test_same_code(self):
+        """
+        An upload of the code that is running should not reload it.
+        """
+        reload_student_code = mock.Mock()
+        self.run_student_code("old", reload_student_code)
+        reload_student_code.assert_not_called()
+        self.assertEqual(self.calls, [("old", "setup")] + [("old", "main")] * 3)
+
+    def test_fallback(self):
+        """
+        If the uploaded code cannot be swapped in, runtime should be asked for a new process.
+        """
+        reload_student_code = mock.Mock(side_effect=RuntimeError("Student code overrides `Robot`"))
+        events = self.run_student_code("new", reload_student_code)
+        self.assertEqual(self.calls, [("old", "setup")])
+        self.assertEqual(events, [BAD_EVENTS.STUDENT_CODE_RELOAD])
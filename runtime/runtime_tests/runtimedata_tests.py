@@ -0,0 +1,143 @@
+"""
+Unit tests for runtimedata.
+"""
+import random
+import unittest
+
+import runtime_pb2
+from runtimedata import RuntimeDataPackager, encode_varint
+from statestore import StateStore
+
+from runtimeUtil import HIBIKE_DEVICES, SENSOR_TYPE
+
+# Number of random changes each fuzz run makes
+FUZZ_STEPS = 300
+
+
+def old_package(state):
+    """
+    Package a nested STATE the way the UDP packager did before `RuntimeDataPackager`.
+    """
+    proto_message = runtime_pb2.RuntimeData()
+    proto_message.robot_state = state["studentCodeState"][0]
+    for uid, values in state["hibike"][0]["devices"][0].items():
+        sensor = proto_message.sensor_data.add()
+        sensor.uid = str(uid)
+        sensor.device_type = SENSOR_TYPE[uid >> 72]
+        for param, value in values[0].items():
+            if value[0] is None:
+                continue
+            param_value_pair = sensor.param_value.add()
+            param_value_pair.param = param
+            if isinstance(value[0], bool):
+                param_value_pair.bool_value = value[0]
+            elif isinstance(value[0], float):
+                param_value_pair.float_value = value[0]
+            elif isinstance(value[0], int):
+                param_value_pair.int_value = value[0]
+    return proto_message.SerializeToString()
+
+
+def random_value(rng):
+    """Return a random param value of any type a device can send, or None."""
+    return rng.choice([None, rng.random() < 0.5, rng.uniform(-10, 10),
+                       rng.randint(-2 ** 31, 2 ** 31 - 1), 0, 0.0, False])
+
+
+class EncodeVarintTests(unittest.TestCase):
+    """
+    Test varint encoding against known encodings.
+    """
+    def test_known_values(self):
+        """
+        Small and multi-byte numbers should be encoded like protobuf does.
+        """
+        for number, encoded in ((0, b"\x00"), (1, b"\x01"), (127, b"\x7f"),
+                                (128, b"\x80\x01"), (300, b"\xac\x02"),
+                                (2 ** 21, b"\x80\x80\x80\x01")):
+            self.assertEqual(encode_varint(number), encoded)
+
+
+class PackagerTests(unittest.TestCase):
+    """
+    Test that packaged state is byte-identical to what the old packager built.
+    """
+    def setUp(self):
+        self.store = StateStore({
+            "studentCodeState": [runtime_pb2.RuntimeData.STUDENT_STOPPED, 0.0],
+            "hibike": [{"devices": [{}, 0.0]}, 0.0],
+        })
+        self.packager = RuntimeDataPackager(self.store)
+        self.serial_no = 0
+
+    def add_device(self, rng):
+        """Add a device of a random type with every param unset, like a new subscription."""
+        device = rng.choice(HIBIKE_DEVICES)
+        self.serial_no += 1
+        uid = device["id"] << 72 | self.serial_no
+        self.store.create(("hibike", "devices", uid))
+        for param in device["params"]:
+            self.store.create(("hibike", "devices", uid, param["name"]))
+            self.store.set(("hibike", "devices", uid, param["name"]), None)
+
+    def change(self, rng):
+        """Make a random change to the state, like StateManager would."""
+        uids = list(self.store.get(("hibike", "devices")))
+        choice = rng.random()
+        if not uids or choice < 0.1:
+            self.add_device(rng)
+        elif choice < 0.15:
+            self.store.delete(("hibike", "devices", rng.choice(uids)))
+        elif choice < 0.2:
+            self.store.set(("studentCodeState",), rng.choice(
+                [runtime_pb2.RuntimeData.TELEOP, runtime_pb2.RuntimeData.AUTO,
+                 runtime_pb2.RuntimeData.STUDENT_STOPPED]))
+        else:
+            uid = rng.choice(uids)
+            params = list(self.store.get(("hibike", "devices", uid)))
+            self.store.update(("hibike", "devices", uid),
+                              [(param, random_value(rng))
+                               for param in rng.sample(params, rng.randint(1, len(params)))])
+
+    def test_fuzz(self):
+        """
+        After random updates, additions and removals, the output should match the old packager.
+        """
+        for seed in range(5):
+            rng = random.Random(seed)
+            with self.subTest(seed=seed):
+                self.setUp()
+                for _ in range(FUZZ_STEPS):
+                    for _ in range(rng.randint(0, 3)):
+                        self.change(rng)
+                    self.store.new_batch()
+                    self.assertEqual(self.packager.package(), old_package(self.store.nested()))
+                self.assertGreater(self.packager.reused, 0)
+
+    def test_unchanged(self):
+        """
+        Packaging unchanged state again should return the same bytes without re-encoding.
+        """
+        rng = random.Random(0)
+        for _ in range(3):
+            self.add_device(rng)
+        message = self.packager.package()
+        encoded = self.packager.encoded
+        self.assertIs(self.packager.package(), message)
+        self.assertEqual(self.packager.encoded, encoded)
+
+    def test_one_device_changed(self):
+        """
+        Changing one device should re-encode only that device.
+        """
+        rng = random.Random(1)
+        for _ in range(4):
+            self.add_device(rng)
+        self.packager.package()
+        uid = next(iter(self.store.get(("hibike", "devices"))))
+        param = next(iter(self.store.get(("hibike", "devices", uid))))
+        encoded, reused = self.packager.encoded, self.packager.reused
+        self.store.set(("hibike", "devices", uid, param), True)
+        self.assertEqual(self.packager.package(), old_package(self.store.nested()))
+        self.assertEqual(self.packager.encoded, encoded + 1)
+        self.assertEqual(self.packager.reused, reused + 3)
@@ -0,0 +1,147 @@
+"""
+Unit tests for sampling_profiler.
+"""
+import io
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+import sampling_profiler
+from sampling_profiler import SamplingProfiler, write_callgrind, write_folded
+
+# Two samples of main -> helper, and one of main itself
+SAMPLES = {
+    (("app.py", "main", 10), ("lib.py", "helper", 3)): 2,
+    (("app.py", "main", 12),): 1,
+}
+
+
+def busy_function(seconds):
+    """Use the CPU for SECONDS."""
+    total = 0
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        total += 1
+    return total
+
+
+class WriterTests(unittest.TestCase):
+    """
+    Test the folded stack and callgrind output.
+    """
+    def test_folded(self):
+        """
+        Each distinct stack should be one line with its sample count.
+        """
+        out = io.StringIO()
+        write_folded(SAMPLES, out)
+        self.assertEqual(out.getvalue(), "main (app.py) 1\nmain (app.py);helper (lib.py) 2\n")
+
+    def test_callgrind(self):
+        """
+        Functions should have their self samples and inclusive samples of their calls.
+        """
+        out = io.StringIO()
+        write_callgrind(SAMPLES, out, "test")
+        text = out.getvalue()
+        self.assertIn("cmd: test\nevents: Samples\n", text)
+        self.assertIn("fl=app.py\nfn=main\n12 1\ncfl=lib.py\ncfn=helper\ncalls=2 0\n10 2\n", text)
+        self.assertIn("fl=lib.py\nfn=helper\n3 2\n", text)
+
+    def test_recursion_counted_once(self):
+        """
+        A recursive call should add a sample to its edge once per sample.
+        """
+        frame = ("app.py", "walk", 5)
+        out = io.StringIO()
+        write_callgrind({(frame, frame, frame): 1}, out, "test")
+        self.assertIn("cfn=walk\ncalls=1 0\n5 1\n", out.getvalue())
+
+
+class ProfilerTests(unittest.TestCase):
+    """
+    Test sampling this process.
+    """
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.handlers = {signum: signal.getsignal(signum) for signum in
+                         (signal.SIGPROF, sampling_profiler.START_SIGNAL,
+                          sampling_profiler.STOP_SIGNAL)}
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, sampling_profiler.PROFILER_SIGNALS)
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        self.profile_dir.cleanup()
+
+    def read_profiles(self, paths):
+        """Return the contents of the folded and callgrind files at PATHS."""
+        self.assertEqual([os.path.splitext(path)[1] for path in paths],
+                         [".folded", ".callgrind"])
+        for path in paths:
+            self.assertEqual(os.path.dirname(path), self.profile_dir.name)
+        with open(paths[0]) as folded, open(paths[1]) as callgrind:
+            return folded.read(), callgrind.read()
+
+    def test_samples_busy_function(self):
+        """
+        A function using the CPU should show up in both profiles.
+        """
+        profiler = SamplingProfiler("test", profile_dir=self.profile_dir.name)
+        profiler.start()
+        self.assertTrue(profiler.running)
+        busy_function(0.3)
+        folded, callgrind = self.read_profiles(profiler.stop())
+        self.assertFalse(profiler.running)
+        self.assertIn("busy_function (sampling_profiler_tests.py)", folded)
+        self.assertNotIn("_sample (sampling_profiler.py)", folded)
+        self.assertIn("fn=busy_function\n", callgrind)
+
+    def test_toggle(self):
+        """
+        Stopping an idle profiler should write nothing, and starting one
+        that runs should keep its samples.
+        """
+        profiler = SamplingProfiler("test", profile_dir=self.profile_dir.name)
+        self.assertEqual(profiler.stop(), [])
+        profiler.start()
+        busy_function(0.1)
+        samples = sum(profiler.samples.values())
+        self.assertGreater(samples, 0)
+        profiler.start()
+        self.assertGreaterEqual(sum(profiler.samples.values()), samples)
+        profiler.stop()
+        self.assertEqual(profiler.stop(), [])
+        self.assertEqual(len(os.listdir(self.profile_dir.name)), 2)
+
+    def test_signals(self):
+        """
+        The start and stop signals should toggle profiling of an installed process.
+        """
+        sampling_profiler.install("signalled")
+        profiler = sampling_profiler._PROFILER # pylint: disable=protected-access
+        profiler.profile_dir = self.profile_dir.name
+        sampling_profiler.signal_process(os.getpid(), True)
+        self.assertTrue(profiler.running)
+        busy_function(0.1)
+        sampling_profiler.signal_process(os.getpid(), False)
+        self.assertFalse(profiler.running)
+        names = sorted(os.listdir(self.profile_dir.name))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.startswith("signalled-") for name in names))
+
+    def test_signals_held_until_installed(self):
+        """
+        A start signal sent while the signals are blocked should be handled once installed.
+        """
+        sampling_profiler.block_signals()
+        sampling_profiler.signal_process(os.getpid(), True)
+        self.assertIn(sampling_profiler.START_SIGNAL, signal.sigpending())
+        sampling_profiler.install("held")
+        profiler = sampling_profiler._PROFILER # pylint: disable=protected-access
+        profiler.profile_dir = self.profile_dir.name
+        self.assertTrue(profiler.running)
+        profiler.stop()
@@ -0,0 +1,77 @@
+"""
+Unit tests for sensortable.
+"""
+import unittest
+from unittest import mock
+
+import sensortable
+from sensortable import MappedFile, SensorTable
+
+from runtimeUtil import SENSOR_TYPE
+
+# A LimitSwitch and a YogiBear
+SWITCH_UID = next(i for i, name in SENSOR_TYPE.items() if name == "LimitSwitch") << 72 | 1
+MOTOR_UID = next(i for i, name in SENSOR_TYPE.items() if name == "YogiBear") << 72 | 2
+
+
+class SensorTableTests(unittest.TestCase):
+    """
+    Test writing and reading values through the table, on the default backing store.
+    """
+    def setUp(self):
+        self.owner = SensorTable.create()
+        self.assertIsNotNone(self.owner)
+        self.reader = SensorTable.attach(self.owner.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.owner.close()
+        self.owner.unlink()
+
+    def test_round_trip(self):
+        """
+        Values written for an allocated device should be read back in another view.
+        """
+        self.owner.allocate(SWITCH_UID)
+        self.owner.allocate(MOTOR_UID)
+        self.assertTrue(self.reader.write(SWITCH_UID, [("switch1", True)]))
+        self.assertTrue(self.reader.write(MOTOR_UID, [("duty_cycle", 0.5), ("enc_pos", -12)]))
+        self.assertIs(self.owner.read(SWITCH_UID, "switch1"), True)
+        self.assertIsNone(self.owner.read(SWITCH_UID, "switch0"))
+        self.assertEqual(self.owner.read(MOTOR_UID, "duty_cycle"), 0.5)
+        self.assertEqual(self.owner.read(MOTOR_UID, "enc_pos"), -12)
+
+    def test_unallocated(self):
+        """
+        Devices without a slot should not be written, and reading them should fail.
+        """
+        self.assertFalse(self.reader.write(SWITCH_UID, [("switch1", True)]))
+        with self.assertRaises(KeyError):
+            self.owner.read(SWITCH_UID, "switch1")
+
+    def test_stale_values_hidden(self):
+        """
+        Values left in a slot by a previous device should not be returned.
+        """
+        self.owner.allocate(SWITCH_UID)
+        self.reader.write(SWITCH_UID, [("switch1", True)])
+        self.owner.free(SWITCH_UID)
+        self.owner.allocate(SWITCH_UID + 1)
+        self.assertIsNone(self.reader.read(SWITCH_UID + 1, "switch1"))
+
+    def test_attach_missing(self):
+        """
+        Attaching to a table that doesn't exist should return None.
+        """
+        self.assertIsNone(SensorTable.attach("pie_sensors_missing"))
+
+
+class MappedFileTableTests(SensorTableTests):
+    """
+    The same tests on the backing store used before Python 3.8.
+    """
+    def setUp(self):
+        patcher = mock.patch.object(sensortable, "SharedMemory", MappedFile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
@@ -0,0 +1,82 @@
+"""
+Unit tests for statemanager.
+"""
+import unittest
+
+from statemanager import StateManager
+from statestore import StateStore
+
+from runtimeUtil import BAD_EVENTS, PROCESS_NAMES
+
+
+class FakeQueue(list):
+    """
+    A queue that keeps everything put in it.
+    """
+    def put(self, item):
+        """Keep ITEM."""
+        self.append(item)
+
+
+class FakePipe(list):
+    """
+    A pipe that keeps everything sent down it.
+    """
+    def send(self, item):
+        """Keep ITEM."""
+        self.append(item)
+
+
+class ProfileTests(unittest.TestCase):
+    """
+    Test forwarding requests to toggle the profiler to runtime.
+    """
+    def setUp(self):
+        # Only the queue to runtime is needed to forward requests
+        self.manager = StateManager.__new__(StateManager)
+        self.manager.bad_things_queue = FakeQueue()
+
+    def test_forwarded(self):
+        """
+        Requests for every process, or one named by its value or enum, should go to runtime.
+        """
+        for process_name in (None, PROCESS_NAMES.HIBIKE.value, PROCESS_NAMES.HIBIKE):
+            with self.subTest(process_name=process_name):
+                self.manager.profile(True, process_name)
+                bad_thing = self.manager.bad_things_queue.pop()
+                self.assertEqual(bad_thing.event, BAD_EVENTS.PROFILE)
+                self.assertEqual(bad_thing.data, [getattr(process_name, "value", process_name),
+                                                  True])
+
+    def test_unknown_process(self):
+        """
+        A request for a process that doesn't exist should be reported, not forwarded.
+        """
+        self.manager.profile(False, "hibiek")
+        bad_thing, = self.manager.bad_things_queue
+        self.assertEqual(bad_thing.event, BAD_EVENTS.UNKNOWN_PROCESS)
+        self.assertIn("hibiek", bad_thing.data)
+
+
+class PromoteStandbyTests(unittest.TestCase):
+    """
+    Test making the standby student code process the running one.
+    """
+    def setUp(self):
+        self.manager = StateManager.__new__(StateManager)
+        self.old_pipe, self.standby_pipe = FakePipe(), FakePipe()
+        self.manager.process_mapping = {PROCESS_NAMES.STUDENT_CODE: self.old_pipe,
+                                        PROCESS_NAMES.STUDENT_CODE_STANDBY: self.standby_pipe}
+
+    def test_promoted(self):
+        """
+        The standby's pipe should answer student code requests, and be told how to run.
+        """
+        self.manager.promote_standby("autonomous", None, 20, "skip")
+        self.assertEqual(self.manager.process_mapping,
+                         {PROCESS_NAMES.STUDENT_CODE: self.standby_pipe})
+        self.assertEqual(self.standby_pipe, [["autonomous", None, 20, "skip"]])
+        self.manager.state_store = StateStore({"counter": [1.0, 0.0]})
+        self.manager.get_value(["counter"])
+        self.assertEqual(self.standby_pipe[1:], [1.0])
+        self.assertEqual(self.old_pipe, [])
@@ -0,0 +1,187 @@
+"""
+Unit tests for statequeue.
+"""
+import collections
+import queue
+import unittest
+
+from statequeue import CONTROL, REQUEST, TELEMETRY, InputLanes
+
+from runtimeUtil import HIBIKE_COMMANDS, HIBIKE_RESPONSE, SM_COMMANDS
+
+DEVICE_VALUES = HIBIKE_RESPONSE.DEVICE_VALUES.value
+DEVICE_STATS = HIBIKE_RESPONSE.DEVICE_STATS.value
+
+
+class FakeStateQueue:
+    """
+    A `StateQueue` holding requests that were all sent at known times.
+    """
+    def __init__(self):
+        self.items = collections.deque()
+
+    def put(self, request, sent_at=0.0):
+        """Add REQUEST, as if it was sent at SENT_AT."""
+        self.items.append((sent_at, request))
+
+    def get(self, block=True):
+        """Return the oldest request, which must exist."""
+        assert block and self.items
+        return self.items.popleft()
+
+    def get_nowait(self):
+        """Return the oldest request, raising `queue.Empty` if there are none."""
+        if not self.items:
+            raise queue.Empty
+        return self.items.popleft()
+
+
+class LanesTestCase(unittest.TestCase):
+    """
+    Sorts requests from a fake queue into lanes, with a clock stopped at 10.0.
+    """
+    def setUp(self):
+        self.state_queue = FakeStateQueue()
+        self.lanes = InputLanes(self.state_queue, clock=lambda: 10.0)
+
+    def handle_all(self, *requests):
+        """Queue REQUESTS, and return them in the order StateManager gets them."""
+        for request in requests:
+            self.state_queue.put(request)
+        handled = []
+        while self.state_queue.items or self.lanes:
+            handled.append(self.lanes.get())
+        return handled
+
+
+class OrderingTests(LanesTestCase):
+    """
+    Test the order requests are handled in.
+    """
+    def test_write_before_disable(self):
+        """
+        A write sent before Hibike is disabled should not be handled after it.
+        """
+        write = [HIBIKE_COMMANDS.WRITE, [7, [("duty_cycle", 1.0)]]]
+        disable = [HIBIKE_COMMANDS.DISABLE, []]
+        self.assertEqual(self.handle_all(write, disable), [write, disable])
+
+    def test_mode_changes_in_order(self):
+        """
+        Mode changes should stay in order with the requests sent around them.
+        """
+        requests = [
+            [SM_COMMANDS.SET_VAL, ["studentCodeState", 0]],
+            [SM_COMMANDS.ENTER_TELEOP, []],
+            [SM_COMMANDS.END_STUDENT_CODE, []],
+            [SM_COMMANDS.ENTER_AUTO, []],
+            [SM_COMMANDS.ENTER_IDLE, []],
+        ]
+        self.assertEqual(self.handle_all(*requests), requests)
+
+    def test_emergency_stop_first(self):
+        """
+        An emergency stop should be handled before anything sent earlier.
+        """
+        write = [HIBIKE_COMMANDS.WRITE, [7, [("duty_cycle", 1.0)]]]
+        values = [DEVICE_VALUES, [{7: [("enc_pos", 3)]}]]
+        stop = [SM_COMMANDS.EMERGENCY_STOP, []]
+        self.assertEqual(self.handle_all(values, write, stop), [stop, write, values])
+
+    def test_stop_not_undone(self):
+        """
+        An emergency stop should be handled again after a restart or reset sent before it.
+        """
+        for clear in ([SM_COMMANDS.EMERGENCY_RESTART, []], [SM_COMMANDS.RESET, []]):
+            with self.subTest(clear=clear):
+                stop = [SM_COMMANDS.EMERGENCY_STOP, []]
+                self.assertEqual(self.handle_all(clear, stop), [stop, clear, stop])
+
+    def test_telemetry_last(self):
+        """
+        Telemetry should wait for requests, even ones sent after it.
+        """
+        values = [DEVICE_VALUES, [{7: [("enc_pos", 3)]}]]
+        stats = [DEVICE_STATS, [{"links": 1}]]
+        get = [SM_COMMANDS.GET_VAL, [["hibike"]]]
+        self.assertEqual(self.handle_all(values, stats, get), [get, values, stats])
+
+    def test_malformed(self):
+        """
+        Requests that are not ``[command, args]`` should be handed on in order.
+        """
+        get = [SM_COMMANDS.GET_VAL, [["hibike"]]]
+        self.assertEqual(self.handle_all([], None, get), [[], None, get])
+
+
+class ConflationTests(LanesTestCase):
+    """
+    Test that telemetry still waiting is merged with newer telemetry of the same kind.
+    """
+    def test_device_values(self):
+        """
+        Device values should be merged, keeping the newest value of each param.
+        """
+        handled = self.handle_all(
+            [DEVICE_VALUES, [{7: [("enc_pos", 1), ("duty_cycle", 0.5)]}]],
+            [DEVICE_VALUES, [{7: [("enc_pos", 2)], 8: [("switch0", True)]}]],
+            [DEVICE_VALUES, [{7: [("enc_pos", 3)]}]])
+        self.assertEqual(handled, [[DEVICE_VALUES, [{
+            7: [("enc_pos", 3), ("duty_cycle", 0.5)], 8: [("switch0", True)]}]]])
+        self.assertEqual(self.lanes.conflated, {DEVICE_VALUES: 2})
+
+    def test_newest_wins(self):
+        """
+        Statistics and team changes should be replaced by the newest one.
+        """
+        for cmd_type in (DEVICE_STATS, SM_COMMANDS.SET_TEAM):
+            with self.subTest(cmd_type=cmd_type):
+                self.assertEqual(self.handle_all([cmd_type, [1]], [cmd_type, [2]]),
+                                 [[cmd_type, [2]]])
+
+    def test_ansible(self):
+        """
+        Updates from Dawn should be merged key by key.
+        """
+        handled = self.handle_all([SM_COMMANDS.RECV_ANSIBLE, [{"a": 1, "b": 1}]],
+                                  [SM_COMMANDS.RECV_ANSIBLE, [{"b": 2}]])
+        self.assertEqual(handled, [[SM_COMMANDS.RECV_ANSIBLE, [{"a": 1, "b": 2}]]])
+
+    def test_not_conflated_once_handled(self):
+        """
+        Telemetry that arrives after the last one was handled should not be merged into it.
+        """
+        self.assertEqual(len(self.handle_all([DEVICE_STATS, [1]])), 1)
+        self.assertEqual(self.handle_all([DEVICE_STATS, [2]]), [[DEVICE_STATS, [2]]])
+        self.assertEqual(self.lanes.conflated, {})
+
+    def test_keeps_first_time(self):
+        """
+        Merged telemetry should count as having waited since the first one was sent.
+        """
+        self.state_queue.put([DEVICE_STATS, [1]], sent_at=4.0)
+        self.state_queue.put([DEVICE_STATS, [2]], sent_at=9.0)
+        self.lanes.get()
+        self.assertEqual(self.lanes.max_age[TELEMETRY], 6.0)
+
+
+class StatsTests(LanesTestCase):
+    """
+    Test the summary of how the lanes are doing.
+    """
+    def test_stats(self):
+        """
+        Requests handled and how long they waited should be summarized by lane.
+        """
+        self.state_queue.put([SM_COMMANDS.GET_VAL, [["a"]]], sent_at=9.0)
+        self.state_queue.put([SM_COMMANDS.GET_VAL, [["b"]]], sent_at=7.0)
+        self.state_queue.put([SM_COMMANDS.EMERGENCY_STOP, []], sent_at=9.5)
+        self.state_queue.put([DEVICE_STATS, [1]], sent_at=8.0)
+        for _ in range(3):
+            self.lanes.get()
+        stats = self.lanes.stats()
+        self.assertEqual(stats["waiting"], {CONTROL: 0, REQUEST: 0, TELEMETRY: 1})
+        self.assertEqual(stats["handled"], {CONTROL: 1, REQUEST: 2, TELEMETRY: 0})
+        self.assertEqual(stats["mean_age"], {CONTROL: 0.5, REQUEST: 2.0, TELEMETRY: 0.0})
+        self.assertEqual(stats["max_age"], {CONTROL: 0.5, REQUEST: 3.0, TELEMETRY: 0.0})
+        self.assertEqual(self.lanes.stats()["max_age"], dict.fromkeys(stats["max_age"], 0.0))
@@ -0,0 +1,270 @@
+"""
+Unit tests for statestore.
+"""
+import unittest
+
+from statestore import StateStore
+from statemanager import StateManager
+from runtime_tests.utils import FakeClock
+
+# A state tree in the format StateManager used before StateStore
+NESTED = {
+    "hibike": [{
+        "devices": [{
+            7: [{"duty_cycle": [0.5, 1.0], "enc_pos": [3, 1.5]}, 1.5],
+        }, 1.5],
+        "device_subscribed": [1, 1.0],
+    }, 1.5],
+    "gamepads": [{0: [{"axes": [[0.0, 0.0], 2.0]}, 2.0]}, 2.0],
+    "limits": [{"low": 1, "high": 2}, 3.0],
+    "empty": [{}, 4.0],
+}
+
+
+class StateStoreTests(unittest.TestCase):
+    """
+    Test reading and writing the store.
+    """
+    def setUp(self):
+        self.clock = FakeClock(10.0)
+        self.store = StateStore(NESTED, clock=self.clock)
+
+    def test_load(self):
+        """
+        A loaded tree should be read back as it was, keeping its timestamps.
+        """
+        self.assertEqual(self.store.nested(), NESTED)
+        self.assertEqual(self.store.get(("hibike", "devices", 7, "enc_pos")), 3)
+        self.assertEqual(self.store.timestamp(("gamepads", 0)), 2.0)
+
+    def test_load_values(self):
+        """
+        Dictionaries that are not made of entries, and lists, should be values.
+        """
+        self.assertEqual(self.store.get(("limits",)), {"low": 1, "high": 2})
+        self.assertEqual(self.store.get(("gamepads", 0, "axes")), [0.0, 0.0])
+        self.assertEqual(self.store.get(("empty",)), {})
+
+    def test_load_replaces(self):
+        """
+        Loading keys that already exist should replace them and what is under them.
+        """
+        self.store.load({7: [{"duty_cycle": [1.0, 5.0]}, 5.0]}, ("hibike", "devices"))
+        self.assertEqual(self.store.get(("hibike", "devices")), {7: [{"duty_cycle": [1.0, 5.0]},
+                                                                     5.0]})
+        self.assertNotIn(("hibike", "devices", 7, "enc_pos"), self.store)
+
+    def test_get_missing(self):
+        """
+        Reading a path that doesn't exist should raise KeyError.
+        """
+        with self.assertRaises(KeyError):
+            self.store.get(("hibike", "devices", 8))
+
+    def test_set(self):
+        """
+        Setting a value should stamp it and its ancestors with the batch time.
+        """
+        self.clock.time = 20.0
+        self.store.set(("hibike", "devices", 7, "duty_cycle"), -0.5)
+        self.assertEqual(self.store.get(("hibike", "devices", 7)),
+                         {"duty_cycle": [-0.5, 20.0], "enc_pos": [3, 1.5]})
+        for path in (("hibike", "devices", 7), ("hibike", "devices"), ("hibike",)):
+            self.assertEqual(self.store.timestamp(path), 20.0)
+        self.assertEqual(self.store.timestamp(("gamepads",)), 2.0)
+
+    def test_set_missing(self):
+        """
+        Setting a path that doesn't exist should raise KeyError and change nothing.
+        """
+        with self.assertRaises(KeyError):
+            self.store.set(("hibike", "devices", 8), 1)
+        self.assertEqual(self.store.nested(), NESTED)
+
+    def test_set_subtree(self):
+        """
+        Setting a subtree should replace it and everything under it with a value.
+        """
+        self.store.set(("hibike", "devices"), {})
+        self.assertEqual(self.store.get(("hibike", "devices")), {})
+        self.assertNotIn(("hibike", "devices", 7), self.store)
+        with self.assertRaises(KeyError):
+            self.store.get(("hibike", "devices", 7, "duty_cycle"))
+
+    def test_create(self):
+        """
+        Creating a path should make empty subtrees where there is nothing yet.
+        """
+        self.store.create(("hibike", "devices", 8, "switch0"))
+        self.assertEqual(self.store.get(("hibike", "devices", 8)), {"switch0": [{}, 10.0]})
+        self.assertEqual(self.store.get(("hibike", "devices", 7, "enc_pos")), 3)
+        self.store.set(("hibike", "devices", 8, "switch0"), True)
+        self.assertIs(self.store.get(("hibike", "devices", 8, "switch0")), True)
+
+    def test_create_through_value(self):
+        """
+        Creating a path through a value should raise TypeError naming the key.
+        """
+        with self.assertRaisesRegex(TypeError, "key 'device_subscribed' is defined"):
+            self.store.create(("hibike", "device_subscribed", "more"))
+
+    def test_delete(self):
+        """
+        Deleting a subtree should remove it and everything under it.
+        """
+        self.clock.time = 30.0
+        self.store.delete(("hibike", "devices", 7))
+        self.assertEqual(self.store.get(("hibike", "devices")), {})
+        self.assertNotIn(("hibike", "devices", 7, "duty_cycle"), self.store)
+        self.assertEqual(self.store.timestamp(("hibike", "devices")), 30.0)
+        with self.assertRaises(KeyError):
+            self.store.delete(("hibike", "devices", 7))
+
+    def test_update(self):
+        """
+        Updating a subtree should write the keys it has and skip the rest.
+        """
+        version = self.store.version
+        self.store.update(("hibike", "devices", 7), [("duty_cycle", 1.0), ("missing", 2)])
+        self.assertEqual(self.store.get(("hibike", "devices", 7)),
+                         {"duty_cycle": [1.0, 10.0], "enc_pos": [3, 1.5]})
+        self.assertNotIn(("hibike", "devices", 7, "missing"), self.store)
+        self.assertEqual(self.store.version, version + 1)
+        self.assertEqual(self.store.version_of(("hibike", "devices", 7, "duty_cycle")),
+                         self.store.version_of(("hibike",)))
+
+    def test_update_nothing(self):
+        """
+        An update that writes no keys should not change any version.
+        """
+        version = self.store.version
+        self.store.update(("hibike", "devices", 7), [("missing", 2)])
+        self.assertEqual(self.store.version, version)
+
+    def test_batch_clock(self):
+        """
+        Writes in one batch should share a timestamp, reading the clock once.
+        """
+        self.clock.reads = 0
+        self.store.set(("hibike", "device_subscribed"), 2)
+        self.clock.time = 11.0
+        self.store.set(("limits",), None)
+        self.assertEqual(self.clock.reads, 1)
+        self.assertEqual(self.store.timestamp(("limits",)), 10.0)
+        self.store.new_batch()
+        self.store.set(("limits",), None)
+        self.assertEqual(self.store.timestamp(("limits",)), 11.0)
+        self.assertEqual(self.clock.reads, 2)
+
+
+class VersionTests(unittest.TestCase):
+    """
+    Test versions and the changes they are used to find.
+    """
+    def setUp(self):
+        self.store = StateStore(NESTED, clock=FakeClock(10.0))
+
+    def test_versions_increase(self):
+        """
+        Every write should give the path and its ancestors a newer version.
+        """
+        path = ("hibike", "devices", 7, "enc_pos")
+        writes = [lambda: self.store.set(path, 4),
+                  lambda: self.store.update(path[:-1], [("enc_pos", 5)]),
+                  lambda: self.store.create(("hibike", "devices", 8)),
+                  lambda: self.store.delete(("hibike", "devices", 8)),
+                  lambda: self.store.load({"extra": [1, 0.0]})]
+        seen = [self.store.version_of(())]
+        for write in writes:
+            write()
+            self.assertGreater(self.store.version_of(()), seen[-1])
+            seen.append(self.store.version_of(()))
+        self.assertEqual(seen[-1], self.store.version)
+        self.assertLess(self.store.version_of(("gamepads",)), self.store.version)
+
+    def test_changes(self):
+        """
+        Changes since a version should only include the children written after it.
+        """
+        since = self.store.version
+        self.assertIsNone(self.store.changes(("hibike",), since))
+        self.store.set(("hibike", "devices", 7, "enc_pos"), 4)
+        version, changed, keys = self.store.changes(("hibike", "devices", 7), since)
+        self.assertEqual(version, self.store.version)
+        self.assertEqual(changed, {"enc_pos": [4, 10.0]})
+        self.assertEqual(keys, ("duty_cycle", "enc_pos"))
+        self.assertEqual(self.store.changes(("hibike", "devices", 7, "enc_pos"), since),
+                         (self.store.version, 4, None))
+        self.assertIsNone(self.store.changes(("gamepads",), since))
+
+
+class ViewCacheTests(unittest.TestCase):
+    """
+    Test that the nested dictionaries built for subtrees are cached until they change.
+    """
+    def setUp(self):
+        self.store = StateStore(NESTED, clock=FakeClock(10.0))
+
+    def test_cached(self):
+        """
+        Reading an unchanged subtree again should return the same dictionary.
+        """
+        view = self.store.get(("hibike", "devices"))
+        self.assertIs(self.store.get(("hibike", "devices")), view)
+
+    def test_invalidated(self):
+        """
+        Writing under a subtree should rebuild its view and its ancestors', but not others.
+        """
+        devices = self.store.get(("hibike", "devices"))
+        gamepads = self.store.get(("gamepads",))
+        self.store.set(("hibike", "devices", 7, "enc_pos"), 4)
+        rebuilt = self.store.get(("hibike", "devices"))
+        self.assertIsNot(rebuilt, devices)
+        self.assertEqual(rebuilt[7][0]["enc_pos"], [4, 10.0])
+        self.assertIs(self.store.get(("gamepads",)), gamepads)
+        self.assertIs(self.store.nested()["gamepads"][0], gamepads)
+
+    def test_deleted_views_dropped(self):
+        """
+        A subtree that was deleted and created again should not show its old view.
+        """
+        self.store.get(("hibike", "devices", 7))
+        self.store.delete(("hibike", "devices", 7))
+        self.store.create(("hibike", "devices", 7))
+        self.assertEqual(self.store.get(("hibike", "devices", 7)), {})
+
+
+def old_key_error_message(state, keys):
+    """
+    Return the message StateManager built for a missing key by walking
+    the nested STATE, the way it did before StateStore.
+    """
+    result = state
+    for i, key in enumerate(keys):
+        try:
+            result = result[key][0]
+        except (KeyError, IndexError, TypeError):
+            return StateManager.dict_error_message(None, i, keys, result)
+    raise AssertionError("{} is in the state".format(keys))
+
+
+class KeyErrorTests(unittest.TestCase):
+    """
+    Test that errors for missing keys read as they did before StateStore.
+    """
+    def setUp(self):
+        # Only the state store is needed to explain a missing key
+        self.manager = StateManager.__new__(StateManager)
+        self.manager.state_store = StateStore(NESTED, clock=FakeClock(10.0))
+
+    def test_messages_unchanged(self):
+        """
+        Missing keys at any depth, and keys under values, should get the old messages.
+        """
+        for keys in (["missing"], ["hibike", "missing"], ["hibike", "devices", 8],
+                     ["hibike", "devices", 7, "switch0"], ["hibike", "device_subscribed", "x"],
+                     ["limits", "low"], ["empty", "key"], ["gamepads", 0, "axes", 1]):
+            with self.subTest(keys=keys):
+                error = self.manager.key_error(keys)
+                self.assertEqual(str(error), old_key_error_message(NESTED, keys))
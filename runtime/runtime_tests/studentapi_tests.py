@@ -0,0 +1,212 @@
+"""
+Unit tests for studentapi.
+"""
+import pickle
+import unittest
+
+from statemanager import StateManager
+from statestore import StateStore
+from studentapi import StateCache, StudentAPI
+
+from runtimeUtil import PROCESS_NAMES, SM_COMMANDS, StudentAPIKeyError
+
+# StateManager's state, in the format it is loaded from
+NESTED = {
+    "hibike": [{
+        "devices": [{
+            7: [{"duty_cycle": [0.5, 1.0]}, 1.0],
+            8: [{"duty_cycle": [0.0, 1.0]}, 1.0],
+        }, 1.0],
+    }, 1.0],
+    "dawn_addr": [None, 1.0],
+}
+
+
+class FakeManager:
+    """
+    Stands in for both pipes to StateManager, answering each batch with RESULTS.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.commands = []
+
+    def put(self, command):
+        """Keep COMMAND."""
+        self.commands.append(command)
+
+    def recv(self):
+        """Answer the last command."""
+        return self.results
+
+
+class StoreManager:
+    """
+    Stands in for both pipes to a StateManager whose state is in a real
+    `StateStore`, answering tick snapshots the way it does.
+    """
+    def __init__(self, nested):
+        self.manager = StateManager.__new__(StateManager)
+        # Everything written in a test is written at 20.0
+        self.manager.state_store = StateStore(nested, clock=lambda: 20.0)
+        self.manager.process_mapping = {PROCESS_NAMES.STUDENT_CODE: self}
+        self.sent = []
+
+    @property
+    def store(self):
+        """The state StateManager reads from."""
+        return self.manager.state_store
+
+    def put(self, command):
+        """Run COMMAND in StateManager."""
+        command_type, args = command
+        assert command_type == SM_COMMANDS.TICK_SNAPSHOT
+        self.manager.tick_snapshot(*args)
+
+    def send(self, changes):
+        """Keep CHANGES, copied as a pipe would."""
+        self.sent.append(pickle.loads(pickle.dumps(changes)))
+
+    def recv(self):
+        """Answer the last command."""
+        return self.sent[-1]
+
+
+class BatchTests(unittest.TestCase):
+    """
+    Test sending several requests to StateManager together.
+    """
+    def test_results(self):
+        """
+        Every request should be sent in one command and get its result.
+        """
+        manager = FakeManager([1.0, None])
+        with StudentAPI(manager, manager).batch() as batch:
+            batch.get_value("counter")
+            batch.set_value(3.0, "right")
+        self.assertEqual(batch.results, [1.0, None])
+        self.assertEqual(manager.commands, [[SM_COMMANDS.BATCH, [[
+            [SM_COMMANDS.GET_VAL, [["counter"]]],
+            [SM_COMMANDS.SET_VAL, [3.0, ["right"]]]]]]])
+
+    def test_error_keeps_results(self):
+        """
+        When a request fails, the first error should be raised and every result kept.
+        """
+        first, second = StudentAPIKeyError("first"), StudentAPIKeyError("second")
+        manager = FakeManager([1.0, first, True, second])
+        batch = StudentAPI(manager, manager).batch()
+        with self.assertRaises(StudentAPIKeyError) as raised:
+            with batch:
+                for key in ("a", "b", "c", "d"):
+                    batch.get_value(key)
+        self.assertIs(raised.exception, first)
+        self.assertEqual(batch.results, [1.0, first, True, second])
+
+    def test_not_sent_on_error(self):
+        """
+        Requests should not be sent if the block raises.
+        """
+        manager = FakeManager([])
+        with self.assertRaises(RuntimeError):
+            with StudentAPI(manager, manager).batch() as batch:
+                batch.get_value("counter")
+                raise RuntimeError
+        self.assertEqual(manager.commands, [])
+        self.assertIsNone(batch.results)
+
+
+class StateCacheTests(unittest.TestCase):
+    """
+    Test keeping copies of StateManager's state up to date with tick snapshots.
+    """
+    def setUp(self):
+        self.manager = StoreManager(NESTED)
+        self.cache = StateCache(self.manager, self.manager)
+        self.cache.track("hibike", "devices")
+        self.cache.track("dawn_addr")
+
+    def assert_cached(self, *path):
+        """Assert that the copy of PATH matches StateManager's state."""
+        self.assertEqual(self.cache.values[path], self.manager.store.get(path))
+
+    def test_first_get(self):
+        """
+        Getting a path that was never fetched should fetch every tracked path.
+        """
+        self.assertEqual(self.cache.get("hibike", "devices"), NESTED["hibike"][0]["devices"][0])
+        self.assertEqual(len(self.manager.sent), 1)
+        self.assertIsNone(self.cache.get("dawn_addr"))
+        self.assertEqual(len(self.manager.sent), 1)
+
+    def test_merge(self):
+        """
+        Only the children that changed should be sent, and merged into the copy.
+        """
+        self.cache.refresh()
+        self.manager.store.set(("hibike", "devices", 7, "duty_cycle"), 1.0)
+        self.cache.refresh()
+        version, changed, keys = self.manager.sent[-1][("hibike", "devices")]
+        self.assertEqual(version, self.manager.store.version_of(("hibike", "devices")))
+        self.assertEqual(changed, {7: [{"duty_cycle": [1.0, 20.0]}, 20.0]})
+        self.assertEqual(keys, (7, 8))
+        self.assertNotIn(("dawn_addr",), self.manager.sent[-1])
+        self.assert_cached("hibike", "devices")
+        self.assertEqual(self.cache.versions[("hibike", "devices")], version)
+
+    def test_deleted_keys(self):
+        """
+        Children that were removed should be removed from the copy too.
+        """
+        self.cache.refresh()
+        self.manager.store.delete(("hibike", "devices", 8))
+        self.cache.refresh()
+        self.assertEqual(self.manager.sent[-1][("hibike", "devices")][1], {})
+        self.assert_cached("hibike", "devices")
+        self.assertEqual(list(self.cache.get("hibike", "devices")), [7])
+
+    def test_value_replaced(self):
+        """
+        A value should be replaced, even by a subtree, and a subtree by a value.
+        """
+        self.cache.refresh()
+        self.manager.store.set(("dawn_addr",), "10.0.0.2")
+        self.manager.store.set(("hibike", "devices"), None)
+        self.cache.refresh()
+        self.assertEqual(self.cache.get("dawn_addr"), "10.0.0.2")
+        self.assertIsNone(self.cache.get("hibike", "devices"))
+        self.manager.store.load({"devices": [{9: [{"duty_cycle": [0.0, 20.0]}, 20.0]}, 20.0]},
+                                ("hibike",))
+        self.cache.refresh()
+        self.assert_cached("hibike", "devices")
+
+    def test_unchanged(self):
+        """
+        When nothing changed, nothing should be sent and the copies kept.
+        """
+        self.cache.refresh()
+        versions = dict(self.cache.versions)
+        devices = self.cache.get("hibike", "devices")
+        self.cache.refresh()
+        self.assertIsNone(self.manager.sent[-1])
+        self.assertEqual(self.cache.versions, versions)
+        self.assertIs(self.cache.get("hibike", "devices"), devices)
+
+    def test_missing_path(self):
+        """
+        A tracked path that is not in the state should raise the error StateManager explains.
+        """
+        self.cache.track("hibike", "devices", 9)
+        with self.assertRaises(StudentAPIKeyError) as raised:
+            self.cache.refresh()
+        self.assertEqual(str(raised.exception),
+                         str(self.manager.manager.key_error(("hibike", "devices", 9))))
+        self.assertEqual(self.cache.versions[("hibike", "devices", 9)], -1)
+
+    def test_path_deleted(self):
+        """
+        A path that was fetched and then removed should raise, not return the stale copy.
+        """
+        self.cache.refresh()
+        self.manager.store.delete(("hibike", "devices"))
+        with self.assertRaises(StudentAPIKeyError):
+            self.cache.refresh()
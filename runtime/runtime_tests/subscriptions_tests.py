@@ -0,0 +1,152 @@
+"""
+Unit tests for subscriptions.
+"""
+import unittest
+
+import subscriptions
+from subscriptions import SubscriptionScheduler, device_data_size
+
+from runtimeUtil import SENSOR_TYPE
+
+DEVICE_IDS = {name: device_id for device_id, name in SENSOR_TYPE.items()}
+MOTOR_PARAMS = ["duty_cycle", "enc_pos"]
+SWITCH_PARAMS = ["switch0", "switch1", "switch2"]
+
+
+def make_uid(device_name, serial_no):
+    """Return the UID of the DEVICE_NAME with SERIAL_NO."""
+    return DEVICE_IDS[device_name] << 72 | serial_no
+
+
+class SchedulerTests(unittest.TestCase):
+    """
+    Test adding and removing devices, and the delays planned for them.
+    """
+    def setUp(self):
+        self.scheduler = SubscriptionScheduler()
+
+    def test_add_returns_new_device(self):
+        """
+        Every device added should be in the delays returned, at its target rate.
+        """
+        for serial_no in range(1, 4):
+            uid = make_uid("YogiBear", serial_no)
+            self.assertEqual(self.scheduler.add(uid, "YogiBear", MOTOR_PARAMS), {uid: 20})
+        self.assertEqual(len(self.scheduler.delays()), 3)
+
+    def test_add_again_after_reset(self):
+        """
+        A device that reset should get its subscription again, even if its delay is unchanged.
+        """
+        uid = make_uid("LimitSwitch", 1)
+        self.scheduler.add(uid, "LimitSwitch", SWITCH_PARAMS)
+        self.assertEqual(self.scheduler.add(uid, "LimitSwitch", SWITCH_PARAMS), {uid: 40})
+
+    def test_remove(self):
+        """
+        Removing a device with no effect on the others should return no changes.
+        """
+        uid = make_uid("LimitSwitch", 1)
+        self.scheduler.add(uid, "LimitSwitch", SWITCH_PARAMS)
+        self.scheduler.add(make_uid("YogiBear", 2), "YogiBear", MOTOR_PARAMS)
+        self.assertEqual(self.scheduler.remove(uid), {})
+        self.assertNotIn(uid, self.scheduler.subscriptions)
+        self.assertEqual(self.scheduler.remove(uid), {})
+
+    def test_plan_unchanged(self):
+        """
+        Planning again with nothing changed should return no changes.
+        """
+        self.scheduler.add(make_uid("YogiBear", 1), "YogiBear", MOTOR_PARAMS)
+        self.assertEqual(self.scheduler.plan(), {})
+
+
+class BudgetTests(unittest.TestCase):
+    """
+    Test that devices are slowed down to fit the bandwidth budgets.
+    """
+    def test_link_budget(self):
+        """
+        No device should use more than the budget of its link.
+        """
+        uid = make_uid("YogiBear", 1)
+        packet_size = device_data_size(DEVICE_IDS["YogiBear"], MOTOR_PARAMS)
+        scheduler = SubscriptionScheduler(link_budget=packet_size * 10)
+        self.assertEqual(scheduler.add(uid, "YogiBear", MOTOR_PARAMS), {uid: 100})
+
+    def test_least_important_first(self):
+        """
+        Over the total budget, less important devices should be slowed down first.
+        """
+        motor = make_uid("YogiBear", 1)
+        switch = make_uid("LimitSwitch", 2)
+        motor_bytes = device_data_size(DEVICE_IDS["YogiBear"], MOTOR_PARAMS) * 50
+        scheduler = SubscriptionScheduler(total_budget=motor_bytes + 100)
+        scheduler.add(motor, "YogiBear", MOTOR_PARAMS)
+        changed = scheduler.add(switch, "LimitSwitch", SWITCH_PARAMS)
+        self.assertEqual(set(changed), {switch})
+        self.assertEqual(scheduler.subscriptions[motor].delay, 20)
+        self.assertGreater(changed[switch], 40)
+        self.assertLessEqual(scheduler.total_bytes_per_sec(), scheduler.total_budget + 1)
+
+    def test_min_rate(self):
+        """
+        Devices should never be slowed down below the minimum rate.
+        """
+        scheduler = SubscriptionScheduler(total_budget=1)
+        uid = make_uid("LimitSwitch", 1)
+        scheduler.add(uid, "LimitSwitch", SWITCH_PARAMS)
+        self.assertEqual(scheduler.subscriptions[uid].delay, 1000 // subscriptions.MIN_RATE)
+
+    def test_removal_speeds_up(self):
+        """
+        Removing a device should give the bandwidth it freed back to the others.
+        """
+        motor = make_uid("YogiBear", 1)
+        switch = make_uid("LimitSwitch", 2)
+        motor_bytes = device_data_size(DEVICE_IDS["YogiBear"], MOTOR_PARAMS) * 50
+        scheduler = SubscriptionScheduler(total_budget=motor_bytes + 100)
+        scheduler.add(switch, "LimitSwitch", SWITCH_PARAMS)
+        scheduler.add(motor, "YogiBear", MOTOR_PARAMS)
+        self.assertEqual(scheduler.remove(motor), {switch: 40})
+
+
+class PolicyTests(unittest.TestCase):
+    """
+    Test that target rates and priorities come from the device config.
+    """
+    def test_from_config(self):
+        """
+        Device types with a "subscription" in hibikeDevices.json should get its rate and priority.
+        """
+        policies = subscriptions.load_policies()
+        self.assertEqual(policies["YogiBear"], (50, 0))
+        self.assertEqual(policies["BatteryBuzzer"], (2, 3))
+        self.assertNotIn("ExampleDevice", policies)
+
+    def test_custom_policies(self):
+        """
+        A scheduler should plan with the policies it is given, and the default for others.
+        """
+        devices = [{"name": "LimitSwitch", "subscription": {"rate": 5, "priority": 0}},
+                   {"name": "YogiBear"}]
+        scheduler = SubscriptionScheduler(policies=subscriptions.load_policies(devices))
+        switch = make_uid("LimitSwitch", 1)
+        motor = make_uid("YogiBear", 2)
+        self.assertEqual(scheduler.add(switch, "LimitSwitch", SWITCH_PARAMS), {switch: 200})
+        scheduler.add(motor, "YogiBear", MOTOR_PARAMS)
+        self.assertEqual((scheduler.subscriptions[motor].target_rate,
+                          scheduler.subscriptions[motor].priority), subscriptions.DEFAULT_POLICY)
+
+    def test_summary(self):
+        """
+        The summary should show every device's planned delay and the bandwidth used.
+        """
+        scheduler = SubscriptionScheduler()
+        uid = make_uid("YogiBear", 1)
+        scheduler.add(uid, "YogiBear", MOTOR_PARAMS)
+        summary = scheduler.summary()
+        self.assertEqual(summary["bytes_per_sec"], round(scheduler.total_bytes_per_sec()))
+        self.assertEqual(summary["devices"][uid]["delay_ms"], 20)
+        self.assertEqual(summary["devices"][uid]["rate"], 50.0)
+        self.assertEqual(summary["devices"][uid]["priority"], 0)
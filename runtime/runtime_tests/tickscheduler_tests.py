@@ -0,0 +1,186 @@
+"""
+Unit tests for tickscheduler.
+"""
+import random
+import unittest
+
+from tickscheduler import (MIN_HZ, SUSTAINED_OVERRUN, WARN_INTERVAL, TickScheduler, percentile,
+                           summarize)
+from runtime_tests.utils import FakeClock
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """
+    Runs a `TickScheduler` on a fake clock, collecting its warnings.
+    """
+    def setUp(self):
+        self.clock = FakeClock(100.0)
+        self.warnings = []
+
+    def make_scheduler(self, rate_hz, policy):
+        """Return a scheduler for RATE_HZ with POLICY, starting now."""
+        return TickScheduler(rate_hz, policy, warn=self.warnings.append, clock=self.clock)
+
+    def run_ticks(self, scheduler, count, duration, jitter=0.):
+        """
+        Run COUNT ticks whose main function takes DURATION seconds, sleeping as
+        told and waking up JITTER seconds late. DURATION and JITTER may be
+        functions returning the time for each tick.
+        """
+        for _ in range(count):
+            scheduler.tick_started()
+            took = duration() if callable(duration) else duration
+            self.clock.time += took
+            sleep = scheduler.tick_finished(took)
+            self.assertGreaterEqual(sleep, 0)
+            self.clock.time += sleep + (jitter() if callable(jitter) else jitter)
+
+
+class CadenceTests(SchedulerTestCase):
+    """
+    Test that ticks stay on their grid of deadlines.
+    """
+    def test_no_drift(self):
+        """
+        Varying main durations and late wakeups should not move later deadlines.
+        """
+        rng = random.Random(0)
+        start = self.clock.time
+        scheduler = self.make_scheduler(20, "skip")
+        self.run_ticks(scheduler, 1000, lambda: rng.uniform(0, 0.04),
+                       lambda: rng.uniform(0, 0.005))
+        self.assertAlmostEqual(scheduler.deadline, start + 1000 * 0.05)
+        self.assertLessEqual(self.clock.time - scheduler.deadline, 0.005)
+        self.assertEqual(scheduler.stats.overruns, 0)
+        self.assertEqual(scheduler.stats.skipped, 0)
+
+    def test_sleep_errors(self):
+        """
+        How late each tick woke up should be recorded.
+        """
+        scheduler = self.make_scheduler(10, "skip")
+        self.run_ticks(scheduler, 5, 0.01, jitter=0.003)
+        scheduler.tick_started()
+        self.assertEqual(len(scheduler.stats.sleep_errors), 6)
+        self.assertEqual(scheduler.stats.sleep_errors[0], 0)
+        for error in list(scheduler.stats.sleep_errors)[1:]:
+            self.assertAlmostEqual(error, 0.003)
+
+    def test_skip_counts(self):
+        """
+        A tick that overruns should skip the slots it ran over and wake on the next one.
+        """
+        start = self.clock.time
+        scheduler = self.make_scheduler(10, "skip")
+        scheduler.tick_started()
+        self.clock.time += 0.25
+        sleep = scheduler.tick_finished(0.25)
+        self.assertAlmostEqual(sleep, 0.05)
+        self.assertAlmostEqual(scheduler.deadline, start + 0.3)
+        self.assertEqual((scheduler.stats.ticks, scheduler.stats.overruns,
+                          scheduler.stats.skipped), (1, 1, 2))
+        self.clock.time += sleep
+        self.run_ticks(scheduler, 3, 0.01)
+        self.assertEqual((scheduler.stats.ticks, scheduler.stats.overruns,
+                          scheduler.stats.skipped), (4, 1, 2))
+
+    def test_unknown_policy(self):
+        """
+        An overrun policy that doesn't exist should raise ValueError.
+        """
+        with self.assertRaises(ValueError):
+            self.make_scheduler(10, "panic")
+
+
+class OverrunPolicyTests(SchedulerTestCase):
+    """
+    Test what each policy does about sustained overruns.
+    """
+    def test_skip(self):
+        """
+        "skip" should only count sustained overruns.
+        """
+        scheduler = self.make_scheduler(50, "skip")
+        self.run_ticks(scheduler, 3 * SUSTAINED_OVERRUN, 0.05)
+        self.assertEqual(self.warnings, [])
+        self.assertEqual(scheduler.rate_hz, 50)
+        self.assertEqual(scheduler.stats.overruns, 3 * SUSTAINED_OVERRUN)
+
+    def test_not_sustained(self):
+        """
+        Overruns broken up by ticks on time should not be acted on.
+        """
+        scheduler = self.make_scheduler(50, "warn")
+        durations = iter([0.05, 0.001] * 2 * SUSTAINED_OVERRUN)
+        self.run_ticks(scheduler, 4 * SUSTAINED_OVERRUN, lambda: next(durations))
+        self.assertEqual(self.warnings, [])
+        self.assertEqual(scheduler.stats.overruns, 2 * SUSTAINED_OVERRUN)
+
+    def test_degrade(self):
+        """
+        "degrade" should lower the rate to one the main function keeps up with, once.
+        """
+        scheduler = self.make_scheduler(50, "degrade")
+        self.run_ticks(scheduler, SUSTAINED_OVERRUN, 0.05)
+        # Each tick took 60 ms, but 16 Hz leaves 50 ms for 80% of each period
+        self.assertEqual(scheduler.rate_hz, 16)
+        self.assertAlmostEqual(scheduler.period, 1 / 16)
+        self.assertEqual(scheduler.target_rate_hz, 50)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn("instead of 50 Hz", self.warnings[0])
+        self.assertIn("Lowering its rate to 16 Hz", self.warnings[0])
+        overruns = scheduler.stats.overruns
+        self.run_ticks(scheduler, 3 * SUSTAINED_OVERRUN, 0.05)
+        self.assertEqual(scheduler.stats.overruns, overruns)
+        self.assertEqual(len(self.warnings), 1)
+        summary = scheduler.summary()
+        self.assertEqual((summary["rate_hz"], summary["target_rate_hz"], summary["policy"]),
+                         (16, 50, "degrade"))
+
+    def test_degrade_minimum(self):
+        """
+        "degrade" should not lower the rate below `MIN_HZ`.
+        """
+        scheduler = self.make_scheduler(10, "degrade")
+        self.run_ticks(scheduler, SUSTAINED_OVERRUN, 2.0)
+        self.assertEqual(scheduler.rate_hz, MIN_HZ)
+        self.assertEqual(len(self.warnings), 1)
+
+    def test_warn(self):
+        """
+        "warn" should keep the rate and warn at most every `WARN_INTERVAL` seconds.
+        """
+        scheduler = self.make_scheduler(50, "warn")
+        self.run_ticks(scheduler, SUSTAINED_OVERRUN, 0.05)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn("main is running at 16.7 Hz instead of 50 Hz", self.warnings[0])
+        self.assertEqual(scheduler.rate_hz, 50)
+        warned_at = self.clock.time
+        while self.clock.time - warned_at < WARN_INTERVAL - 1:
+            self.run_ticks(scheduler, SUSTAINED_OVERRUN, 0.05)
+        self.assertEqual(len(self.warnings), 1)
+        self.run_ticks(scheduler, 2 * SUSTAINED_OVERRUN, 0.05)
+        self.assertEqual(len(self.warnings), 2)
+
+
+class SummaryTests(unittest.TestCase):
+    """
+    Test the percentiles the stats are summarized with.
+    """
+    def test_percentile(self):
+        """
+        Percentiles should be values in the list, and None for an empty one.
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertEqual(percentile([7], 0.5), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_summarize(self):
+        """
+        Summaries should be in milliseconds, with None when there is nothing to summarize.
+        """
+        self.assertEqual(summarize([0.002, 0.001, 0.004]), {"p50": 2.0, "p99": 4.0, "max": 4.0})
+        self.assertEqual(summarize([]), {"p50": None, "p99": None, "max": None})
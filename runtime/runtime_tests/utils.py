@@ -0,0 +1,16 @@
+"""
+General utilities for unit tests.
+"""
+
+
+class FakeClock:
+    """
+    A clock that only moves when told to, counting how often it is read.
+    """
+    def __init__(self, start=0.0):
+        self.time = start
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.time
@@ -0,0 +1,97 @@
+"""Packaging the robot's state into ``RuntimeData`` for Dawn.
+
+``RuntimeDataPackager`` lives next to StateManager's ``StateStore`` and keeps
+each device's ``SensorData`` already serialized. Each call to ``package``
+only re-encodes devices with a param that changed since the last call, and
+splices the cached bytes of every other device into the message: a
+serialized protobuf message is the concatenation of its encoded fields, so
+``RuntimeData`` is the encoded ``robot_state`` followed by one
+length-delimited ``sensor_data`` field per device.
+"""
+import runtime_pb2
+
+from runtimeUtil import *
+
+DEVICES_PATH = ("hibike", "devices")
+ROBOT_STATE_PATH = ("studentCodeState",)
+
+# Key of RuntimeData.sensor_data: field 2, length-delimited
+SENSOR_DATA_TAG = bytes([(2 << 3) | 2])
+
+
+def encode_varint(number):
+    """Encode a non-negative integer as a protobuf varint."""
+    encoded = bytearray()
+    while number > 0x7f:
+        encoded.append((number & 0x7f) | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def encode_sensor_data(uid, params):
+    """
+    Serialize the ``sensor_data`` field for the device UID, whose PARAMS are
+    ``{param: [value, timestamp]}``. Params that are None are left out.
+    """
+    sensor = runtime_pb2.RuntimeData.SensorData()
+    sensor.uid = str(uid)
+    sensor.device_type = SENSOR_TYPE[uid >> 72]
+    for param, (value, _) in params.items():
+        if value is None:
+            continue
+        param_value_pair = sensor.param_value.add()
+        param_value_pair.param = param
+        if isinstance(value, bool):
+            param_value_pair.bool_value = value
+        elif isinstance(value, float):
+            param_value_pair.float_value = value
+        elif isinstance(value, int):
+            param_value_pair.int_value = value
+    payload = sensor.SerializeToString()
+    return SENSOR_DATA_TAG + encode_varint(len(payload)) + payload
+
+
+class RuntimeDataPackager:
+    """
+    Serialized ``RuntimeData`` for the state in a `StateStore`, re-encoding
+    only what changed.
+    """
+
+    def __init__(self, state_store):
+        self.state_store = state_store
+        # Version of the state the cached bytes were built from
+        self.version = -1
+        self.robot_state = None
+        self.header = b""
+        # {uid: serialized sensor_data field}, in the order of the devices
+        self.sensors = {}
+        self.message = None
+        # Devices encoded and reused, for tuning
+        self.encoded = 0
+        self.reused = 0
+
+    def package(self):
+        """
+        Return the current state as a serialized ``RuntimeData``.
+        """
+        robot_state = self.state_store.get(ROBOT_STATE_PATH)
+        changes = self.state_store.changes(DEVICES_PATH, self.version)
+        if changes is None and robot_state == self.robot_state and self.message is not None:
+            return self.message
+        if robot_state != self.robot_state:
+            self.robot_state = robot_state
+            self.header = runtime_pb2.RuntimeData(robot_state=robot_state).SerializeToString()
+        if changes is not None:
+            self.version, changed, uids = changes
+            sensors = {}
+            for uid in uids:
+                if uid in changed:
+                    sensors[uid] = encode_sensor_data(uid, changed[uid][0])
+                    self.encoded += 1
+                else:
+                    sensors[uid] = self.sensors[uid]
+                    self.reused += 1
+            self.sensors = sensors
+        self.message = self.header + b"".join(self.sensors.values())
+        return self.message
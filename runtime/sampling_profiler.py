@@ -0,0 +1,183 @@
+"""A low-overhead sampling profiler that can be turned on in a running process.
+
+Every runtime process calls ``install`` when it starts. After that, sending
+the process ``START_SIGNAL`` starts a ``setitimer(ITIMER_PROF)`` timer that
+records the stack of every thread about ``SAMPLE_HZ`` times per second of CPU
+time, and ``STOP_SIGNAL`` stops it and writes the samples to
+``PROFILE_DIR`` as
+
+  * ``<process>-<start>-<end>.folded``: one ``frame;frame;frame count`` line
+    per distinct stack, for flamegraph.pl and speedscope, and
+  * ``<process>-<start>-<end>.callgrind``: for KCachegrind/QCachegrind,
+
+where ``<start>`` and ``<end>`` are local times like ``20240101T120000``.
+
+Use ``SM_COMMANDS.PROFILE`` to toggle profiling; StateManager forwards it to
+runtime, which knows the PIDs of its children.
+"""
+import collections
+import os
+import signal
+import sys
+import time
+
+# Signals that start and stop sampling
+START_SIGNAL = signal.SIGUSR1
+STOP_SIGNAL = signal.SIGUSR2
+PROFILER_SIGNALS = (START_SIGNAL, STOP_SIGNAL)
+# Samples per second of CPU time
+SAMPLE_HZ = 200
+# Where profiles are written
+PROFILE_DIR = os.environ.get("PIE_PROFILE_DIR", "/tmp/runtime-profiles")
+TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+
+class SamplingProfiler:
+    """Collect stack samples of every thread in this process."""
+
+    def __init__(self, process_name, sample_hz=SAMPLE_HZ, profile_dir=PROFILE_DIR):
+        self.process_name = process_name
+        self.interval = 1 / sample_hz
+        self.profile_dir = profile_dir
+        # {stack: number of samples}, each stack a tuple of (file, function, line), root first
+        self.samples = collections.Counter()
+        self.started = None
+
+    @property
+    def running(self):
+        """Whether samples are being collected."""
+        return self.started is not None
+
+    def start(self):
+        """Start sampling, discarding any earlier samples."""
+        if self.running:
+            return
+        self.samples.clear()
+        self.started = time.time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """Stop sampling and write the profile. Returns the paths written."""
+        if not self.running:
+            return []
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        started, self.started = self.started, None
+        return self.dump(started, time.time())
+
+    def _sample(self, _signum, _frame):
+        for thread_frame in sys._current_frames().values(): # pylint: disable=protected-access
+            stack = []
+            frame = thread_frame
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            # The innermost frame of the interrupted thread is this handler
+            if stack and stack[0][1] == "_sample":
+                stack.pop(0)
+            if stack:
+                stack.reverse()
+                self.samples[tuple(stack)] += 1
+
+    def dump(self, started, stopped):
+        """Write the collected samples. Returns the paths written."""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, "{}-{}-{}".format(
+            self.process_name, time.strftime(TIME_FORMAT, time.localtime(started)),
+            time.strftime(TIME_FORMAT, time.localtime(stopped))))
+        paths = [base + ".folded", base + ".callgrind"]
+        with open(paths[0], "w") as folded:
+            write_folded(self.samples, folded)
+        with open(paths[1], "w") as callgrind:
+            write_callgrind(self.samples, callgrind, self.process_name)
+        return paths
+
+
+def frame_label(frame):
+    """Name a (file, function, line) frame for collapsed stacks."""
+    filename, function, _ = frame
+    return "{} ({})".format(function, os.path.basename(filename))
+
+
+def write_folded(samples, out):
+    """Write SAMPLES as collapsed stacks."""
+    folded = collections.Counter()
+    for stack, count in samples.items():
+        folded[";".join(frame_label(frame) for frame in stack)] += count
+    for stack, count in sorted(folded.items()):
+        out.write("{} {}\n".format(stack, count))
+
+
+def count_costs(samples):
+    """
+    Count the samples of each function in SAMPLES.
+
+    Returns:
+        ``(self_cost, calls)``, where ``self_cost`` is
+        ``{(file, function): {line: self samples}}`` and ``calls`` is
+        ``{(caller file, caller function): {(call line, callee file, callee function):
+        [calls, inclusive samples]}}``
+    """
+    self_cost = collections.defaultdict(collections.Counter)
+    calls = collections.defaultdict(dict)
+    for stack, count in samples.items():
+        filename, function, line = stack[-1]
+        self_cost[filename, function][line] += count
+        seen = set()
+        for caller, callee in zip(stack, stack[1:]):
+            edge = (caller[:2], caller[2], callee[:2])
+            # Count recursive edges once per sample
+            if edge in seen:
+                continue
+            seen.add(edge)
+            call = calls[caller[:2]].setdefault((caller[2],) + callee[:2], [0, 0])
+            call[0] += count
+            call[1] += count
+    return self_cost, calls
+
+
+def write_callgrind(samples, out, process_name):
+    """Write SAMPLES in callgrind format, with self and inclusive sample counts."""
+    self_cost, calls = count_costs(samples)
+    out.write("# callgrind format\nversion: 1\ncreator: sampling_profiler\n")
+    out.write("cmd: {}\nevents: Samples\n\n".format(process_name))
+    for filename, function in sorted(set(self_cost) | set(calls)):
+        out.write("fl={}\nfn={}\n".format(filename, function))
+        for line, count in sorted(self_cost[filename, function].items()):
+            out.write("{} {}\n".format(line, count))
+        for (line, callee_file, callee_function), (num_calls, cost) in sorted(
+                calls[filename, function].items()):
+            out.write("cfl={}\ncfn={}\ncalls={} 0\n{} {}\n".format(
+                callee_file, callee_function, num_calls, line, cost))
+        out.write("\n")
+
+
+_PROFILER = None
+
+
+def block_signals():
+    """
+    Hold ``START_SIGNAL`` and ``STOP_SIGNAL`` until `install` is called, instead
+    of letting them kill the process. Processes started from this one, even by
+    exec like the forkserver, inherit this.
+    """
+    signal.pthread_sigmask(signal.SIG_BLOCK, PROFILER_SIGNALS)
+
+
+def install(process_name):
+    """
+    Let this process be profiled with ``START_SIGNAL`` and ``STOP_SIGNAL``,
+    handling any that were held by `block_signals`.
+    """
+    global _PROFILER # pylint: disable=global-statement
+    _PROFILER = SamplingProfiler(process_name)
+    signal.signal(START_SIGNAL, lambda *_: _PROFILER.start())
+    signal.signal(STOP_SIGNAL, lambda *_: _PROFILER.stop())
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, PROFILER_SIGNALS)
+
+
+def signal_process(pid, start):
+    """Ask process PID to start or stop profiling."""
+    os.kill(pid, START_SIGNAL if start else STOP_SIGNAL)
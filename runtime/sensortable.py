@@ -0,0 +1,276 @@
+"""A table of sensor values in shared memory.
+
+Hibike writes sensor values into the table as soon as they arrive, student
+code reads them without going through StateManager, and StateManager decides
+which device lives in which slot.
+
+The table is a fixed array of ``MAX_DEVICES`` slots. Each slot has two parts:
+
+  * an owner header, written only by StateManager, holding the UID the slot
+    is allocated to, and
+  * a values block, written only by Hibike, holding the UID the values belong
+    to, a bitmask of params that have a value, and one 8-byte cell per param
+    (indexed by param number, packed with the param's type from
+    hibikeDevices.json).
+
+Both parts are guarded by a seqlock: the writer makes the sequence number odd
+while writing and even again afterwards, and readers retry if the sequence
+number was odd or changed while they were reading. A reader only trusts values
+whose UID matches the slot's owner, so values left over from a previous device
+are never returned.
+
+The table lives in ``multiprocessing.shared_memory`` on Python 3.8 and later,
+and in a ``MappedFile`` in ``/dev/shm`` before that. If runtime did not create
+a table, ``SensorTable.attach`` returns None and callers fall back to asking
+StateManager.
+"""
+import mmap
+import os
+import struct
+import tempfile
+
+from runtimeUtil import HIBIKE_DEVICES, PARAM_TYPES
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Environment variable runtime uses to tell its children the table's name
+SENSOR_TABLE_ENV = "PIE_SENSOR_TABLE"
+
+MAX_DEVICES = 32
+MAX_PARAMS = 16
+CELL_SIZE = 8
+# Give up on a read after this many torn attempts
+MAX_READ_ATTEMPTS = 100
+
+# {device_id: {param name: (param number, struct for the param's type)}}
+PARAM_LAYOUT = {device["id"]: {param["name"]: (param["number"],
+                                               struct.Struct("<" + PARAM_TYPES[param["type"]]))
+                               for param in device["params"]}
+                for device in HIBIKE_DEVICES}
+
+# Table header: layout version, bumped by StateManager whenever a slot changes owner
+TABLE_HEADER = struct.Struct("<I")
+# Owner header: seq, uid bits 95:64, uid bits 63:0
+OWNER_HEADER = struct.Struct("<IIQ")
+# Values header: seq, params with a value, padding, uid bits 95:64, uid bits 63:0
+VALUES_HEADER = struct.Struct("<IHxxIQ")
+SEQ = struct.Struct("<I")
+# uid bits 95:64 of an empty slot; real UIDs are only 88 bits long
+EMPTY = 0xFFFFFFFF
+UID_LOW_MASK = 0xFFFFFFFFFFFFFFFF
+
+OWNER_OFFSET = 0
+VALUES_OFFSET = OWNER_OFFSET + OWNER_HEADER.size
+CELLS_OFFSET = VALUES_OFFSET + 24
+SLOT_SIZE = CELLS_OFFSET + MAX_PARAMS * CELL_SIZE
+TABLE_SIZE = TABLE_HEADER.size + MAX_DEVICES * SLOT_SIZE
+
+
+class MappedFile:
+    """
+    Shared memory in a file mapped into memory, with the parts of the
+    ``shared_memory.SharedMemory`` interface the table uses. NAME is the
+    file's path.
+    """
+    # Where to create files; /dev/shm keeps them in memory on Linux
+    DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    def __init__(self, name=None, create=False, size=0):
+        if create:
+            descriptor, name = tempfile.mkstemp(prefix="pie_sensors_", dir=self.DIRECTORY)
+            os.ftruncate(descriptor, size)
+        else:
+            descriptor = os.open(name, os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(descriptor, size or os.fstat(descriptor).st_size)
+        finally:
+            os.close(descriptor)
+        self.name = name
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        """Unmap the file."""
+        self.buf.release()
+        self._mmap.close()
+
+    def unlink(self):
+        """Remove the file."""
+        os.unlink(self.name)
+
+
+# Backing store of the table on this version of Python
+SharedMemory = MappedFile if shared_memory is None else shared_memory.SharedMemory
+
+
+class SensorTable:
+    """A view of the shared sensor table.
+
+    Use ``create`` in the process that owns the table (runtime) and ``attach``
+    everywhere else.
+    """
+
+    def __init__(self, shm):
+        self._shm = shm
+        self._buf = shm.buf
+        self._slots = {}
+        self._layout_version = None
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def create(cls):
+        """Create a new, empty table. Returns None if shared memory is unavailable."""
+        try:
+            table = cls(SharedMemory(create=True, size=TABLE_SIZE))
+        except OSError:
+            return None
+        TABLE_HEADER.pack_into(table._buf, 0, 0)
+        for slot in range(MAX_DEVICES):
+            base = table._slot_offset(slot)
+            OWNER_HEADER.pack_into(table._buf, base + OWNER_OFFSET, 0, EMPTY, 0)
+            VALUES_HEADER.pack_into(table._buf, base + VALUES_OFFSET, 0, 0, EMPTY, 0)
+        return table
+
+    @classmethod
+    def attach(cls, name=None):
+        """Attach to an existing table, by default the one named in ``SENSOR_TABLE_ENV``.
+
+        Returns None if there is no table to attach to.
+        """
+        name = name or os.environ.get(SENSOR_TABLE_ENV)
+        if not name:
+            return None
+        try:
+            return cls(SharedMemory(name=name))
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        """Detach from the table."""
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        """Destroy the table. Only the creator should call this."""
+        self._shm.unlink()
+
+    @staticmethod
+    def _slot_offset(slot):
+        return TABLE_HEADER.size + slot * SLOT_SIZE
+
+    def _read_owner(self, slot):
+        """Read the UID that SLOT is allocated to, or None if it is empty."""
+        base = self._slot_offset(slot) + OWNER_OFFSET
+        for _ in range(MAX_READ_ATTEMPTS):
+            seq, uid_high, uid_low = OWNER_HEADER.unpack_from(self._buf, base)
+            if seq & 1 or SEQ.unpack_from(self._buf, base)[0] != seq:
+                continue
+            return None if uid_high == EMPTY else (uid_high << 64) | uid_low
+        raise TimeoutError("sensor table slot {} is stuck mid-write".format(slot))
+
+    def _write_owner(self, slot, uid):
+        base = self._slot_offset(slot) + OWNER_OFFSET
+        seq, = SEQ.unpack_from(self._buf, base)
+        SEQ.pack_into(self._buf, base, seq + 1)
+        if uid is None:
+            OWNER_HEADER.pack_into(self._buf, base, seq + 1, EMPTY, 0)
+        else:
+            OWNER_HEADER.pack_into(self._buf, base, seq + 1, uid >> 64, uid & UID_LOW_MASK)
+        SEQ.pack_into(self._buf, base, seq + 2)
+
+    def _bump_layout_version(self):
+        version, = TABLE_HEADER.unpack_from(self._buf, 0)
+        TABLE_HEADER.pack_into(self._buf, 0, (version + 1) & 0xFFFFFFFF)
+
+    def slot_of(self, uid):
+        """Return the slot allocated to UID, or None if it has none."""
+        version, = TABLE_HEADER.unpack_from(self._buf, 0)
+        if version != self._layout_version:
+            self._slots = {}
+            for slot in range(MAX_DEVICES):
+                owner = self._read_owner(slot)
+                if owner is not None:
+                    self._slots[owner] = slot
+            self._layout_version = version
+        return self._slots.get(uid)
+
+    # StateManager side
+
+    def allocate(self, uid):
+        """Give UID a slot, returning its index, or None if the table is full."""
+        slot = self.slot_of(uid)
+        if slot is not None:
+            return slot
+        for slot in range(MAX_DEVICES):
+            if self._read_owner(slot) is None:
+                self._write_owner(slot, uid)
+                self._bump_layout_version()
+                return slot
+        return None
+
+    def free(self, uid):
+        """Release the slot allocated to UID, if any."""
+        slot = self.slot_of(uid)
+        if slot is not None:
+            self._write_owner(slot, None)
+            self._bump_layout_version()
+
+    # Hibike side
+
+    def write(self, uid, params_and_values): # pylint: disable=too-many-locals
+        """Store PARAMS_AND_VALUES for UID.
+
+        Returns False if UID has no slot (yet), in which case nothing is written.
+        """
+        slot = self.slot_of(uid)
+        if slot is None:
+            return False
+        layout = PARAM_LAYOUT[uid >> 72]
+        base = self._slot_offset(slot)
+        values_base = base + VALUES_OFFSET
+        cells_base = base + CELLS_OFFSET
+        buf = self._buf
+        seq, valid, uid_high, uid_low = VALUES_HEADER.unpack_from(buf, values_base)
+        if (uid_high << 64) | uid_low != uid:
+            valid = 0
+        SEQ.pack_into(buf, values_base, seq + 1)
+        for param, value in params_and_values:
+            number, param_struct = layout[param]
+            param_struct.pack_into(buf, cells_base + number * CELL_SIZE, value)
+            valid |= 1 << number
+        VALUES_HEADER.pack_into(buf, values_base, seq + 1, valid, uid >> 64, uid & UID_LOW_MASK)
+        SEQ.pack_into(buf, values_base, seq + 2)
+        return True
+
+    # Student code side
+
+    def read(self, uid, param):
+        """Read the value of PARAM for UID.
+
+        Returns None if the param hasn't been received yet.
+        Raises KeyError if UID has no slot.
+        """
+        slot = self.slot_of(uid)
+        if slot is None:
+            raise KeyError(uid)
+        number, param_struct = PARAM_LAYOUT[uid >> 72][param]
+        base = self._slot_offset(slot)
+        values_base = base + VALUES_OFFSET
+        cell = base + CELLS_OFFSET + number * CELL_SIZE
+        buf = self._buf
+        for _ in range(MAX_READ_ATTEMPTS):
+            seq, valid, uid_high, uid_low = VALUES_HEADER.unpack_from(buf, values_base)
+            if seq & 1:
+                continue
+            value = param_struct.unpack_from(buf, cell)[0]
+            if SEQ.unpack_from(buf, values_base)[0] != seq:
+                continue
+            if (uid_high << 64) | uid_low != uid or not valid & (1 << number):
+                return None
+            return value
+        raise TimeoutError("sensor table slot {} is stuck mid-write".format(slot))
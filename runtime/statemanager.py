@@ -4,7 +4,16 @@ import traceback
 
 import runtime_pb2
 
+from codecache import CodeCache, student_code_path
 from runtimeUtil import *
+from runtimedata import RuntimeDataPackager
+from sensortable import SensorTable
+from statequeue import InputLanes
+from statestore import StateStore
+from subscriptions import SubscriptionScheduler
+
+# Time in seconds between updates of the input lane statistics in the state
+LANE_STATS_INTERVAL = 5
 
 
 class StateManager: # pylint: disable=too-many-public-methods
@@ -17,12 +26,17 @@ class StateManager: # pylint: disable=too-many-public-methods
     def __init__(self, badThingsQueue, inputQueue, runtimePipe):
         self.init_robot_state()
         self.bad_things_queue = badThingsQueue
-        self.input_ = inputQueue
+        self.input_ = InputLanes(inputQueue)
+        self.next_lane_stats = time.monotonic() + LANE_STATS_INTERVAL
         self.command_mapping = self.make_command_map()
+        self.batch_mapping = self.make_batch_map()
         self.hibike_mapping = self.make_hibike_map()
         self.hibike_response_mapping = self.make_hibike_response_map()
         self.device_name_to_subscribe_params = self.make_subscription_map()
         self.process_mapping = {PROCESS_NAMES.RUNTIME: runtimePipe}
+        self.sensor_table = SensorTable.attach()
+        self.subscription_scheduler = SubscriptionScheduler()
+        self.code_cache = CodeCache()
 
     @staticmethod
     def make_subscription_map():
@@ -64,9 +78,26 @@ class StateManager: # pylint: disable=too-many-public-methods
             SM_COMMANDS.ENTER_AUTO: self.enter_auto,
             SM_COMMANDS.END_STUDENT_CODE: self.end_student_code,
             SM_COMMANDS.SET_TEAM: self.set_team,
+            SM_COMMANDS.PROFILE: self.profile,
+            SM_COMMANDS.BATCH: self.batch,
+            SM_COMMANDS.TICK_SNAPSHOT: self.tick_snapshot,
+            SM_COMMANDS.PROMOTE_STANDBY: self.promote_standby,
+            SM_COMMANDS.PROCESS_STARTED: self.process_started,
         }
         return command_mapping
 
+    def make_batch_map(self):
+        """
+        Create a mapping between the commands that can be batched and the
+        functions that return their results.
+        """
+        return {
+            SM_COMMANDS.GET_VAL: self.try_get_value,
+            SM_COMMANDS.SET_VAL: self.try_set_value,
+            SM_COMMANDS.CREATE_KEY: self.try_create_key,
+            SM_COMMANDS.GET_TIME: self.try_get_timestamp,
+        }
+
     def make_hibike_map(self):
         """
         Create a mapping between Hibike commands and Hibike functions.
@@ -77,7 +108,8 @@ class StateManager: # pylint: disable=too-many-public-methods
             HIBIKE_COMMANDS.READ: self.hibike_read_params,
             HIBIKE_COMMANDS.WRITE: self.hibike_write_params,
             HIBIKE_COMMANDS.DISABLE: self.hibike_disable,
-            HIBIKE_COMMANDS.TIMESTAMP_DOWN: self.hibike_timestamp_down
+            HIBIKE_COMMANDS.TIMESTAMP_DOWN: self.hibike_timestamp_down,
+            HIBIKE_COMMANDS.STATS: self.hibike_stats,
         }
         return hibike_mapping
 
@@ -89,7 +121,8 @@ class StateManager: # pylint: disable=too-many-public-methods
             HIBIKE_RESPONSE.DEVICE_SUBBED: self.hibike_response_device_subbed,
             HIBIKE_RESPONSE.DEVICE_VALUES: self.hibike_response_device_values,
             HIBIKE_RESPONSE.DEVICE_DISCONNECT: self.hibike_response_device_disconnect,
-            HIBIKE_RESPONSE.TIMESTAMP_UP: self.hibike_response_timestamp_up
+            HIBIKE_RESPONSE.TIMESTAMP_UP: self.hibike_response_timestamp_up,
+            HIBIKE_RESPONSE.DEVICE_STATS: self.hibike_response_device_stats,
         }
         return {k.value: v for k, v in hibike_response_mapping.items()}
 
@@ -98,7 +131,7 @@ class StateManager: # pylint: disable=too-many-public-methods
         Initialize robot state.
         """
         t = time.time()
-        self.state = {
+        self.state_store = StateStore({
             "studentCodeState": [2, t],
             "limit_switch": [["limit_switch", 0, 123456], t],
             "incrementer": [2, t],
@@ -108,7 +141,9 @@ class StateManager: # pylint: disable=too-many-public-methods
             "dict1": [{"inner_dict1_int": [555, t], "inner_dict_1_string": ["hello", t]}, t],
             "list1": [[[70, t], ["five", t], [14.3, t]], t],
             "string1": ["abcde", t],
-            "runtime_meta": [{"studentCode_main_count": [0, t], "e_stopped": [False, t]}, t],
+            "runtime_meta": [{"studentCode_main_count": [0, t], "e_stopped": [False, t],
+                              "input_lanes": [None, t], "process_startup": [{}, t],
+                              "student_loop": [None, t], "uploaded_code_hash": [None, t]}, t],
             "hibike": [{"device_subscribed": [0, t],
                         "devices": [{-1: [{"major": [RUNTIME_CONFIG.VERSION_MAJOR.value, t],
                                            "minor": [RUNTIME_CONFIG.VERSION_MINOR.value, t],
@@ -116,7 +151,8 @@ class StateManager: # pylint: disable=too-many-public-methods
                                           t],
                                      0: [{"code": [0, t]}, t],
                                      1: [{"code": [0, t]}, t],
-                                     2: [{"code": [0, t]}, t]}, t]}, t],
+                                     2: [{"code": [0, t]}, t]}, t],
+                        "link_stats": [{}, t], "subscription_plan": [None, t]}, t],
             "dawn_addr": [None, t],
             "gamepads": [{0: {"axes": {0: 0.5, 1: -0.5, 2: 1, 3: -1},
                               "buttons": {0: True, 1: False, 2: True, 3: False, 4: True}}}, t],
@@ -125,101 +161,193 @@ class StateManager: # pylint: disable=too-many-public-methods
             "gamecodes": [[64314, 64314, 64314, 64314, 64314, 64314], t],
             "gamecodes_check": [[1543, 3215, 2551, 5354, 1152, 2222], t],
             "rfids": [[6, 1, 3, 5, 2, 4], t],
-        }
+        })
+        self.ansible_packager = RuntimeDataPackager(self.state_store)
+
+    @property
+    def state(self):
+        """
+        The whole state as a tree of [value, timestamp] lists.
+        """
+        return self.state_store.nested()
 
     def add_pipe(self, process_name, pipe):
         self.process_mapping[process_name] = pipe
         pipe.send(RUNTIME_CONFIG.PIPE_READY.value)
 
+    def promote_standby(self, test_name, max_iter, rate_hz, overrun_policy):
+        """
+        Make the standby student code process the running one, and tell it to start.
+        """
+        pipe = self.process_mapping.pop(PROCESS_NAMES.STUDENT_CODE_STANDBY)
+        self.process_mapping[PROCESS_NAMES.STUDENT_CODE] = pipe
+        pipe.send([test_name, max_iter, rate_hz, overrun_policy])
+
+    def process_started(self, process_name, startup_time):
+        """
+        Record how long PROCESS_NAME took from being spawned to running.
+        """
+        path = ("runtime_meta", "process_startup", process_name)
+        if path not in self.state_store:
+            self.state_store.create(path)
+        self.state_store.set(path, startup_time)
+
     def create_key(self, keys, send=True):
         """
         Insert keys into state.
         """
-        curr_dict = self.state
-        path = []
-        for key in keys:
-            try:
-                if key not in curr_dict:
-                    curr_dict[key] = [{}, 0]
-                path.append(curr_dict[key])
-                curr_dict = curr_dict[key][0]
-            except TypeError:
-                error = StudentAPIKeyError(
-                    "key '{}' is defined, but does not contain a dictionary.".format(key))
-                self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
-                return
-        curr_time = time.time()
-        for item in path:
-            item[1] = curr_time
-        if send:
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(None)
+        result = self.try_create_key(keys)
+        if send or isinstance(result, Exception):
+            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(result)
 
     def get_value(self, keys):
         """
         Retrieve values associated with keys.
         """
-        result = self.state
-        try:
-            for i, key in enumerate(keys):
-                result = result[key][0]
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(result)
-        except:
-            error = StudentAPIKeyError(self.dict_error_message(i, keys, result))
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
+        self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(self.try_get_value(keys))
 
     def set_value(self, value, keys, send=True):
         """
         Updates an existing entry in self.state with new value and time.
         """
+        result = self.try_set_value(value, keys)
+        if send:
+            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(result)
+
+    def batch(self, requests):
+        """
+        Run several get, set, create key and get timestamp requests, and send
+        student code a list with the result or error of each one, in order.
+        """
+        results = []
+        for cmd_type, args in requests:
+            if cmd_type in self.batch_mapping:
+                results.append(self.batch_mapping[cmd_type](*args))
+            else:
+                results.append(StudentAPIValueError("{} cannot be batched".format(cmd_type)))
+        self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(results)
+
+    def tick_snapshot(self, versions):
+        """
+        Send student code what changed under each path in VERSIONS, a mapping
+        from paths to the version student code last saw, or None if nothing did.
+        """
+        changes = {}
+        for path, since in versions.items():
+            try:
+                change = self.state_store.changes(path, since)
+            except KeyError:
+                change = self.key_error(path)
+            if change is not None:
+                changes[path] = change
+        self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(changes or None)
+
+    def try_create_key(self, keys):
+        """
+        Insert keys into state. Returns None, or the error to raise in student code.
+        """
+        try:
+            self.state_store.create(tuple(keys))
+        except TypeError as e:
+            return StudentAPIKeyError(str(e))
+        return None
+
+    def try_get_value(self, keys):
+        """
+        Return the value associated with keys, or the error to raise in student code.
+        """
+        try:
+            return self.state_store.get(tuple(keys))
+        except (KeyError, TypeError):
+            return self.key_error(keys)
+
+    def try_set_value(self, value, keys):
+        """
+        Update an existing entry. Returns the value, or the error to raise in student code.
+        """
         assert len(keys) >= 1
-        parent, child, path = None, self.state, []
+        try:
+            self.state_store.set(tuple(keys), value)
+        except (KeyError, TypeError):
+            return self.key_error(keys)
+        return value
 
+    def try_get_timestamp(self, keys):
+        """
+        Return the time keys were last written, or the error to raise in student code.
+        """
         try:
-            for i, key in enumerate(keys):
-                parent, child_and_ts = child, child[key]
-                path.append(child_and_ts)
-                child = child_and_ts[0]
-        except (KeyError, IndexError):
-            error = StudentAPIKeyError(self.dict_error_message(i, keys, child))
-            if send:
-                process = self.process_mapping[PROCESS_NAMES.STUDENT_CODE]
-                process.send(error)
-        else:
-            parent[keys[-1]][0] = value
-            now = time.time()
-            for mapping_and_ts in path:
-                mapping_and_ts[1] = now
-            if send:
-                process = self.process_mapping[PROCESS_NAMES.STUDENT_CODE]
-                process.send(value)
+            return self.state_store.timestamp(tuple(keys))
+        except (KeyError, TypeError):
+            return self.key_error(keys)
 
     def send_ansible(self):
-        self.process_mapping[PROCESS_NAMES.UDP_SEND_PROCESS].send(self.state)
+        """
+        Send the UDP sender the state, already serialized as ``RuntimeData``.
+        """
+        try:
+            message = self.ansible_packager.package()
+        except Exception as e:
+            message = None
+            self.bad_things_queue.put(BadThing(sys.exc_info(),
+                                               "UDP packager has crashed with error:" + str(e),
+                                               event=BAD_EVENTS.UDP_SEND_ERROR,
+                                               printStackTrace=True))
+        self.process_mapping[PROCESS_NAMES.UDP_SEND_PROCESS].send(message)
 
     def recv_ansible(self, new_data):
-        self.state.update(new_data)
+        self.state_store.load(new_data)
 
     def set_team(self, team):
-        if self.state["team_flag_uid"][0] is not None:
+        team_flag_uid = self.state_store.get(("team_flag_uid",))
+        if team_flag_uid is not None:
             self.hibike_write_params(self.process_mapping[PROCESS_NAMES.HIBIKE],
-                                     self.state["team_flag_uid"][0], [(team, True)])
-            self.state["team_flag_uid"] = [None, 0]
+                                     team_flag_uid, [(team, True)])
+            self.state_store.set(("team_flag_uid",), None)
+
+    def profile(self, start, process_name=None):
+        """
+        Ask runtime to start or stop sampling PROCESS_NAME, or every process if None.
+        """
+        if process_name is not None:
+            try:
+                process_name = PROCESS_NAMES(getattr(process_name, "value", process_name)).value
+            except ValueError:
+                self.bad_things_queue.put(BadThing(sys.exc_info(),
+                                                   "Unknown process name: %s" % (process_name,),
+                                                   event=BAD_EVENTS.UNKNOWN_PROCESS,
+                                                   printStackTrace=False))
+                return
+        self.bad_things_queue.put(BadThing(sys.exc_info(), [process_name, start],
+                                           event=BAD_EVENTS.PROFILE, printStackTrace=False))
 
     def set_addr(self, new_addr):
-        self.state["dawn_addr"] = [new_addr, time.time()]
+        self.state_store.set(("dawn_addr",), new_addr)
         self.bad_things_queue.put(BadThing(sys.exc_info(), None, BAD_EVENTS.NEW_IP, False))
 
     def send_addr(self, process_name):
-        self.process_mapping[process_name].send(self.state["dawn_addr"][0])
+        self.process_mapping[process_name].send(self.state_store.get(("dawn_addr",)))
 
     def student_upload(self):
         """
-        Notifies Dawn to enter idle; then asks for student code.
+        Tells Dawn the student code was received, checks it, sends any problems
+        found to Dawn's console, and then tells student code that is running to
+        reload it between ticks.
+
+        The hash of the new code goes in ("runtime_meta", "uploaded_code_hash"),
+        which running student code fetches with its state every tick.
         """
-        self.bad_things_queue.put(
-            BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_IDLE, False))
-        self.process_mapping[PROCESS_NAMES.TCP_PROCESS].send(
-            [ANSIBLE_COMMANDS.STUDENT_UPLOAD, True])
+        if PROCESS_NAMES.TCP_PROCESS in self.process_mapping:
+            self.process_mapping[PROCESS_NAMES.TCP_PROCESS].send(
+                [ANSIBLE_COMMANDS.STUDENT_UPLOAD, True])
+        try:
+            compiled = self.code_cache.get(student_code_path())
+        except (ImportError, OSError):
+            return
+        if compiled.errors:
+            self.send_console("Problems found in the uploaded code:\n" +
+                              "".join("  {}\n".format(error) for error in compiled.errors))
+        self.state_store.set(("runtime_meta", "uploaded_code_hash"), compiled.source_hash)
 
     def send_console(self, console_log):
         if PROCESS_NAMES.TCP_PROCESS in self.process_mapping:
@@ -233,8 +361,7 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_AUTO, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.AUTO, time.time()]
+        self.state_store.set(("studentCodeState",), runtime_pb2.RuntimeData.AUTO)
 
     def enter_teleop(self):
         """
@@ -243,8 +370,7 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_TELEOP, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.TELEOP, time.time()]
+        self.state_store.set(("studentCodeState",), runtime_pb2.RuntimeData.TELEOP)
 
     def enter_idle(self):
         """
@@ -253,38 +379,29 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_IDLE, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.STUDENT_STOPPED, time.time()]
+        self.state_store.set(("studentCodeState",), runtime_pb2.RuntimeData.STUDENT_STOPPED)
 
     def get_timestamp(self, keys):
         """
         Send a timestamp to student code.
         """
-        curr_dict = self.state
-        timestamp = 0
-        try:
-            for i, key in enumerate(keys):
-                curr_dict, timestamp = curr_dict[key]
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(timestamp)
-        except:
-            error = StudentAPIKeyError(self.dict_error_message(i, keys, curr_dict))
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
+        self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(self.try_get_timestamp(keys))
 
     def student_code_tick(self):
-        self.state["runtime_meta"][0]["studentCode_main_count"][0] += 1
+        path = ("runtime_meta", "studentCode_main_count")
+        self.state_store.set(path, self.state_store.get(path) + 1)
 
     def emergency_stop(self):
         """
         Activate emergency stop.
         """
-        self.state["runtime_meta"][0]["e_stopped"][0] = True
+        self.state_store.set(("runtime_meta", "e_stopped"), True)
         self.bad_things_queue.put(BadThing(sys.exc_info(
         ), "Emergency Stop Activated", event=BAD_EVENTS.EMERGENCY_STOP, printStackTrace=False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.ESTOP, time.time()]
+        self.state_store.set(("studentCodeState",), runtime_pb2.RuntimeData.ESTOP)
 
     def emergency_restart(self):
-        self.state["runtime_meta"][0]["e_stopped"][0] = False
+        self.state_store.set(("runtime_meta", "e_stopped"), False)
 
     def end_student_code(self):
         self.process_mapping[PROCESS_NAMES.UDP_RECEIVE_PROCESS].send(
@@ -310,6 +427,12 @@ class StateManager: # pylint: disable=too-many-public-methods
         data.append(time.perf_counter())
         pipe.send([HIBIKE_COMMANDS.TIMESTAMP_DOWN.value, data])
 
+    def hibike_stats(self, pipe):
+        """
+        Ask Hibike for link statistics right away.
+        """
+        pipe.send([HIBIKE_COMMANDS.STATS.value, []])
+
     def hibike_response_device_subbed(self, uid, delay, params):
         """
         Stores information about subscribed device.
@@ -318,30 +441,59 @@ class StateManager: # pylint: disable=too-many-public-methods
             device_name = SENSOR_TYPE[uid >> 72]
 
             if device_name in self.device_name_to_subscribe_params:
-                self.hibike_subscribe_device(
-                    self.process_mapping[PROCESS_NAMES.HIBIKE], uid, 40,
-                    self.device_name_to_subscribe_params[device_name])
-        self.create_key(["hibike", "devices", uid], send=False)
+                self.resubscribe(self.subscription_scheduler.add(
+                    uid, device_name, self.device_name_to_subscribe_params[device_name]))
+        if self.sensor_table is not None:
+            self.sensor_table.allocate(uid)
+        store = self.state_store
+        store.create(("hibike", "devices", uid))
         for param in params:
-            self.create_key(["hibike", "devices", uid, param], send=False)
-            self.set_value(None, ["hibike", "devices", uid, param], send=False)
-        self.state["hibike"][0]["device_subscribed"][0] += 1
+            store.create(("hibike", "devices", uid, param))
+            store.set(("hibike", "devices", uid, param), None)
+        count_path = ("hibike", "device_subscribed")
+        store.set(count_path, store.get(count_path) + 1)
 
     def hibike_response_device_values(self, data):
         """
         Updates devices' values based on data.
         """
         for uid, params in data.items():
-            for key, value in params:
-                self.set_value(value, ["hibike", "devices", uid, key], send=False)
+            self.state_store.update(("hibike", "devices", uid), params)
 
     # pylint: disable=invalid-name
     def hibike_response_device_disconnect(self, uid):
         """
         Delete any history of the device at UID.
         """
-        devs = self.state["hibike"][0]["devices"][0]
-        del devs[uid]
+        self.state_store.delete(("hibike", "devices", uid))
+        if self.sensor_table is not None:
+            self.sensor_table.free(uid)
+        self.resubscribe(self.subscription_scheduler.remove(uid))
+
+    def update_lane_stats(self):
+        """
+        Record how long requests waited in each input lane, and how many were conflated.
+        """
+        self.state_store.set(("runtime_meta", "input_lanes"), self.input_.stats())
+        self.next_lane_stats = time.monotonic() + LANE_STATS_INTERVAL
+
+    def resubscribe(self, delays):
+        """
+        Send subscription requests for new devices and devices whose planned delay
+        changed, and record the plan in ("hibike", "subscription_plan").
+        """
+        subscriptions = self.subscription_scheduler.subscriptions
+        for uid, delay in delays.items():
+            self.hibike_subscribe_device(self.process_mapping[PROCESS_NAMES.HIBIKE], uid, delay,
+                                         subscriptions[uid].params)
+        self.state_store.set(("hibike", "subscription_plan"),
+                             self.subscription_scheduler.summary())
+
+    def hibike_response_device_stats(self, stats):
+        """
+        Store the latest link statistics for each device.
+        """
+        self.state_store.set(("hibike", "link_stats"), stats)
 
     def hibike_response_timestamp_up(self, *data):
         """
@@ -358,6 +510,21 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         pipe.send([HIBIKE_COMMANDS.DISABLE.value, []])
 
+    def key_error(self, keys):
+        """
+        Explain why there is nothing at KEYS in the state.
+        """
+        keys = list(keys)
+        for errored_index in range(len(keys)):
+            try:
+                found = tuple(keys[:errored_index + 1]) in self.state_store
+            except TypeError: # Unhashable key
+                found = False
+            if not found:
+                break
+        curr_dict = self.state_store.get(tuple(keys[:errored_index]))
+        return StudentAPIKeyError(self.dict_error_message(errored_index, keys, curr_dict))
+
     def dict_error_message(self, errored_index, keys, curr_dict):
         """
         Returns a KeyError dictionary error message.
@@ -410,7 +577,8 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         while True:
             try:
-                request = self.input_.get(block=True)
+                request = self.input_.get()
+                self.state_store.new_batch()
                 cmd_type = request[0]
                 args = request[1]
                 if len(request) != 2:
@@ -422,7 +590,7 @@ class StateManager: # pylint: disable=too-many-public-methods
                     command = self.command_mapping[cmd_type]
                     command(*args)
                 elif cmd_type in self.hibike_mapping:
-                    if not self.state["runtime_meta"][0]["e_stopped"][0]:
+                    if not self.state_store.get(("runtime_meta", "e_stopped")):
                         command = self.hibike_mapping[cmd_type]
                         command(self.process_mapping[PROCESS_NAMES.HIBIKE], *args)
                 elif cmd_type in self.hibike_response_mapping:
@@ -433,6 +601,8 @@ class StateManager: # pylint: disable=too-many-public-methods
                                                        "Unknown process name: %s" % (request,),
                                                        event=BAD_EVENTS.UNKNOWN_PROCESS,
                                                        printStackTrace=False))
+                if time.monotonic() >= self.next_lane_stats:
+                    self.update_lane_stats()
             except Exception as e:
                 formatted_tb = traceback.format_exc()
                 self.bad_things_queue.put(BadThing(sys.exc_info(),
@@ -0,0 +1,195 @@
+"""StateManager's input queue, split into lanes by priority.
+
+Every process sends StateManager requests through one ``StateQueue``, which
+stamps each request with the time it was sent. StateManager moves
+everything that has arrived into ``InputLanes`` and always handles the most
+urgent request first:
+
+  * ``CONTROL``: emergency stops, which jump ahead of everything. Hibike
+    commands check ``e_stopped`` when they are handled, so none that were
+    sent earlier can run after the stop,
+  * ``REQUEST``: everything else, in the order it was sent. Mode changes,
+    ``DISABLE`` and student code's round trips stay in order with each
+    other, so a write sent before a disable is never handled after it, and
+    a reply is never sent down a pipe that was registered after its request,
+  * ``TELEMETRY``: sensor values, gamepads and link statistics.
+
+Telemetry is conflated: a newer request of the same kind is merged into
+one that is still waiting, so however far behind StateManager gets, it only
+applies the newest values once.
+"""
+import collections
+import multiprocessing
+import queue
+import time
+
+from runtimeUtil import *
+
+CONTROL = "control"
+REQUEST = "request"
+TELEMETRY = "telemetry"
+# Lanes, most urgent first
+LANES = (CONTROL, REQUEST, TELEMETRY)
+
+CONTROL_COMMANDS = {
+    SM_COMMANDS.EMERGENCY_STOP,
+}
+# Requests that clear an emergency stop, which must not undo one sent after them
+CLEARS_STOP = {
+    SM_COMMANDS.RESET,
+    SM_COMMANDS.EMERGENCY_RESTART,
+}
+
+
+def merge_device_values(old_args, new_args):
+    """Merge two batches of device values, keeping the newest value of each param."""
+    merged = {uid: dict(params) for uid, params in old_args[0].items()}
+    for uid, params in new_args[0].items():
+        merged.setdefault(uid, {}).update(params)
+    return [{uid: list(params.items()) for uid, params in merged.items()}]
+
+
+def merge_ansible(old_args, new_args):
+    """Merge two updates from Dawn, keeping the newest value of each key."""
+    merged = dict(old_args[0])
+    merged.update(new_args[0])
+    return [merged]
+
+
+def newest(_old_args, new_args):
+    """Keep only the newest request."""
+    return new_args
+
+
+# Telemetry commands, and how to conflate two requests of each kind
+TELEMETRY_COMMANDS = {
+    HIBIKE_RESPONSE.DEVICE_VALUES.value: merge_device_values,
+    HIBIKE_RESPONSE.DEVICE_STATS.value: newest,
+    SM_COMMANDS.RECV_ANSIBLE: merge_ansible,
+    SM_COMMANDS.SET_TEAM: newest,
+}
+
+
+def lane_of(cmd_type):
+    """Return the lane requests of CMD_TYPE go in."""
+    if cmd_type in CONTROL_COMMANDS:
+        return CONTROL
+    if cmd_type in TELEMETRY_COMMANDS:
+        return TELEMETRY
+    return REQUEST
+
+
+def clears_stop(request):
+    """Whether REQUEST clears an emergency stop."""
+    try:
+        return request[0] in CLEARS_STOP
+    except (IndexError, TypeError):
+        return False
+
+
+class StateQueue:
+    """A multiprocessing queue that remembers when each request was put in it.
+
+    ``time.monotonic`` is the same clock in every process, so StateManager
+    can tell how long a request waited. CONTEXT is the multiprocessing
+    context the processes using the queue are started with.
+    """
+    def __init__(self, context=multiprocessing):
+        self._queue = context.Queue()
+
+    def put(self, request, block=True, timeout=None):
+        self._queue.put((time.monotonic(), request), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        """Returns ``(time sent, request)``."""
+        return self._queue.get(block, timeout)
+
+    def get_nowait(self):
+        return self._queue.get_nowait()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+
+class InputLanes:
+    """Requests from a `StateQueue`, sorted into lanes and handed out by priority."""
+
+    def __init__(self, state_queue, clock=time.monotonic):
+        self.state_queue = state_queue
+        self.clock = clock
+        self.control = collections.deque()
+        self.requests = collections.deque()
+        # {cmd_type: [time sent, request]}, oldest first
+        self.telemetry = collections.OrderedDict()
+        # Requests handled, and the total and longest time they waited, by lane
+        self.handled = dict.fromkeys(LANES, 0)
+        self.total_age = dict.fromkeys(LANES, 0.0)
+        self.max_age = dict.fromkeys(LANES, 0.0)
+        # Telemetry requests merged into an earlier one, by command
+        self.conflated = {}
+
+    def __len__(self):
+        return len(self.control) + len(self.requests) + len(self.telemetry)
+
+    def _add(self, queued_at, request):
+        try:
+            cmd_type = request[0]
+            lane = lane_of(cmd_type)
+        except (IndexError, TypeError):
+            # Let StateManager complain about it
+            lane = REQUEST
+        if lane == CONTROL:
+            self.control.append((queued_at, request))
+            # Stop again once whatever was waiting to clear the stop is handled
+            if any(clears_stop(waiting) for _, waiting in self.requests):
+                self.requests.append((queued_at, request))
+        elif lane == REQUEST:
+            self.requests.append((queued_at, request))
+        elif cmd_type in self.telemetry:
+            waiting = self.telemetry[cmd_type]
+            waiting[1] = [cmd_type, TELEMETRY_COMMANDS[cmd_type](waiting[1][1], request[1])]
+            self.conflated[cmd_type] = self.conflated.get(cmd_type, 0) + 1
+        else:
+            self.telemetry[cmd_type] = [queued_at, request]
+
+    def _fill(self):
+        """Move everything already in the queue into the lanes, waiting if there is nothing."""
+        if not self:
+            self._add(*self.state_queue.get(block=True))
+        while True:
+            try:
+                self._add(*self.state_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def get(self):
+        """Return the most urgent request, waiting for one if there are none."""
+        self._fill()
+        if self.control:
+            lane, (queued_at, request) = CONTROL, self.control.popleft()
+        elif self.requests:
+            lane, (queued_at, request) = REQUEST, self.requests.popleft()
+        else:
+            lane, (queued_at, request) = TELEMETRY, self.telemetry.popitem(last=False)[1]
+        age = self.clock() - queued_at
+        self.handled[lane] += 1
+        self.total_age[lane] += age
+        self.max_age[lane] = max(self.max_age[lane], age)
+        return request
+
+    def stats(self):
+        """Summarize the lanes, resetting the longest waits."""
+        stats = {
+            "waiting": {CONTROL: len(self.control), REQUEST: len(self.requests),
+                        TELEMETRY: len(self.telemetry)},
+            "handled": dict(self.handled),
+            "mean_age": {lane: self.total_age[lane] / self.handled[lane]
+                         if self.handled[lane] else 0.0 for lane in LANES},
+            "max_age": dict(self.max_age),
+            "conflated": {str(cmd_type): count for cmd_type, count in self.conflated.items()},
+        }
+        self.max_age = dict.fromkeys(LANES, 0.0)
+        return stats
@@ -0,0 +1,249 @@
+"""Robot state, indexed by tuple paths.
+
+StateManager's state used to be a tree of ``[value, timestamp]`` lists that
+every command walked key by key. ``StateStore`` keeps one flat dictionary
+from paths like ``("hibike", "devices", uid, "duty_cycle")`` to entries, so
+reading or writing a key is a single lookup no matter how deep it is.
+
+Every entry has a timestamp and a version. Writing a key gives it and all
+of its ancestors the current batch's timestamp and a new version from a
+counter that only goes up, so comparing versions tells whether anything
+under a path changed; ``changes`` uses that to return only what changed
+since a given version. ``new_batch`` starts a batch; ``time.time()`` is only
+called once per batch, the first time something is written.
+
+Paths that have keys under them are subtrees. Asking for one (or calling
+``nested``) builds the old ``{key: [value, timestamp]}`` dictionaries, which
+are cached until something under them changes.
+"""
+import time
+
+# Indices into an entry
+VALUE = 0
+TIMESTAMP = 1
+VERSION = 2
+# Keys of a subtree's children, in insertion order, or None for values
+CHILDREN = 3
+# The entries of every ancestor, from the root down
+ANCESTORS = 4
+
+ROOT = ()
+
+
+def is_subtree(value):
+    """Whether VALUE, from a nested state tree, has ``[value, timestamp]`` entries under it."""
+    return isinstance(value, dict) and all(
+        isinstance(child, list) and len(child) == 2 for child in value.values())
+
+
+class StateStore:
+    """
+    A tree of timestamped, versioned values indexed by tuple paths.
+    """
+
+    def __init__(self, nested=None, clock=time.time):
+        self.clock = clock
+        self.version = 0
+        self._now = None
+        self._entries = {ROOT: [None, 0, 0, {}, ()]}
+        # {path: (version, nested dictionary)} for subtrees that have been built
+        self._views = {}
+        if nested is not None:
+            self.load(nested)
+
+    def new_batch(self):
+        """
+        Start a new batch of writes, which will share one timestamp.
+        """
+        self._now = None
+
+    @property
+    def now(self):
+        """The timestamp of the current batch."""
+        if self._now is None:
+            self._now = self.clock()
+        return self._now
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def _new_entry(self, path, value, timestamp, children):
+        parent = self._entries[path[:-1]]
+        parent[CHILDREN][path[-1]] = None
+        entry = [value, timestamp, self.version, children, parent[ANCESTORS] + (parent,)]
+        self._entries[path] = entry
+        return entry
+
+    def _touch(self, entry):
+        """Give ENTRY and its ancestors a new version and the batch timestamp."""
+        self.version += 1
+        now = self.now
+        version = self.version
+        entry[TIMESTAMP] = now
+        entry[VERSION] = version
+        for ancestor in entry[ANCESTORS]:
+            ancestor[TIMESTAMP] = now
+            ancestor[VERSION] = version
+
+    def _drop_children(self, path, entry):
+        """Remove everything under the subtree at PATH."""
+        for key in entry[CHILDREN]:
+            child_path = path + (key,)
+            child = self._entries.pop(child_path)
+            self._views.pop(child_path, None)
+            if child[CHILDREN] is not None:
+                self._drop_children(child_path, child)
+        self._views.pop(path, None)
+
+    def get(self, path):
+        """
+        Return the value at PATH, building a nested dictionary if it is a subtree.
+
+        Raises KeyError if there is nothing at PATH.
+        """
+        entry = self._entries[path]
+        if entry[CHILDREN] is None:
+            return entry[VALUE]
+        return self._view(path, entry)
+
+    def _view(self, path, entry):
+        cached = self._views.get(path)
+        if cached is not None and cached[0] == entry[VERSION]:
+            return cached[1]
+        view = {}
+        for key in entry[CHILDREN]:
+            child_path = path + (key,)
+            child = self._entries[child_path]
+            if child[CHILDREN] is None:
+                view[key] = [child[VALUE], child[TIMESTAMP]]
+            else:
+                view[key] = [self._view(child_path, child), child[TIMESTAMP]]
+        self._views[path] = (entry[VERSION], view)
+        return view
+
+    def nested(self):
+        """
+        Return the whole state as a tree of ``[value, timestamp]`` lists.
+        """
+        return self._view(ROOT, self._entries[ROOT])
+
+    def changes(self, path, since):
+        """
+        Return what changed at or under PATH after version SINCE, or None if nothing did.
+
+        For a value, returns ``(version, value, None)``. For a subtree, returns
+        ``(version, changed, keys)``, where CHANGED has the ``[value, timestamp]``
+        of each child that changed and KEYS are the keys of all current children.
+        """
+        entry = self._entries[path]
+        if entry[VERSION] <= since:
+            return None
+        if entry[CHILDREN] is None:
+            return entry[VERSION], entry[VALUE], None
+        changed = {}
+        for key in entry[CHILDREN]:
+            child_path = path + (key,)
+            child = self._entries[child_path]
+            if child[VERSION] > since:
+                if child[CHILDREN] is None:
+                    changed[key] = [child[VALUE], child[TIMESTAMP]]
+                else:
+                    changed[key] = [self._view(child_path, child), child[TIMESTAMP]]
+        return entry[VERSION], changed, tuple(entry[CHILDREN])
+
+    def timestamp(self, path):
+        """
+        Return the time PATH, or anything under it, was last written.
+        """
+        return self._entries[path][TIMESTAMP]
+
+    def version_of(self, path):
+        """
+        Return the version of PATH, which goes up whenever it or anything under it is written.
+        """
+        return self._entries[path][VERSION]
+
+    def set(self, path, value):
+        """
+        Replace the value at PATH, which must already exist.
+
+        Raises KeyError if it doesn't.
+        """
+        entry = self._entries[path]
+        if entry[CHILDREN] is not None:
+            self._drop_children(path, entry)
+            entry[CHILDREN] = None
+        entry[VALUE] = value
+        self._touch(entry)
+
+    def update(self, path, items):
+        """
+        Set each ``(key, value)`` in ITEMS under the subtree PATH, skipping
+        keys that don't exist there. The keys written share a version.
+        """
+        entries = self._entries
+        written = []
+        for key, value in items:
+            entry = entries.get(path + (key,))
+            if entry is not None and entry[CHILDREN] is None:
+                entry[VALUE] = value
+                written.append(entry)
+        if written:
+            self._touch(entries[path])
+            for entry in written:
+                entry[TIMESTAMP] = self._now
+                entry[VERSION] = self.version
+
+    def create(self, path):
+        """
+        Create empty subtrees along PATH where there is nothing yet.
+
+        Raises TypeError if a key before the last one in PATH holds a value
+        rather than a subtree.
+        """
+        entry = None
+        for end in range(1, len(path) + 1):
+            entry = self._entries.get(path[:end])
+            if entry is None:
+                entry = self._new_entry(path[:end], None, 0, {})
+            elif entry[CHILDREN] is None and end < len(path):
+                raise TypeError("key '{}' is defined, but does not contain a dictionary.".format(
+                    path[end - 1]))
+        if entry is not None:
+            self._touch(entry)
+
+    def delete(self, path):
+        """
+        Remove PATH and everything under it.
+
+        Raises KeyError if there is nothing at PATH.
+        """
+        entry = self._entries.pop(path)
+        if entry[CHILDREN] is not None:
+            self._drop_children(path, entry)
+        parent = self._entries[path[:-1]]
+        del parent[CHILDREN][path[-1]]
+        self._touch(parent)
+
+    def load(self, nested, path=ROOT):
+        """
+        Add a tree of ``[value, timestamp]`` lists under the subtree PATH,
+        replacing any keys that are already there and keeping their timestamps.
+
+        Dictionaries whose values are all ``[value, timestamp]`` lists become
+        subtrees; anything else is a value.
+        """
+        for key, (value, timestamp) in nested.items():
+            child_path = path + (key,)
+            if child_path in self._entries:
+                self.delete(child_path)
+            self.version += 1
+            if is_subtree(value):
+                self._new_entry(child_path, None, timestamp, {})
+                self.load(value, child_path)
+            else:
+                self._new_entry(child_path, value, timestamp, None)
+        entry = self._entries[path]
+        entry[VERSION] = self.version
+        for ancestor in entry[ANCESTORS]:
+            ancestor[VERSION] = self.version
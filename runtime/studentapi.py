@@ -6,6 +6,7 @@ import inspect
 import io
 
 from runtimeUtil import *
+from sensortable import SensorTable
 
 
 class Actions:
@@ -13,31 +14,139 @@ class Actions:
     async def sleep(seconds):
         await asyncio.sleep(seconds)
 
+class Batch:
+    """Several StateManager requests, sent together in one round trip.
+
+    Use it as a context manager, which sends the requests when the block ends:
+
+        with Robot.batch() as batch:
+            batch.get_value("counter")
+            batch.set_value(3.0, "right")
+        counter, right = batch.results
+
+    Every request runs, even if an earlier one fails; the first error, in
+    request order, is then raised. ``results`` still holds the result of
+    every request, with the error in place of each one that failed.
+    """
+    def __init__(self, api):
+        self._api = api
+        self._requests = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.send()
+
+    def get_value(self, key, *args):
+        """Get the value associated with key."""
+        self._requests.append([SM_COMMANDS.GET_VAL, [[key] + list(args)]])
+
+    def set_value(self, value, key, *args):
+        """Set the value associated with key."""
+        self._requests.append([SM_COMMANDS.SET_VAL, [value, [key] + list(args)]])
+
+    def create_key(self, key, *args):
+        """Create a new key, or nested keys."""
+        self._requests.append([SM_COMMANDS.CREATE_KEY, [[key] + list(args)]])
+
+    def get_timestamp(self, key, *args):
+        """Get the time the value associated with key was last set."""
+        self._requests.append([SM_COMMANDS.GET_TIME, [[key] + list(args)]])
+
+    def send(self):
+        """Send the requests made so far. Returns their results, in order."""
+        requests, self._requests = self._requests, []
+        self.results = self._api._send_batch(requests) # pylint: disable=protected-access
+        # statemanager passes exceptions back; raise the first one
+        for result in self.results:
+            if isinstance(result, Exception):
+                raise result
+        return self.results
+
+
 class StudentAPI:
     """Hidden interface with State Manager."""
     def __init__(self, toManager, fromManager):
         self.from_manager = fromManager
         self.to_manager = toManager
 
+    def batch(self):
+        """Start a `Batch` of requests to StateManager."""
+        return Batch(self)
+
+    def _send_batch(self, requests):
+        """Send REQUESTS to StateManager as one command and return their results,
+        with an exception in place of each request that failed.
+        """
+        if not requests:
+            return []
+        self.to_manager.put([SM_COMMANDS.BATCH, [requests]])
+        return self.from_manager.recv()
+
     def _get_sm_value(self, key, *args):
         """Returns the value associated with key.
         """
-        self.to_manager.put([SM_COMMANDS.GET_VAL, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, Exception):
-            raise message
-        return message
+        with self.batch() as batch:
+            batch.get_value(key, *args)
+        return batch.results[0]
 
     def _set_sm_value(self, value, key, *args):
         """Sets the value associated with key.
         """
-        # statemanager passes exception, then check to see if returned value is
-        # exception or not
-        self.to_manager.put([SM_COMMANDS.SET_VAL, [value, [key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, Exception):
-            raise message
-        return message
+        with self.batch() as batch:
+            batch.set_value(value, key, *args)
+        return batch.results[0]
+
+
+class StateCache(StudentAPI):
+    """Local copies of parts of StateManager's state, refreshed once per tick.
+
+    ``refresh`` sends StateManager the version of each tracked path it last
+    saw, and gets back only the subtrees that changed since then.
+    """
+    def __init__(self, toManager, fromManager):
+        super().__init__(toManager, fromManager)
+        # {path: last version seen}, with -1 for paths never fetched
+        self.versions = {}
+        self.values = {}
+
+    def track(self, *path):
+        """Keep a copy of the value at PATH, starting with the next refresh."""
+        if path not in self.versions:
+            self.versions[path] = -1
+            self.values[path] = None
+
+    def get(self, *path):
+        """Return the cached value at PATH, fetching it if it never has been."""
+        if self.versions[path] == -1:
+            self.refresh()
+        return self.values[path]
+
+    def refresh(self):
+        """Fetch whatever changed under the tracked paths."""
+        if not self.versions:
+            return
+        self.to_manager.put([SM_COMMANDS.TICK_SNAPSHOT, [self.versions]])
+        changes = self.from_manager.recv()
+        if changes is None:
+            return
+        for path, change in changes.items():
+            if isinstance(change, Exception):
+                raise change
+            version, value, keys = change
+            if keys is None:
+                self.values[path] = value
+            else:
+                cached = self.values[path]
+                if not isinstance(cached, dict):
+                    cached = self.values[path] = {}
+                cached.update(value)
+                for key in cached.keys() - set(keys):
+                    del cached[key]
+            self.versions[path] = version
 
 
 class Gamepad(StudentAPI):
@@ -68,13 +177,14 @@ class Gamepad(StudentAPI):
         "joystick_right_y": 3
     }
 
-    def __init__(self, toManager, fromManager):
+    def __init__(self, toManager, fromManager, state_cache=None):
         super().__init__(toManager, fromManager)
-        self._get_gamepad()
+        self._state_cache = state_cache or StateCache(toManager, fromManager)
+        self._state_cache.track("gamepads")
 
-    def _get_gamepad(self):
-        """Fetch gamepads from StateManager."""
-        self.all_gamepads = self._get_sm_value("gamepads")
+    @property
+    def all_gamepads(self):
+        return self._state_cache.get("gamepads")
 
     def get_value(self, name, gamepad_number=0):
         """Get a value from a gamepad."""
@@ -120,25 +230,42 @@ class Robot(StudentAPI):
         "led4": [(bool,)],
     }
 
-    def __init__(self, to_manager, from_manager, func_map):
+    def __init__(self, to_manager, from_manager, func_map, state_cache=None):
         super().__init__(to_manager, from_manager)
         self.func_map = func_map
+        self._state_cache = state_cache or StateCache(to_manager, from_manager)
         self._create_sensor_mapping()
         self._coroutines_running = set()
+        self._coroutine_tasks = set()
         self._stdout_buffer = io.StringIO()
+        self._sensor_table = SensorTable.attach()
         self._get_all_sensors()
 
 
         self.student_code_writes = {}
 
     def _get_all_sensors(self):
-        """Get a list of sensors."""
-        self.peripherals = self._get_sm_value('hibike', 'devices')
+        """Track the list of sensors, which is fetched the first time it is read.
+
+        Not needed when sensor values can be read from the shared sensor table.
+        """
+        if self._sensor_table is None:
+            self._state_cache.track('hibike', 'devices')
+
+    @property
+    def peripherals(self):
+        return self._state_cache.get('hibike', 'devices')
 
     def get_value(self, device_name, param):
         """Get a single value from a device."""
         uid = self._hibike_get_uid(device_name)
         self._check_read_params(uid, param)
+        if self._sensor_table is not None:
+            try:
+                return self._sensor_table.read(uid, param)
+            except KeyError:
+                # Not (yet) in the table; ask StateManager instead
+                return self._get_sm_value('hibike', 'devices', uid, param)
         return self.peripherals[uid][0][param][0]
 
     def set_value(self, device_name, param, value):
@@ -185,7 +312,15 @@ class Robot(StudentAPI):
             await future
             self._coroutines_running.remove(func)
 
-        asyncio.ensure_future(wrapped_future())
+        task = asyncio.ensure_future(wrapped_future())
+        self._coroutine_tasks.add(task)
+        task.add_done_callback(self._coroutine_tasks.discard)
+
+    def _stop_coroutines(self):
+        """Cancel every coroutine started with ``run``."""
+        for task in list(self._coroutine_tasks):
+            task.cancel()
+        self._coroutines_running.clear()
 
     def is_running(self, func):
         """Check if func is being run by ``Robot.run()``."""
@@ -241,19 +376,15 @@ class Robot(StudentAPI):
         """ Creates a new key, or nested keys if more than 1 key is passed in.
             If any nested key does not exist, it will be created.
         """
-        self.to_manager.put([SM_COMMANDS.CREATE_KEY, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, StudentAPIKeyError):
-            raise message
+        with self.batch() as batch:
+            batch.create_key(key, *args)
 
     def get_timestamp(self, key, *args):
         """Returns the value associated with key.
         """
-        self.to_manager.put([SM_COMMANDS.GET_TIME, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, StudentAPIKeyError):
-            raise message
-        return message
+        with self.batch() as batch:
+            batch.get_timestamp(key, *args)
+        return batch.results[0]
 
     def _hibike_get_uid(self, name):
         try:
@@ -0,0 +1,171 @@
+"""Plan how often each smart sensor sends its values.
+
+Every device sends its subscribed params in a DeviceData packet once per
+subscription delay. The size of that packet depends on the types of the
+params, so the bandwidth a subscription costs is known from
+hibikeDevices.json alone.
+
+Each device type has a target rate and a priority (lower numbers are more
+important), set by its ``"subscription"`` in hibikeDevices.json.
+``SubscriptionScheduler.plan`` gives every device its target rate, then slows devices down until:
+
+  * no single serial link is busier than ``LINK_UTILIZATION`` of its
+    capacity, and
+  * the sum over all devices, which Hibike has to decode on one event loop,
+    stays under ``TOTAL_UTILIZATION`` of ``TOTAL_BYTES_PER_SEC``.
+
+When the total is too high, the least important devices are slowed down
+first, never below ``MIN_RATE``.
+"""
+import math
+import struct
+
+from runtimeUtil import HIBIKE_DEVICES, PARAM_TYPES
+
+# 115200 baud, with a start and stop bit for every byte
+LINK_BYTES_PER_SEC = 115200 / 10
+# Fraction of a link that subscriptions may use; the rest is left for
+# writes, reads and heartbeats
+LINK_UTILIZATION = 0.5
+# Sensor data Hibike can decode per second across all devices
+TOTAL_BYTES_PER_SEC = 48000
+# Fraction of TOTAL_BYTES_PER_SEC above which devices are slowed down
+TOTAL_UTILIZATION = 0.8
+# Slowest rate any device is slowed down to, in Hz
+MIN_RATE = 2
+# Subscription delays are sent as an unsigned 16-bit number of milliseconds
+MIN_DELAY_MS = 1
+MAX_DELAY_MS = 0xFFFF
+
+# Target rate in Hz and priority of device types without a "subscription"
+DEFAULT_POLICY = (25, 1)
+
+# {device_id: {param name: param size in bytes}}
+PARAM_SIZES = {device["id"]: {param["name"]: struct.calcsize("<" + PARAM_TYPES[param["type"]])
+                              for param in device["params"]}
+               for device in HIBIKE_DEVICES}
+
+
+def load_policies(devices=None):
+    """
+    Return the target rate and priority of each device type in DEVICES (by
+    default, those in hibikeDevices.json), as {device name: (rate, priority)}.
+    """
+    policies = {}
+    for device in HIBIKE_DEVICES if devices is None else devices:
+        if "subscription" in device:
+            policy = device["subscription"]
+            policies[device["name"]] = (policy["rate"], policy["priority"])
+    return policies
+
+
+def device_data_size(device_id, params):
+    """Size in bytes of the framed DeviceData packet carrying PARAMS."""
+    # Message id, payload length, bitmask, values, checksum
+    message = 2 + 2 + sum(PARAM_SIZES[device_id][param] for param in params) + 1
+    # COBS adds a byte per 254 bytes (at least one); the frame adds a zero and a length
+    return message + message // 254 + 1 + 2
+
+
+class Subscription:
+    """A device's subscribed params and its planned delay, given its POLICY of (rate, priority)."""
+
+    def __init__(self, uid, device_name, params, policy=DEFAULT_POLICY):
+        self.uid = uid
+        self.device_name = device_name
+        self.params = list(params)
+        self.target_rate, self.priority = policy
+        self.packet_size = device_data_size(uid >> 72, self.params)
+        self.rate = self.target_rate
+
+    @property
+    def delay(self):
+        """The subscription delay in milliseconds for the planned rate."""
+        return min(max(int(math.ceil(1000 / self.rate)), MIN_DELAY_MS), MAX_DELAY_MS)
+
+    @property
+    def bytes_per_sec(self):
+        """Bandwidth used at the planned rate."""
+        return self.packet_size * 1000 / self.delay
+
+
+class SubscriptionScheduler:
+    """
+    Keep the subscriptions of connected devices within the bandwidth budget.
+
+    POLICIES is {device name: (target rate, priority)}, from `load_policies`
+    by default.
+    """
+
+    def __init__(self, link_budget=LINK_BYTES_PER_SEC * LINK_UTILIZATION,
+                 total_budget=TOTAL_BYTES_PER_SEC * TOTAL_UTILIZATION, policies=None):
+        self.link_budget = link_budget
+        self.total_budget = total_budget
+        self.policies = load_policies() if policies is None else policies
+        self.subscriptions = {}
+
+    def add(self, uid, device_name, params):
+        """
+        Start scheduling a device, or schedule it again if it reset. Returns the
+        delays that changed, as {uid: delay}, which always include UID.
+        """
+        old_delays = self.delays()
+        self.subscriptions[uid] = Subscription(
+            uid, device_name, params, self.policies.get(device_name, DEFAULT_POLICY))
+        changed = self.plan(old_delays)
+        changed[uid] = self.subscriptions[uid].delay
+        return changed
+
+    def remove(self, uid):
+        """Stop scheduling a device. Returns the delays that changed, as {uid: delay}."""
+        old_delays = self.delays()
+        self.subscriptions.pop(uid, None)
+        return self.plan(old_delays)
+
+    def delays(self):
+        """The planned delay of every device, as {uid: delay}."""
+        return {uid: sub.delay for uid, sub in self.subscriptions.items()}
+
+    def plan(self, old_delays=None):
+        """
+        Recompute every device's rate. Returns the delays that differ from
+        OLD_DELAYS, or that changed if it is not given, as {uid: delay}.
+        """
+        if old_delays is None:
+            old_delays = self.delays()
+        for sub in self.subscriptions.values():
+            # Never more than a single link can carry
+            sub.rate = min(sub.target_rate, self.link_budget / sub.packet_size)
+        excess = self.total_bytes_per_sec() - self.total_budget
+        for priority in sorted({sub.priority for sub in self.subscriptions.values()},
+                               reverse=True):
+            if excess <= 0:
+                break
+            group = [sub for sub in self.subscriptions.values() if sub.priority == priority]
+            group_bytes = sum(sub.packet_size * sub.rate for sub in group)
+            floor_bytes = sum(sub.packet_size * min(sub.rate, MIN_RATE) for sub in group)
+            if group_bytes <= floor_bytes:
+                continue
+            scale = max(1 - excess / (group_bytes - floor_bytes), 0)
+            for sub in group:
+                floor = min(sub.rate, MIN_RATE)
+                sub.rate = floor + (sub.rate - floor) * scale
+            excess = self.total_bytes_per_sec() - self.total_budget
+        return {uid: sub.delay for uid, sub in self.subscriptions.items()
+                if old_delays.get(uid) != sub.delay}
+
+    def total_bytes_per_sec(self):
+        """Bandwidth used by all devices at their planned rates."""
+        return sum(sub.bytes_per_sec for sub in self.subscriptions.values())
+
+    def summary(self):
+        """Return the current plan as a dict fit for the state, with rates in Hz."""
+        return {
+            "bytes_per_sec": round(self.total_bytes_per_sec()),
+            "budget": round(self.total_budget),
+            "devices": {uid: {"device_name": sub.device_name, "priority": sub.priority,
+                              "delay_ms": sub.delay, "rate": round(1000 / sub.delay, 1),
+                              "target_rate": sub.target_rate,
+                              "bytes_per_sec": round(sub.bytes_per_sec)}
+                        for uid, sub in self.subscriptions.items()},
+        }
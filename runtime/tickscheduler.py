@@ -0,0 +1,161 @@
+"""Running student code's main function on a fixed cadence.
+
+``TickScheduler`` gives each tick an absolute deadline on a grid of
+``1 / rate_hz`` second slots, so the time spent in a tick and the error of each
+sleep never add up into drift. A tick that runs past the next deadline is an
+overrun; the slots it ran over are skipped rather than run back to back.
+
+Once ticks overrun ``SUSTAINED_OVERRUN`` times in a row, the overrun policy
+decides what happens:
+
+* ``"skip"``: nothing more; the skipped slots only show up in the stats.
+* ``"degrade"``: lower the rate to one the main function keeps up with.
+* ``"warn"``: tell the student, at most every ``WARN_INTERVAL`` seconds.
+
+``TickStats`` keeps how long the main function took and how late each tick
+woke up over the last ``STATS_WINDOW`` ticks.
+"""
+import collections
+import math
+import time
+
+# What to do about sustained overruns
+OVERRUN_POLICIES = ("skip", "degrade", "warn")
+# Overruns in a row that make an overrun sustained
+SUSTAINED_OVERRUN = 10
+# Number of recent ticks the percentiles are computed over
+STATS_WINDOW = 200
+# Time in seconds between warnings about sustained overruns
+WARN_INTERVAL = 5
+# Slowest rate in Hz "degrade" lowers the cadence to
+MIN_HZ = 1
+# Fraction of each period a degraded cadence leaves for the main function
+DEGRADE_HEADROOM = 0.8
+
+OVERRUN_WARNING = (
+    "{name} is running at {achieved:.1f} Hz instead of {rate_hz:g} Hz: it takes "
+    "{duration:.0f} ms (p99) and has {period:.0f} ms per tick.")
+DEGRADE_WARNING = OVERRUN_WARNING + " Lowering its rate to {new_rate_hz:g} Hz."
+
+
+def percentile(sorted_values, fraction):
+    """Return the FRACTION percentile of SORTED_VALUES, or None if there are none."""
+    if not sorted_values:
+        return None
+    index = min(int(math.ceil(fraction * len(sorted_values))) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+def summarize(values):
+    """Return the p50, p99 and max of VALUES in milliseconds."""
+    ordered = sorted(values)
+    summary = {}
+    for name, value in (("p50", percentile(ordered, 0.5)), ("p99", percentile(ordered, 0.99)),
+                        ("max", ordered[-1] if ordered else None)):
+        summary[name] = None if value is None else round(value * 1000, 3)
+    return summary
+
+
+class TickStats:
+    """
+    Durations of the main function, sleep errors and overruns of a `TickScheduler`.
+    """
+
+    def __init__(self, window=STATS_WINDOW):
+        self.durations = collections.deque(maxlen=window)
+        self.sleep_errors = collections.deque(maxlen=window)
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def summary(self):
+        """Return the stats as a dict fit for the state, with times in milliseconds."""
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "duration_ms": summarize(self.durations),
+            "sleep_error_ms": summarize(self.sleep_errors),
+        }
+
+
+# pylint: disable=too-many-instance-attributes
+class TickScheduler:
+    """
+    Deadlines for running NAME at RATE_HZ times per second, measured with CLOCK.
+
+    Call `tick_started` when a tick wakes up and `tick_finished` with how long
+    the main function took; it returns how long to sleep until the next tick.
+    WARN is called with a message for the student.
+    """
+
+    def __init__(self, rate_hz, policy="warn", name="main", warn=print, clock=time.monotonic):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy: {}".format(policy))
+        self.rate_hz = rate_hz
+        self.target_rate_hz = rate_hz
+        self.period = 1. / rate_hz
+        self.policy = policy
+        self.name = name
+        self.warn = warn
+        self.clock = clock
+        self.stats = TickStats()
+        self.deadline = clock()
+        self.consecutive_overruns = 0
+        # When the current run of overruns started
+        self.overruns_since = None
+        self.last_warning = None
+
+    def tick_started(self):
+        """Record how late the tick that is about to run woke up."""
+        self.stats.sleep_errors.append(max(self.clock() - self.deadline, 0.))
+
+    def tick_finished(self, duration):
+        """
+        Record that the main function took DURATION seconds, and return the
+        time in seconds until the next deadline.
+        """
+        self.stats.ticks += 1
+        self.stats.durations.append(duration)
+        now = self.clock()
+        self.deadline += self.period
+        if now <= self.deadline:
+            self.consecutive_overruns = 0
+            return self.deadline - now
+        missed = int((now - self.deadline) // self.period) + 1
+        self.stats.overruns += 1
+        self.stats.skipped += missed
+        self.deadline += missed * self.period
+        if self.consecutive_overruns == 0:
+            self.overruns_since = now
+        self.consecutive_overruns += 1
+        if self.consecutive_overruns >= SUSTAINED_OVERRUN:
+            self.consecutive_overruns = 0
+            achieved = (SUSTAINED_OVERRUN - 1) / max(now - self.overruns_since, self.period)
+            self._sustained_overrun(now, achieved)
+        return self.deadline - now
+
+    def summary(self):
+        """Return the cadence and `TickStats` of this scheduler as a dict."""
+        summary = self.stats.summary()
+        summary.update(rate_hz=self.rate_hz, target_rate_hz=self.target_rate_hz,
+                       policy=self.policy)
+        return summary
+
+    def _sustained_overrun(self, now, achieved):
+        if self.policy == "skip":
+            return
+        duration = percentile(sorted(self.stats.durations), 0.99)
+        details = dict(name=self.name, achieved=achieved, rate_hz=self.rate_hz,
+                       duration=duration * 1000, period=self.period * 1000)
+        if self.policy == "degrade":
+            fits = DEGRADE_HEADROOM / duration if duration > 0 else self.rate_hz
+            new_rate_hz = max(MIN_HZ, math.floor(min(achieved, fits)))
+            if new_rate_hz < self.rate_hz:
+                self.warn(DEGRADE_WARNING.format(new_rate_hz=new_rate_hz, **details))
+                self.rate_hz = new_rate_hz
+                self.period = 1. / new_rate_hz
+                self.deadline = now + self.period
+        elif self.last_warning is None or now - self.last_warning >= WARN_INTERVAL:
+            self.last_warning = now
+            self.warn(OVERRUN_WARNING.format(**details))